@@ -60,5 +60,7 @@ setup(
         create_admin = awraamba.scripts.db:create_admin
         populate_db = awraamba.scripts.db:populate
         bootstrap_db = awraamba.scripts.db:bootstrap
+        bench_serialize = awraamba.scripts.bench:serialization
+        compress_assets = awraamba.scripts.assets:compress
     """,
 )
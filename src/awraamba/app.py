@@ -9,22 +9,46 @@
   
 """
 
+import logging
+
 from pyramid.config import Configurator
+from pyramid.events import BeforeRender
+from pyramid.path import AssetResolver
 from sqlalchemy import engine_from_config
+from sqlalchemy.exc import SQLAlchemyError
 
 from pyramid.authentication import RemoteUserAuthenticationPolicy
 from pyramid.request import Request
+from pyramid.settings import asbool
 from pyramid.view import AppendSlashNotFoundViewFactory
 from pyramid_assetgen import AssetGenRequestMixin
 from pyramid_beaker import session_factory_from_settings
+from pyramid_weblayer.i18n import add_underscore_translation
 
+from .basemodel import query_cache
+from .caching import LRUCache, LocalBackend, SingleFlight, backend_from_settings
+from .catalog import load_catalog
+from .live import EventHub
+from .mail import MailDispatcher, MailSpool, PostmarkMailer
+from .middleware import GzipMiddleware, MicroCacheMiddleware
 from .model import Session
-from .views import add_visited_cookie, get_is_authenticated, get_user
+from .passwords import password_hasher
+from .renderers import JSONStreamRenderer
+from .resolver import domain_resolver
+from .static import TourIndex, asset_view, derivative_view, get_tour_path
+from .static import media_view
+from .static import tour_view, versioned_tour_view
+from .thumbnails import Thumbnailer
+from .views import get_is_authenticated, get_user
 from .views import not_found_view
 
 # Mapping of route names to patterns.
 route_mapping = (
     ('reactions', '/api/reactions/'),
+    ('reaction_events', '/api/reactions/events'),
+    ('threads', '/api/threads/'),
+    ('catalog', '/api/catalog'),
+    ('stats', '/api/stats'),
     ('app', '/*path'),
 )
 
@@ -36,13 +60,94 @@ def factory(global_config, **settings):
     engine = engine_from_config(settings, 'sqlalchemy.')
     Session.configure(bind=engine)
     
+    # Cache instances looked up by id, slug or other unique column, in
+    # process or, if configured, in memcached.
+    ttl = int(settings.get('query_cache.ttl', 300))
+    query_cache.configure(backend_from_settings(settings), ttl=ttl)
+    
+    # Hash and verify passwords in dedicated worker processes.
+    password_hasher.configure(
+        processes=int(settings.get('passwords.processes', 2)),
+        max_waiting=int(settings.get('passwords.max_waiting', 16)),
+        timeout=float(settings.get('passwords.timeout', 30)),
+        rounds=int(settings.get('passwords.rounds', 90000))
+    )
+    
+    # Check that signup email domains resolve, caching the answers.
+    dns_servers = settings.get('dns.servers')
+    domain_resolver.configure(
+        servers=dns_servers.split() if dns_servers else None,
+        timeout=float(settings.get('dns.timeout', 2)),
+        ttl=int(settings.get('dns.ttl', 3600)),
+        negative_ttl=int(settings.get('dns.negative_ttl', 300))
+    )
+    
     # Initialise the ``Configurator`` with authentication policy.
     auth_policy = RemoteUserAuthenticationPolicy()
     config = Configurator(settings=settings, authentication_policy=auth_policy)
     
+    # Serve live reaction events to subscribers from a dedicated, non-blocking
+    # loop, if configured to listen on a ``live.port``.  It's started below.
+    hub = EventHub()
+    if settings.get('live.port'):
+        hub.listen(settings.get('live.host', '0.0.0.0'), int(settings['live.port']))
+    config.registry.live_hub = hub
+    
+    # Load the editorial themes, characters and locations into memory.  If
+    # the tables don't exist yet, e.g.: before ``reset_db``, they're loaded
+    # on first use instead.
+    try:
+        config.registry.catalog = load_catalog(engine)
+    except SQLAlchemyError as err:
+        logging.warning('Not loading the catalog at startup: %s' % err)
+        config.registry.catalog = None
+    
+    # Cache serialised ``(body, etag, last_modified)`` pages of reactions by
+    # theme, within a memory budget measured by body size.
+    max_bytes = int(settings.get('reactions_cache.max_bytes', 67108864))
+    sizeof = lambda entry: len(entry[0])
+    config.registry.reactions_cache = LRUCache(max_bytes, sizeof=sizeof)
+    
+    # Cache rendered ``(body, etag, has_placeholder)`` app shells.
+    max_bytes = int(settings.get('shell_cache.max_bytes', 8388608))
+    config.registry.shell_cache = LRUCache(max_bytes, sizeof=sizeof)
+    
+    # Coalesce concurrent identical requests on expensive read paths.
+    timeout = float(settings.get('single_flight.timeout', 5))
+    config.registry.single_flight = SingleFlight(timeout=timeout)
+    
+    # Briefly cache public responses to anonymous requests, if configured
+    # with a ``micro_cache.ttl``.
+    micro_cache_ttl = int(settings.get('micro_cache.ttl', 0))
+    micro_cache = None
+    if micro_cache_ttl:
+        max_items = int(settings.get('micro_cache.max_items', 1000))
+        micro_cache = LocalBackend(max_items=max_items)
+    config.registry.micro_cache = micro_cache
+    
+    # Spool outgoing mail on disk and, if there's a ``postmark.api_key``,
+    # send it in batches from a background thread, started below.
+    api_key = settings.get('postmark.api_key')
+    spool = MailSpool(settings['mail.spool_dir'])
+    config.registry.mailer = PostmarkMailer(api_key, spool=spool)
+    dispatcher = MailDispatcher(spool, api_key,
+        api_url=settings.get('mail.api_url', 'https://api.postmarkapp.com/'),
+        batch_size=int(settings.get('mail.batch_size', 100)),
+        poll_interval=float(settings.get('mail.poll_interval', 1)),
+        timeout=float(settings.get('mail.timeout', 10)),
+        max_attempts=int(settings.get('mail.max_attempts', 8)),
+        backoff=float(settings.get('mail.backoff', 2)),
+        max_backoff=float(settings.get('mail.max_backoff', 3600))
+    )
+    config.registry.mail_dispatcher = dispatcher
+    
     # Include external libraries.
     config.include('pyramid_assetgen')
-    config.include('pyramid_weblayer')
+    
+    # Add the ``pyramid_weblayer`` ``_`` translation function to templates.
+    # Its csrf subscriber isn't included, as it loads the session for every
+    # request: ``views.validate_against_csrf`` is used instead.
+    config.add_subscriber(add_underscore_translation, BeforeRender)
     
     # Setup request and session factories.
     class CustomRequest(AssetGenRequestMixin, Request):
@@ -55,19 +160,60 @@ def factory(global_config, **settings):
     config.set_request_property(get_is_authenticated, 'is_authenticated', reify=True)
     config.set_request_property(get_user, 'user', reify=True)
     
+    # Add a renderer that streams iterables out as JSON arrays.
+    config.add_renderer('json_stream', JSONStreamRenderer)
+    
     # Tell the translation machinery where the message strings are.
     config.add_translation_dirs(settings['locale_dir'])
     
     # Expose `/static` and `/thumbs` directories, cached for two weeks,
     # specifying that ``settings['static_dir'] has an assetgen manifest
-    # in it, and expose the panorama `/tour` files without caching.
+    # in it.
     static_dir = settings['static_dir']
     thumbs_dir = settings['thumbnails_dir']
-    tour_dir = settings['tour_dir']
     config.add_assetgen_manifest(static_dir)
+    # Serve the videos with a view that supports ``Range`` requests and the
+    # text assets with a view that serves precompressed variants.  Both must
+    # be routed before the ``/static`` view.
+    config.add_route('videos', '/static/videos/*subpath')
+    config.add_view(media_view, route_name='videos', request_method='GET')
+    config.add_view(media_view, route_name='videos', request_method='HEAD')
+    config.add_route('assets', '/static/{filename:[^/]+\.(?:css|js|json|svg|txt)}')
+    config.add_view(asset_view, route_name='assets', request_method='GET')
+    config.add_view(asset_view, route_name='assets', request_method='HEAD')
     config.add_static_view('static', static_dir, cache_max_age=1209600)
+    
+    # Make thumbnails of uploaded and remote images in worker processes and
+    # serve other sizes of them, rendered on demand, before the ``/thumbs``
+    # view.
+    cache_max_bytes = settings.get('thumbnails.cache_max_bytes', 268435456)
+    config.registry.thumbnailer = Thumbnailer(thumbs_dir,
+        processes=int(settings.get('thumbnails.processes', 2)),
+        max_bytes=int(settings.get('thumbnails.max_bytes', 10485760)),
+        max_pixels=int(settings.get('thumbnails.max_pixels', 25000000)),
+        max_pending=int(settings.get('thumbnails.max_pending', 100)),
+        timeout=float(settings.get('thumbnails.timeout', 10)),
+        store_dir=settings.get('thumbnails.store_dir'),
+        cache_max_bytes=int(cache_max_bytes)
+    )
+    config.add_route('thumb_derivatives', '/thumbs/{digest:[a-f0-9]{32}}/'
+            '{width:[0-9]{1,4}}x{height:[0-9]{1,4}}.{fmt:png|jpg|webp}')
+    config.add_view(derivative_view, route_name='thumb_derivatives',
+            request_method='GET')
+    config.add_view(derivative_view, route_name='thumb_derivatives',
+            request_method='HEAD')
     config.add_static_view('thumbs', thumbs_dir, cache_max_age=1209600)
-    config.add_static_view('tour', tour_dir)
+    
+    # Expose the panorama `/tour` files at immutable, content versioned urls
+    # and, for backwards compatibility, at revalidating unversioned urls.
+    tour_dir = AssetResolver().resolve(settings['tour_dir']).abspath()
+    tour_index = TourIndex(tour_dir, settings.get('tour.index_file'))
+    config.registry.tour_index = tour_index.load()
+    config.set_request_property(get_tour_path, 'tour_path', reify=True)
+    config.add_route('versioned_tour', '/tour/{version:[0-9a-f]{12}}/*subpath')
+    config.add_view(versioned_tour_view, route_name='versioned_tour')
+    config.add_route('tour', '/tour/*subpath')
+    config.add_view(tour_view, route_name='tour')
     
     # Configure a custom 404 that first tries to append a slash to the URL.
     not_found = AppendSlashNotFoundViewFactory(not_found_view)
@@ -91,6 +237,29 @@ def factory(global_config, **settings):
             return self.app(environ, start_response)
         
     
+    # Compress dynamic responses and micro cache them.
+    app = config.make_wsgi_app()
+    content_types = settings.get('gzip.content_types')
+    if content_types is not None:
+        content_types = content_types.split()
+    min_size = int(settings.get('gzip.min_size', 1024))
+    level = int(settings.get('gzip.level', 6))
+    app = GzipMiddleware(app, min_size=min_size, level=level,
+            content_types=content_types)
+    if micro_cache is not None:
+        max_size = int(settings.get('micro_cache.max_size', 65536))
+        app = MicroCacheMiddleware(app, micro_cache, ttl=micro_cache_ttl,
+                max_size=max_size)
+    
+    # Fork the worker processes before starting any threads, as forking
+    # whilst another thread holds a lock can deadlock the child.
+    password_hasher.start()
+    config.registry.thumbnailer.start()
+    if settings.get('live.port'):
+        hub.start()
+    if api_key and asbool(settings.get('mail.dispatch', True)):
+        dispatcher.start()
+    
     # Return a configured WSGI application.
-    return AuthenticationMiddleware(config.make_wsgi_app())
+    return AuthenticationMiddleware(app)
 
@@ -4,25 +4,44 @@
 """Abstracts SQLAlchemy boilerplace away from ``model.py``."""
 
 __all__ = [
+    'compile_serializer',
+    'decode_cursor',
+    'encode_cursor',
     'engine',
+    'get_cache_columns',
+    'get_public_keys',
+    'get_serializer',
+    'keyset_clause',
+    'open_snapshot',
+    'paginate',
+    'query_cache',
+    'stream_rows',
     'AuthMixin',
     'BaseMixin',
+    'QueryCache',
     'SearchMixin',
     'Session',
     'SlugMixin',
     'SQLModel',
 ]
 
+import base64
+import cPickle as pickle
+import hashlib
+import json
 import logging
+import weakref
 from datetime import datetime
 from decimal import Decimal
 
-from passlib.apps import custom_app_context as pwd_context
-from sqlalchemy import create_engine, desc, or_
+from sqlalchemy import and_, create_engine, desc, func, or_, select, tuple_
 from sqlalchemy import Column, MetaData
-from sqlalchemy import Boolean, DateTime, Integer, Unicode
+from sqlalchemy import Boolean, DateTime, Integer, Numeric, String, Unicode
+from sqlalchemy import event
 from sqlalchemy.ext.declarative import declared_attr, declarative_base
+from sqlalchemy.orm import class_mapper, object_session
 from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm.attributes import get_history, instance_state
 from zope.sqlalchemy import ZopeTransactionExtension
 
 Session = scoped_session(sessionmaker(extension=ZopeTransactionExtension()))
@@ -30,6 +49,396 @@ SQLModel = declarative_base()
 
 from pyramid_weblayer.utils import generate_hash
 
+from .passwords import password_hasher
+
+DATETIME_FORMATS = ('%Y-%m-%dT%H:%M:%S.%f', '%Y-%m-%dT%H:%M:%S')
+
+def _get_column_type(column):
+    """Return the type of a mapped attribute or a table column."""
+    
+    if hasattr(column, 'property'):
+        return column.property.columns[0].type
+    return column.type
+
+def encode_cursor(values):
+    """Encode a sequence of keyset ``values`` as an opaque, url safe token."""
+    
+    items = []
+    for value in values:
+        if isinstance(value, datetime):
+            value = value.isoformat()
+        elif isinstance(value, Decimal):
+            value = str(value)
+        items.append(value)
+    return base64.urlsafe_b64encode(json.dumps(items)).rstrip('=')
+
+def decode_cursor(token, columns):
+    """Decode a token generated by ``encode_cursor()`` back into a tuple of
+      values, coerced to the types of the ``columns`` they sort on.  Raises a
+      ``ValueError`` if the token can't be decoded.
+    """
+    
+    padded = str(token) + '=' * (-len(token) % 4)
+    try:
+        items = json.loads(base64.urlsafe_b64decode(padded))
+    except (TypeError, ValueError):
+        raise ValueError(token)
+    if not isinstance(items, list) or len(items) != len(columns):
+        raise ValueError(token)
+    values = []
+    for column, item in zip(columns, items):
+        column_type = _get_column_type(column)
+        if isinstance(column_type, DateTime):
+            for format_ in DATETIME_FORMATS:
+                try:
+                    item = datetime.strptime(item, format_)
+                except (TypeError, ValueError):
+                    continue
+                break
+            else:
+                raise ValueError(token)
+        elif isinstance(column_type, Numeric):
+            item = Decimal(str(item))
+        elif isinstance(column_type, Integer):
+            item = int(item)
+        values.append(item)
+    return tuple(values)
+
+def keyset_clause(columns, values, descending=False):
+    """Return a clause that matches the rows that sort after ``values`` when
+      ordering by ``columns``.  Compares row values, so a composite index on
+      the ``columns`` can be used to seek straight to the start of the page.
+    """
+    
+    if descending:
+        return tuple_(*columns) < tuple_(*values)
+    return tuple_(*columns) > tuple_(*values)
+
+def paginate(query, columns, limit, cursor=None, descending=False):
+    """Return ``(rows, next_cursor)`` for a page of ``limit`` rows from the
+      Core ``select`` ``query``, ordered by ``columns`` and starting after
+      ``cursor``.
+      
+      ``next_cursor`` is ``None`` when there are no more rows.
+    """
+    
+    if cursor is not None:
+        values = decode_cursor(cursor, columns)
+        query = query.where(keyset_clause(columns, values, descending))
+    # Select the sort keys under their own labels, so the cursor can be read
+    # off the last row whatever the rest of the select looks like.
+    labels = ['_key_%d' % i for i in range(len(columns))]
+    for column, label in zip(columns, labels):
+        query = query.column(column.label(label))
+    if descending:
+        query = query.order_by(*[item.desc() for item in columns])
+    else:
+        query = query.order_by(*columns)
+    rows = Session.execute(query.limit(limit + 1)).fetchall()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor([last[item] for item in labels])
+    return rows, next_cursor
+
+
+def open_snapshot():
+    """Return a new connection, in a transaction whose queries all read the
+      same snapshot of the db, e.g.: to validate rows that ``stream_rows``
+      then reads with it.
+    """
+    
+    connection = Session.bind.connect()
+    if connection.dialect.name == 'postgresql':
+        options = {'isolation_level': 'REPEATABLE READ'}
+        connection = connection.execution_options(**options)
+    connection.begin()
+    return connection
+
+def stream_rows(query, serializer, batch_size=1000, connection=None):
+    """Yield ``serializer(row)`` for each row of the Core ``select`` ``query``.
+      
+      The query runs lazily, on its own ``connection`` (by default, a new
+      one) with a server side cursor, fetching ``batch_size`` rows at a time,
+      and closes the connection when done.  That means it can be consumed
+      after the request's transaction has ended (e.g.: by a response
+      ``app_iter``) and that memory use doesn't grow with the result size.
+    """
+    
+    if connection is None:
+        connection = Session.bind.connect()
+    try:
+        options = connection.execution_options(stream_results=True)
+        result = options.execute(query)
+        while True:
+            rows = result.fetchmany(batch_size)
+            if not rows:
+                break
+            for row in rows:
+                yield serializer(row)
+    finally:
+        connection.close()
+
+
+_skip = object()
+_serializers = {}
+
+def _isoformat(value):
+    return value.isoformat()
+
+def _convert(value):
+    """Generic conversion for values that don't map to a known column type."""
+    
+    if isinstance(value, datetime):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if hasattr(value, '__json__'):
+        return value.__json__()
+    try:
+        unicode(value)
+    except TypeError:
+        return _skip
+    return value
+
+def get_public_keys(cls):
+    """Return the ``__public__`` keys of a model class."""
+    
+    public = cls.__public__
+    if isinstance(public, property):
+        return cls.__table__.c.keys()
+    return list(public)
+
+def compile_serializer(cls, keys=None):
+    """Return a function that serialises instances of, or result rows from,
+      model class ``cls``.
+      
+      How each of the ``keys`` (defaulting to ``cls.__public__``) is converted
+      is decided once, here, from its column type, rather than by inspecting
+      every value.  Only keys that aren't columns fall back to the generic
+      conversion.
+    """
+    
+    name = cls.__name__.lower()
+    if keys is None:
+        keys = get_public_keys(cls)
+    aliases = getattr(cls, '__public_aliases__', {})
+    columns = cls.__table__.c
+    plain = []
+    converted = []
+    generic = []
+    for key in keys:
+        column = columns.get(aliases.get(key, key))
+        if column is None:
+            generic.append(key)
+        elif isinstance(column.type, DateTime):
+            converted.append((key, _isoformat))
+        elif isinstance(column.type, Numeric):
+            converted.append((key, float))
+        elif isinstance(column.type, (Boolean, Integer, String)):
+            plain.append(key)
+        else:
+            generic.append(key)
+    plain = tuple(plain)
+    converted = tuple(converted)
+    generic = tuple(generic)
+    
+    def serializer(item):
+        d = {'__name__': name}
+        for key in plain:
+            d[key] = getattr(item, key)
+        for key, convert in converted:
+            v = getattr(item, key)
+            d[key] = v if v is None else convert(v)
+        for key in generic:
+            v = _convert(getattr(item, key))
+            if v is not _skip:
+                d[key] = v
+        return d
+    
+    return serializer
+
+def get_serializer(cls):
+    """Return the compiled serializer for model class ``cls``, compiling it
+      on first use.
+    """
+    
+    serializer = _serializers.get(cls)
+    if serializer is None:
+        serializer = _serializers[cls] = compile_serializer(cls)
+    return serializer
+
+_cache_columns = {}
+
+def get_uncached_columns(cls):
+    """Return the names of the columns of ``cls`` that ``query_cache`` never
+      stores, or looks instances up by, e.g.: password hashes.
+    """
+    
+    return frozenset(getattr(cls, '__uncached__', ()))
+
+def get_cache_columns(cls):
+    """Return the names of the columns that identify a single instance of
+      ``cls``, i.e.: its primary key and unique columns, which are the
+      columns that ``query_cache`` can cache lookups by.
+    """
+    
+    names = _cache_columns.get(cls)
+    if names is None:
+        uncached = get_uncached_columns(cls)
+        names = [c.name for c in cls.__table__.c
+                 if (c.primary_key or c.unique) and c.name not in uncached]
+        names = _cache_columns[cls] = frozenset(names)
+    return names
+
+
+class QueryCache(object):
+    """A second level cache of the instances looked up by a unique column,
+      e.g.: by ``User.get_by_id(1)`` or ``Theme.get_by_slug(u'gender')``.
+      Disabled until ``configure()``d with a backend from ``caching``.
+      
+      Instances are stored as pickled column values, which are merged into
+      the current session without a db round trip.  Columns listed in a
+      class's ``__uncached__`` aren't stored and are loaded from the db if
+      they're accessed.  Flushing changes to an
+      instance bumps its ``v`` column and, when the transaction commits, its
+      entries are replaced with markers of the new version, so readers with
+      older snapshots can't put stale copies back.  Entries also expire after
+      ``ttl`` seconds, which bounds how long changes made outside of the ORM
+      (or, with a ``LocalBackend``, by other processes) go unnoticed.
+    """
+    
+    def __init__(self):
+        self.backend = None
+        self.ttl = 300
+        self.hits = 0
+        self.misses = 0
+        self._pending = weakref.WeakKeyDictionary()
+    
+    def configure(self, backend, ttl=300):
+        self.backend = backend
+        self.ttl = ttl
+    
+    def make_key(self, cls, name, value):
+        raw = u'%s:%s:%s' % (cls.__tablename__, name, value)
+        return 'qc:%s' % hashlib.md5(raw.encode('utf-8')).hexdigest()
+    
+    def get(self, cls, name, value, load):
+        """Return the instance of ``cls`` whose unique column ``name`` has
+          ``value``, calling ``load()`` to query for it on a cache miss.
+        """
+        
+        if self.backend is None:
+            return load()
+        key = self.make_key(cls, name, value)
+        entry = self.backend.get(key)
+        if entry is not None and entry[1] is not None:
+            self.hits += 1
+            return self._loads(cls, entry[1])
+        self.misses += 1
+        instance = load()
+        if instance is not None and self._is_cacheable(instance, key):
+            version = instance.v or 0
+            if entry is None or version >= entry[0]:
+                data = self._dumps(instance)
+                self.backend.set(key, (version, data), self.ttl)
+        return instance
+    
+    def stats(self):
+        stats = {'hits': self.hits, 'misses': self.misses}
+        if self.backend is not None:
+            stats['backend'] = self.backend.stats()
+        return stats
+    
+    def _is_cacheable(self, instance, key):
+        """Instances with uncommitted changes aren't cacheable."""
+        
+        session = object_session(instance)
+        if session is None:
+            return True
+        if instance in session.new:
+            return False
+        if session.is_modified(instance, include_collections=False):
+            return False
+        return key not in self._pending.get(session, ())
+    
+    def _dumps(self, instance):
+        uncached = get_uncached_columns(instance.__class__)
+        keys = [k for k in instance.__table__.c.keys() if k not in uncached]
+        values = dict((k, getattr(instance, k)) for k in keys)
+        return pickle.dumps(values, pickle.HIGHEST_PROTOCOL)
+    
+    def _loads(self, cls, data):
+        """Return the instance in the identity map, if there is one, or merge
+          the cached copy into the session.
+        """
+        
+        mapper = class_mapper(cls)
+        instance = mapper.class_manager.new_instance()
+        instance.__dict__.update(pickle.loads(data))
+        identity_key = mapper.identity_key_from_instance(instance)
+        existing = Session.identity_map.get(identity_key)
+        if existing is not None:
+            return existing
+        instance_state(instance).key = identity_key
+        instance = Session.merge(instance, load=False)
+        uncached = get_uncached_columns(cls)
+        if uncached:
+            # Load the columns that weren't cached if they're accessed.
+            Session.expire(instance, list(uncached))
+        return instance
+    
+    def _get_changes(self, session):
+        """Yield ``(instance, version)`` for the instances that ``session``
+          is flushing changes to, where ``version`` is the lowest version
+          that's now valid.
+        """
+        
+        for instance in session.dirty:
+            if isinstance(instance, BaseMixin):
+                if session.is_modified(instance, include_collections=False):
+                    yield instance, instance.v or 0
+        for instance in session.deleted:
+            if isinstance(instance, BaseMixin):
+                yield instance, (instance.v or 0) + 1
+    
+    def before_flush(self, session, flush_context, instances):
+        """Bump the version of modified instances."""
+        
+        for instance, version in list(self._get_changes(session)):
+            if instance not in session.deleted:
+                instance.v = version + 1
+    
+    def after_flush(self, session, flush_context):
+        """Record the keys of the changed instances, including those of their
+          previous unique values, with their new versions.
+        """
+        
+        if self.backend is None:
+            return
+        pending = self._pending.setdefault(session, {})
+        for instance, version in self._get_changes(session):
+            cls = instance.__class__
+            for name in get_cache_columns(cls):
+                for value in get_history(instance, name).sum():
+                    if value is not None:
+                        key = self.make_key(cls, name, value)
+                        pending[key] = max(version, pending.get(key, 0))
+    
+    def after_commit(self, session):
+        pending = self._pending.pop(session, None)
+        if pending and self.backend is not None:
+            for key, version in pending.items():
+                self.backend.set(key, (version, None), self.ttl)
+    
+    def after_rollback(self, session):
+        self._pending.pop(session, None)
+    
+
+query_cache = QueryCache()
+
+
 class ClassProperty(property):
     def __get__(self, cls, owner):
         return self.fget.__get__(None, owner)()
@@ -48,12 +457,24 @@ class AuthMixin(object):
     is_confirmed = Column(Boolean, default=False)
     confirmation_hash = Column(Unicode, unique=True)
     
+    # Secrets that ``query_cache`` mustn't copy into a shared cache.
+    __uncached__ = ('password', 'confirmation_hash')
+    
     @classmethod
     def authenticate(cls, username, raw_password):
+        """Return the confirmed user with ``username`` if ``raw_password`` is
+          theirs, rehashing it if their hash is out of date.
+        """
+        
         query = cls.query.filter_by(username=username, is_confirmed=True)
         candidate = query.first()
-        if candidate and pwd_context.verify(raw_password, candidate.password):
-            return candidate
+        if candidate:
+            ok, new_hash = password_hasher.verify_and_update(raw_password,
+                    candidate.password)
+            if ok:
+                if new_hash is not None:
+                    candidate.password = unicode(new_hash)
+                return candidate
         return None
         
     
@@ -89,22 +510,7 @@ class BaseMixin(object):
         
     
     def __json__(self):
-        d = {'__name__': self.__class__.__name__.lower()}
-        for k in self.__public__:
-            v = getattr(self, k)
-            if isinstance(v, datetime):
-                v = v.isoformat()
-            elif isinstance(v, Decimal):
-                v = float(v)
-            elif hasattr(v, '__json__'):
-                v = v.__json__()
-            else:
-                try:
-                    unicode(v)
-                except TypeError:
-                    continue
-            d[k] = v
-        return d
+        return get_serializer(self.__class__)(self)
         
     
     @property
@@ -113,9 +519,59 @@ class BaseMixin(object):
         
     
     
+    @classmethod
+    def get_public_columns(cls):
+        """Return the table columns that provide ``__public__``, labelled with
+          their public names.  Public names that aren't column names are
+          looked up in ``cls.__public_aliases__``.
+        """
+        
+        aliases = getattr(cls, '__public_aliases__', {})
+        columns = []
+        for key in get_public_keys(cls):
+            name = aliases.get(key, key)
+            column = cls.__table__.c[name]
+            if name != key:
+                column = column.label(key)
+            columns.append(column)
+        return columns
+        
+    
+    @classmethod
+    def select_public(cls, *clauses):
+        """Return a read only Core ``select`` of the public columns matching
+          ``clauses``.  Executing it returns plain result rows, skipping ORM
+          hydration, the identity map and the unit of work, that can be fed
+          straight to ``get_serializer(cls)``.
+        """
+        
+        query = select(cls.get_public_columns())
+        if clauses:
+            query = query.where(and_(*clauses))
+        return query
+        
+    
+    @classmethod
+    def get_validator(cls, *clauses, **kwargs):
+        """Return ``(last_modified, count)`` for the rows matching ``clauses``,
+          which changes whenever a matching row is added, modified or removed.
+          Cheap enough to run before deciding whether to load the rows.  Runs
+          with the ``bind`` keyword argument, if given, or the ``Session``.
+        """
+        
+        bind = kwargs.get('bind', Session)
+        table = cls.__table__
+        query = select([func.max(table.c.m), func.count(table.c.id)])
+        if clauses:
+            query = query.where(and_(*clauses))
+        last_modified, count = bind.execute(query).first()
+        return last_modified, count
+        
+    
+    
     @classmethod
     def get_by_id(cls, id):
-        return cls.query.get(id)
+        return query_cache.get(cls, 'id', id, lambda: cls.query.get(id))
         
     
     @classmethod
@@ -123,6 +579,8 @@ class BaseMixin(object):
         kwargs = {}
         kwargs[name] = value
         query = cls.query.filter_by(**kwargs)
+        if name in get_cache_columns(cls):
+            return query_cache.get(cls, name, value, query.first)
         return query.first()
         
     
@@ -251,6 +709,15 @@ class SlugMixin(object):
     
     @classmethod
     def get_by_slug(cls, slug):
-        return cls.query.filter_by(slug=slug).first()
+        query = cls.query.filter_by(slug=slug)
+        return query_cache.get(cls, 'slug', slug, query.first)
     
 
+
+# Keep ``query_cache`` consistent with changes flushed and committed through
+# the ``Session``.
+event.listen(Session, 'before_flush', query_cache.before_flush)
+event.listen(Session, 'after_flush', query_cache.after_flush)
+event.listen(Session, 'after_commit', query_cache.after_commit)
+event.listen(Session, 'after_rollback', query_cache.after_rollback)
+
@@ -0,0 +1,411 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Provides ``LRUCache``, a thread safe, in-process cache with a memory budget
+  and tag based invalidation, and ``SingleFlight``, which coalesces concurrent
+  calls to compute the same value.  E.g.::
+      
+      cache = LRUCache(max_bytes=1024 * 1024)
+      cache.set('key', 'value', tags=['gender'])
+      cache.get('key')
+      => 'value'
+      cache.invalidate('gender')
+      cache.get('key')
+      => None
+  
+  And, with many threads calling at once, ``compute`` is only called once::
+      
+      single_flight = SingleFlight(timeout=5)
+      single_flight.do('key', compute, *args)
+  
+  Also provides the key value backends that the query cache in ``basemodel``
+  stores instances in: ``LocalBackend``, an in-process cache with TTL and LRU
+  eviction, and ``MemcachedBackend``, which shares a memcached server between
+  processes (``FakeMemcacheClient`` stands in for the server in tests)::
+      
+      backend = LocalBackend(max_items=10000)
+      backend.set('key', 'value', ttl=60)
+      backend = MemcachedBackend(memcache.Client(['127.0.0.1:11211']))
+      backend = MemcachedBackend(FakeMemcacheClient())
+  
+"""
+
+import cPickle as pickle
+import logging
+import threading
+import time
+
+from collections import OrderedDict
+
+class LRUCache(object):
+    """Stores values upto a budget of ``max_bytes``, evicting the least
+      recently used values first.  Values are sized with ``sizeof``, which
+      defaults to ``len()``.
+      
+      Values can be tagged, so that all the values derived from some data can
+      be invalidated together.  To avoid caching values computed from data
+      that was changed whilst they were being computed, read the tags'
+      ``generation()`` first and pass it to ``set()``.
+    """
+    
+    def __init__(self, max_bytes, sizeof=len):
+        self.max_bytes = max_bytes
+        self.sizeof = sizeof
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+        self._tags = {}
+        self._generations = {}
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def get(self, key, default=None):
+        """Return the value for ``key``, marking it as recently used."""
+        
+        with self._lock:
+            try:
+                item = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._items[key] = item
+            self.hits += 1
+            return item[0]
+    
+    def generation(self, tags):
+        """Return a token that changes whenever any of ``tags`` is invalidated."""
+        
+        with self._lock:
+            return tuple(self._generations.get(tag, 0) for tag in tags)
+    
+    def set(self, key, value, tags=(), generation=None):
+        """Store ``value`` under ``key``.  If ``generation`` is given and any of
+          the ``tags`` have been invalidated since it was read, the value is
+          stale and isn't stored.  Returns whether the value was stored.
+        """
+        
+        tags = tuple(tags)
+        size = self.sizeof(value)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if generation is not None:
+                current = tuple(self._generations.get(tag, 0) for tag in tags)
+                if current != generation:
+                    return False
+            self._remove(key)
+            self._items[key] = (value, size, tags)
+            self.size += size
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self.size > self.max_bytes:
+                oldest = next(iter(self._items))
+                self._remove(oldest)
+                self.evictions += 1
+            return True
+    
+    def delete(self, key):
+        with self._lock:
+            self._remove(key)
+    
+    def invalidate(self, tag):
+        """Remove all of the values tagged with ``tag``."""
+        
+        with self._lock:
+            self._generations[tag] = self._generations.get(tag, 0) + 1
+            for key in self._tags.pop(tag, ()):
+                self._remove(key)
+                self.invalidations += 1
+    
+    def clear(self):
+        with self._lock:
+            for tag in self._tags.keys():
+                self._generations[tag] = self._generations.get(tag, 0) + 1
+            self._items.clear()
+            self._tags.clear()
+            self.size = 0
+    
+    def stats(self):
+        return {
+            'items': len(self._items),
+            'size': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations
+        }
+    
+    def _remove(self, key):
+        """Remove ``key``.  Must be called with the lock held."""
+        
+        item = self._items.pop(key, None)
+        if item is not None:
+            value, size, tags = item
+            self.size -= size
+            for tag in tags:
+                keys = self._tags.get(tag)
+                if keys is not None:
+                    keys.discard(key)
+                    if not keys:
+                        del self._tags[tag]
+
+
+class _Call(object):
+    """An in-flight ``SingleFlight`` computation."""
+    
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.failed = False
+    
+
+
+class SingleFlight(object):
+    """Coalesces concurrent calls with the same key: the first caller (the
+      leader) computes the result and any callers that arrive whilst it's in
+      flight wait for, and share, it.
+      
+      Waiters give up after ``timeout`` seconds and compute the result
+      themselves, as they do if the leader fails.  So a slow or broken
+      computation degrades to uncoalesced calls, rather than stalling or
+      failing every caller.  Results are shared between threads, so they
+      mustn't be tied to the leader's thread, e.g.: to its db session.
+    """
+    
+    def __init__(self, timeout=5):
+        self.timeout = timeout
+        self.leaders = 0
+        self.coalesced = 0
+        self.timeouts = 0
+        self.failures = 0
+        self._lock = threading.Lock()
+        self._calls = {}
+    
+    def do(self, key, f, *args, **kwargs):
+        """Return ``f(*args, **kwargs)``, coalescing concurrent calls by ``key``."""
+        
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+                self.leaders += 1
+            else:
+                self.coalesced += 1
+        if is_leader:
+            try:
+                call.result = f(*args, **kwargs)
+            except:
+                call.failed = True
+                raise
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.event.set()
+            return call.result
+        if not call.event.wait(self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            return f(*args, **kwargs)
+        if call.failed:
+            with self._lock:
+                self.failures += 1
+            return f(*args, **kwargs)
+        return call.result
+    
+    def stats(self):
+        return {
+            'in_flight': len(self._calls),
+            'leaders': self.leaders,
+            'coalesced': self.coalesced,
+            'timeouts': self.timeouts,
+            'failures': self.failures
+        }
+    
+
+
+class LocalBackend(object):
+    """Stores upto ``max_items`` values in process for upto their ``ttl``
+      seconds, evicting the least recently used values first.
+    """
+    
+    def __init__(self, max_items=10000, clock=time.time):
+        self.max_items = max_items
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._lock = threading.Lock()
+        self._items = OrderedDict()
+    
+    def __len__(self):
+        return len(self._items)
+    
+    def get(self, key):
+        with self._lock:
+            try:
+                value, expires = self._items.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires and expires <= self.clock():
+                self.misses += 1
+                self.expirations += 1
+                return None
+            self._items[key] = (value, expires)
+            self.hits += 1
+            return value
+    
+    def set(self, key, value, ttl=0):
+        """Store ``value`` under ``key`` for ``ttl`` seconds, or until evicted
+          if ``ttl`` is zero.
+        """
+        
+        expires = self.clock() + ttl if ttl else 0
+        with self._lock:
+            self._items.pop(key, None)
+            self._items[key] = (value, expires)
+            while len(self._items) > self.max_items:
+                self._items.popitem(last=False)
+                self.evictions += 1
+    
+    def delete(self, key):
+        with self._lock:
+            self._items.pop(key, None)
+    
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+    
+    def stats(self):
+        return {
+            'backend': 'local',
+            'items': len(self._items),
+            'max_items': self.max_items,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'expirations': self.expirations
+        }
+    
+
+
+class MemcachedBackend(object):
+    """Stores values in a memcached server, shared between processes, using a
+      ``python-memcached`` style ``client``.  The server evicts and expires
+      values itself.  ``prefix`` namespaces the keys, e.g.: by deployment.
+    """
+    
+    def __init__(self, client, prefix=''):
+        self.client = client
+        self.prefix = prefix
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+    
+    def get(self, key):
+        try:
+            value = self.client.get(self.prefix + key)
+        except Exception:
+            logging.warning('Memcached get failed.', exc_info=True)
+            self.errors += 1
+            value = None
+        if value is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return value
+    
+    def set(self, key, value, ttl=0):
+        try:
+            self.client.set(self.prefix + key, value, time=ttl)
+        except Exception:
+            logging.warning('Memcached set failed.', exc_info=True)
+            self.errors += 1
+    
+    def delete(self, key):
+        try:
+            self.client.delete(self.prefix + key)
+        except Exception:
+            logging.warning('Memcached delete failed.', exc_info=True)
+            self.errors += 1
+    
+    def clear(self):
+        self.client.flush_all()
+    
+    def stats(self):
+        return {
+            'backend': 'memcached',
+            'hits': self.hits,
+            'misses': self.misses,
+            'errors': self.errors
+        }
+    
+
+
+class FakeMemcacheClient(object):
+    """An in-process stand-in for ``memcache.Client``.  Like the real thing,
+      it pickles values, so callers get copies rather than shared objects.
+    """
+    
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._items = {}
+    
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            return None
+        data, expires = item
+        if expires and expires <= self.clock():
+            del self._items[key]
+            return None
+        return pickle.loads(data)
+    
+    def set(self, key, value, time=0):
+        expires = self.clock() + time if time else 0
+        data = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        self._items[key] = (data, expires)
+        return True
+    
+    def delete(self, key):
+        self._items.pop(key, None)
+        return 1
+    
+    def flush_all(self):
+        self._items.clear()
+    
+
+
+def backend_from_settings(settings, prefix='query_cache.'):
+    """Return the backend configured by ``settings``, e.g.::
+      
+          query_cache.backend = memcached
+          query_cache.servers = 127.0.0.1:11211 127.0.0.1:11212
+      
+      Or ``None`` if the backend is ``none``.  Defaults to a ``LocalBackend``
+      with ``query_cache.max_items``.
+    """
+    
+    name = settings.get(prefix + 'backend', 'local')
+    if name == 'none':
+        return None
+    if name == 'local':
+        max_items = int(settings.get(prefix + 'max_items', 10000))
+        return LocalBackend(max_items=max_items)
+    if name == 'fake':
+        return MemcachedBackend(FakeMemcacheClient())
+    if name == 'memcached':
+        import memcache
+        servers = settings.get(prefix + 'servers', '127.0.0.1:11211').split()
+        key_prefix = settings.get(prefix + 'key_prefix', '')
+        return MemcachedBackend(memcache.Client(servers), prefix=key_prefix)
+    raise ValueError('Unknown cache backend: %s' % name)
+
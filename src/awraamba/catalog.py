@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Provides ``load_catalog()``, which reads the editorial themes, characters
+  and locations, and the relations between them, into a frozen, in-memory
+  ``Catalog``, e.g.::
+      
+      catalog = load_catalog(engine)
+      theme = catalog.themes.get_by_slug(u'gender')
+      for id in theme.character_ids:
+          character = catalog.characters[id]
+  
+  The app ``factory`` loads the catalog at startup into
+  ``registry.catalog`` or, if it can't be loaded yet, e.g.: before the db
+  tables are created, ``get_catalog()`` loads it on first use.  It's never
+  modified: reloading replaces it whole, so request threads can read it
+  without locks.
+"""
+
+import hashlib
+import json
+
+from sqlalchemy import select
+
+from .model import Character, Location, Session, Theme
+from .model import c_locs, t_chars, t_locs
+
+class Frozen(object):
+    """Base class for slotted instances whose attributes can't be set once
+      ``__init__`` has set them.
+    """
+    
+    __slots__ = ()
+    
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            object.__setattr__(self, name, kwargs[name])
+    
+    def __setattr__(self, name, value):
+        raise AttributeError('%s is read only.' % self.__class__.__name__)
+    
+    def __delattr__(self, name):
+        raise AttributeError('%s is read only.' % self.__class__.__name__)
+    
+    def __repr__(self):
+        return '<%s %s>' % (self.__class__.__name__, getattr(self, 'slug', ''))
+
+
+
+class FrozenDict(dict):
+    """A ``dict`` that can't be changed once it's been created."""
+    
+    def _read_only(self, *args, **kwargs):
+        raise TypeError('%s is read only.' % self.__class__.__name__)
+    
+    __setitem__ = __delitem__ = _read_only
+    clear = pop = popitem = setdefault = update = _read_only
+
+
+
+class ThemeEntry(Frozen):
+    __slots__ = ('id', 'slug', 'title', 'description', 'character_ids',
+                 'location_ids')
+
+
+class CharacterEntry(Frozen):
+    __slots__ = ('id', 'slug', 'name', 'bio', 'theme_ids', 'location_ids')
+
+
+class LocationEntry(Frozen):
+    __slots__ = ('id', 'slug', 'title', 'description', 'theme_ids',
+                 'character_ids')
+
+
+
+class Index(Frozen):
+    """The entries of one type, indexed by id and by slug, in read only
+      ``by_id`` and ``ids_by_slug`` mappings.
+    """
+    
+    __slots__ = ('by_id', 'ids_by_slug')
+    
+    def __getitem__(self, id):
+        return self.by_id[id]
+    
+    def __iter__(self):
+        return iter(self.by_id[id] for id in sorted(self.by_id))
+    
+    def __len__(self):
+        return len(self.by_id)
+    
+    def get(self, id, default=None):
+        return self.by_id.get(id, default)
+    
+    def get_by_slug(self, slug, default=None):
+        id = self.ids_by_slug.get(slug)
+        if id is None:
+            return default
+        return self.by_id[id]
+
+
+
+class Catalog(Frozen):
+    """The ``themes``, ``characters`` and ``locations`` and the catalog's
+      serialised JSON ``body``, with an ``etag`` that identifies it.
+    """
+    
+    __slots__ = ('themes', 'characters', 'locations', 'body', 'etag')
+
+
+
+def _adjacency(rows):
+    """Return ``{a: (b, ...)}`` and ``{b: (a, ...)}`` for the ``(a, b)`` pairs
+      in an association table's ``rows``.
+    """
+    
+    forward = {}
+    backward = {}
+    for a, b in rows:
+        if a is None or b is None:
+            continue
+        forward.setdefault(a, set()).add(b)
+        backward.setdefault(b, set()).add(a)
+    freeze = lambda d: dict((k, tuple(sorted(v))) for k, v in d.items())
+    return freeze(forward), freeze(backward)
+
+def _index(entries):
+    by_id = FrozenDict((item.id, item) for item in entries)
+    ids_by_slug = FrozenDict((item.slug, item.id) for item in entries)
+    return Index(by_id=by_id, ids_by_slug=ids_by_slug)
+
+def _slugs(index, ids):
+    return [index[id].slug for id in ids]
+
+def load_catalog(bind):
+    """Load the catalog with ``bind``, an engine, connection or session."""
+    
+    execute = bind.execute
+    theme_chars, char_themes = _adjacency(execute(select(
+        [t_chars.c.theme_id, t_chars.c.character_id]
+    )))
+    theme_locs, loc_themes = _adjacency(execute(select(
+        [t_locs.c.theme_id, t_locs.c.location_id]
+    )))
+    char_locs, loc_chars = _adjacency(execute(select(
+        [c_locs.c.character_id, c_locs.c.location_id]
+    )))
+    columns = lambda cls, *names: [cls.__table__.c[name] for name in names]
+    themes = _index([ThemeEntry(
+        id=row.id,
+        slug=row.slug,
+        title=row.title,
+        description=row.description,
+        character_ids=theme_chars.get(row.id, ()),
+        location_ids=theme_locs.get(row.id, ())
+    ) for row in execute(select(
+        columns(Theme, 'id', 'slug', 'title', 'description')
+    ))])
+    characters = _index([CharacterEntry(
+        id=row.id,
+        slug=row.slug,
+        name=row.name,
+        bio=row.bio,
+        theme_ids=char_themes.get(row.id, ()),
+        location_ids=char_locs.get(row.id, ())
+    ) for row in execute(select(
+        columns(Character, 'id', 'slug', 'name', 'bio')
+    ))])
+    locations = _index([LocationEntry(
+        id=row.id,
+        slug=row.slug,
+        title=row.title,
+        description=row.description,
+        theme_ids=loc_themes.get(row.id, ()),
+        character_ids=loc_chars.get(row.id, ())
+    ) for row in execute(select(
+        columns(Location, 'id', 'slug', 'title', 'description')
+    ))])
+    # Serialise the whole graph once, linking entries by slug for the client.
+    data = {
+        'themes': [{
+            'id': item.id,
+            'slug': item.slug,
+            'title': item.title,
+            'description': item.description,
+            'characters': _slugs(characters, item.character_ids),
+            'locations': _slugs(locations, item.location_ids)
+        } for item in themes],
+        'characters': [{
+            'id': item.id,
+            'slug': item.slug,
+            'name': item.name,
+            'bio': item.bio,
+            'themes': _slugs(themes, item.theme_ids),
+            'locations': _slugs(locations, item.location_ids)
+        } for item in characters],
+        'locations': [{
+            'id': item.id,
+            'slug': item.slug,
+            'title': item.title,
+            'description': item.description,
+            'themes': _slugs(themes, item.theme_ids),
+            'characters': _slugs(characters, item.character_ids)
+        } for item in locations]
+    }
+    body = json.dumps(data, sort_keys=True, separators=(',', ':'))
+    return Catalog(
+        themes=themes,
+        characters=characters,
+        locations=locations,
+        body=body,
+        etag=hashlib.md5(body).hexdigest()
+    )
+
+def get_catalog(request):
+    """Return the ``registry.catalog``, loading it if it wasn't loaded at
+      startup.
+    """
+    
+    registry = request.registry
+    catalog = registry.catalog
+    if catalog is None:
+        catalog = registry.catalog = load_catalog(Session)
+    return catalog
+
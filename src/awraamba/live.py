@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Provides ``EventHub``, an in-process pub/sub hub that pushes events to
+  `Server-Sent Events`_ subscribers, e.g.::
+      
+      hub = EventHub()
+      hub.listen('0.0.0.0', 6544)
+      hub.start()
+  
+  Clients subscribe to a channel with an ``EventSource``, e.g.: to get the
+  new reactions to the "gender" theme::
+      
+      new EventSource('/api/reactions/events?theme_slug=gender')
+  
+  Publishers in any thread then fan events out to a channel's subscribers::
+      
+      hub.publish('gender', 'reaction', data)
+  
+  The subscriber connections are served from a single, dedicated non-blocking
+  ``asyncore`` loop (on its own port) rather than tying up a waitress thread
+  each, so thousands of idle subscribers cost little more than their sockets.
+  
+  .. _`Server-Sent Events`: http://www.w3.org/TR/eventsource/
+"""
+
+import asynchat
+import asyncore
+import json
+import logging
+import socket
+import threading
+import time
+import urlparse
+
+from waitress.trigger import trigger
+
+from .schema import valid_slug
+
+EVENTS_PATH = '/api/reactions/events'
+HEARTBEAT_INTERVAL = 15
+MAX_REQUEST_SIZE = 8192
+
+def format_event(event, data, id=None):
+    """Return an event in the ``text/event-stream`` wire format."""
+    
+    lines = []
+    if id is not None:
+        lines.append('id: %s' % id)
+    lines.append('event: %s' % event)
+    for line in json.dumps(data).splitlines():
+        lines.append('data: %s' % line)
+    return '\n'.join(lines) + '\n\n'
+
+
+class EventStreamChannel(asynchat.async_chat):
+    """Reads a subscriber's ``GET`` request and, if it's for a valid channel,
+      responds with the ``text/event-stream`` headers and subscribes the
+      connection to the channel.
+    """
+    
+    def __init__(self, hub, sock, map):
+        asynchat.async_chat.__init__(self, sock, map=map)
+        self.hub = hub
+        self.channel_name = None
+        self._buffer = []
+        self._size = 0
+        self.set_terminator('\r\n\r\n')
+    
+    def collect_incoming_data(self, data):
+        if self.channel_name is not None:
+            return
+        self._size += len(data)
+        if self._size > MAX_REQUEST_SIZE:
+            self.close()
+        else:
+            self._buffer.append(data)
+    
+    def found_terminator(self):
+        request = ''.join(self._buffer)
+        self._buffer = []
+        self.set_terminator(None)
+        try:
+            method, target, version = request.split('\r\n', 1)[0].split(' ', 2)
+        except ValueError:
+            return self.respond_with_error('400 Bad Request')
+        parts = urlparse.urlsplit(target)
+        params = urlparse.parse_qs(parts.query)
+        slug = params.get('theme_slug', [''])[0].strip().lower()
+        if method != 'GET':
+            return self.respond_with_error('405 Method Not Allowed')
+        if parts.path != EVENTS_PATH:
+            return self.respond_with_error('404 Not Found')
+        if not valid_slug.match(slug):
+            return self.respond_with_error('400 Bad Request')
+        self.push('\r\n'.join((
+            'HTTP/1.1 200 OK',
+            'Content-Type: text/event-stream',
+            'Cache-Control: no-cache',
+            'Access-Control-Allow-Origin: *',
+            'Connection: keep-alive',
+            '',
+            'retry: 5000',
+            '',
+            ''
+        )))
+        self.channel_name = slug
+        self.hub.subscribe(slug, self)
+    
+    def respond_with_error(self, status):
+        self.push('HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % status)
+        self.close_when_done()
+    
+    def handle_error(self):
+        logging.warning('Event stream error.', exc_info=True)
+        self.handle_close()
+    
+    def handle_close(self):
+        if self.channel_name is not None:
+            self.hub.unsubscribe(self.channel_name, self)
+            self.channel_name = None
+        self.close()
+
+
+class EventStreamServer(asyncore.dispatcher):
+    """Accepts subscriber connections on ``host``:``port``."""
+    
+    def __init__(self, hub, host, port, backlog=1024):
+        asyncore.dispatcher.__init__(self, map=hub.map)
+        self.hub = hub
+        self.create_socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.set_reuse_addr()
+        self.bind((host, port))
+        self.listen(backlog)
+    
+    def handle_accept(self):
+        pair = self.accept()
+        if pair is not None:
+            sock, addr = pair
+            EventStreamChannel(self.hub, sock, self.hub.map)
+
+
+class EventHub(object):
+    """Fans events published to a named channel out to its subscribers.
+      
+      The subscriber connections and the channel mapping are only ever
+      touched by the hub's loop thread: ``publish()`` hands events over to
+      it by pulling a ``waitress.trigger.trigger``, so it's safe to call from
+      any thread.
+    """
+    
+    def __init__(self, heartbeat_interval=HEARTBEAT_INTERVAL):
+        self.map = {}
+        self.heartbeat_interval = heartbeat_interval
+        self._channels = {}
+        self._trigger = None
+        self._thread = None
+        self.published = 0
+        self.delivered = 0
+    
+    @property
+    def is_running(self):
+        return self._thread is not None and self._thread.is_alive()
+    
+    @property
+    def subscriber_count(self):
+        return sum(len(item) for item in self._channels.values())
+    
+    def listen(self, host, port):
+        """Start accepting subscribers on ``host``:``port``."""
+        
+        return EventStreamServer(self, host, port)
+    
+    def start(self):
+        """Run the loop in a daemon thread."""
+        
+        self._trigger = trigger(self.map)
+        self._thread = threading.Thread(target=self.run, name='EventHub')
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def run(self):
+        """Serve the subscribers, sending each a comment every
+          ``heartbeat_interval`` seconds to keep idle connections open and
+          weed out dead ones.
+        """
+        
+        last_heartbeat = time.time()
+        while True:
+            asyncore.loop(timeout=self.heartbeat_interval, map=self.map,
+                    use_poll=True, count=1)
+            now = time.time()
+            if now - last_heartbeat >= self.heartbeat_interval:
+                last_heartbeat = now
+                # Pushing to a dead connection closes and unsubscribes it.
+                for subscribers in self._channels.values():
+                    for subscriber in list(subscribers):
+                        try:
+                            subscriber.push(':\n\n')
+                        except Exception:
+                            logging.warning('Event stream heartbeat error.',
+                                    exc_info=True)
+    
+    def subscribe(self, name, subscriber):
+        self._channels.setdefault(name, set()).add(subscriber)
+    
+    def unsubscribe(self, name, subscriber):
+        subscribers = self._channels.get(name)
+        if subscribers is not None:
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._channels[name]
+    
+    def publish(self, name, event, data, id=None):
+        """Publish an ``event`` with JSON serialisable ``data`` to the
+          subscribers of channel ``name``.  A no-op if the hub isn't running.
+        """
+        
+        if not self.is_running:
+            return
+        message = format_event(event, data, id=id)
+        self.published += 1
+        self._trigger.pull_trigger(lambda: self._send(name, message))
+    
+    def _send(self, name, message):
+        for subscriber in list(self._channels.get(name, ())):
+            subscriber.push(message)
+            self.delivered += 1
+    
+
@@ -11,33 +11,346 @@
   
       ok = mailer.send(to='a@b.com', from='a@b.com', subject='a', text_body='b')
   
+  Given a ``MailSpool``, the mailer just writes the message to disk, and a
+  ``MailDispatcher`` thread sends the spooled messages to Postmark in
+  batches, retrying with backoff::
+  
+      spool = MailSpool('/var/spool/awraamba')
+      mailer = PostmarkMailer(api_key, spool=spool)
+      dispatcher = MailDispatcher(spool, api_key)
+      dispatcher.start()
+  
 """
 
+import json
+import logging
+import os
+import random
+import threading
+import time
+import urllib2
+
+from os.path import getmtime, join as join_path
+
 import postmark
 
+# The Postmark api and the most messages it accepts per batch.
+POSTMARK_URL = 'https://api.postmarkapp.com/'
+MAX_BATCH_SIZE = 500
+
+def is_template_message(message):
+    return 'TemplateId' in message or 'TemplateAlias' in message
+
+
 class PostmarkMailer(object):
     """Provides `send()`, a wrapper around `postmark.PMMail.send()` that sets the
-      right api key and handles any relevant error.
+      right api key and handles any relevant error.  If there's a ``spool``,
+      messages are spooled for a ``MailDispatcher`` to send instead.
     """
     
-    def __init__(self, api_key, MailClass=postmark.PMMail):
+    def __init__(self, api_key, MailClass=postmark.PMMail, spool=None):
         self._api_key = api_key
         self._MailClass = MailClass
+        self._spool = spool
     
     def send(self, **kwargs):
         """Keyword arguments are ``sender``, ``to``, ``cc``, ``bcc``, ``subject``, 
           ``html_body``, ``text_body``, ``custom_headers`` and ``attachments``.
           See ``postmark.PMMail.send.__doc__`` for the formatting / details.
           
-          Returns ``True`` if the mail went off OK or the ``PMMailSendException``
-          raised if it doesn't.
+          Returns ``True`` if the mail went off (or was spooled) OK or the
+          ``PMMailSendException`` raised if it doesn't.
         """
         
         mailer = self._MailClass(api_key=self._api_key, **kwargs)
         try:
-            mailer.send()
+            if self._spool is not None:
+                mailer._check_values()
+                self._spool.enqueue(mailer.to_json_message())
+            else:
+                mailer.send()
         except postmark.PMMailSendException, err:
             return err
+        except postmark.PMMailMissingValueException, err:
+            return err
         return True
+
+
+
+class MailSpool(object):
+    """Stores JSON messages durably in ``directory``, maildir style: they're
+      written to ``tmp``, moved to ``new`` once complete and claimed by
+      moving them to ``cur``, so each is only sent by one dispatcher, even
+      across processes.  Messages that can't be sent are moved to ``failed``.
+    """
+    
+    def __init__(self, directory):
+        self.directory = directory
+        for name in ('tmp', 'new', 'cur', 'failed'):
+            path = join_path(directory, name)
+            if not os.path.isdir(path):
+                os.makedirs(path)
+        self._event = threading.Event()
+    
+    def _path(self, folder, name):
+        return join_path(self.directory, folder, name)
+    
+    def _write(self, folder, name, entry):
+        tmp_path = self._path('tmp', name)
+        sock = open(tmp_path, 'wb')
+        try:
+            sock.write(json.dumps(entry))
+            sock.flush()
+            os.fsync(sock.fileno())
+        finally:
+            sock.close()
+        os.rename(tmp_path, self._path(folder, name))
+    
+    def enqueue(self, message):
+        """Spool ``message``, a Postmark JSON message dict, returning its
+          name.
+        """
+        
+        now = time.time()
+        name = '%.6f-%d-%06d.json' % (now, os.getpid(), random.randint(0, 999999))
+        entry = {'message': message, 'queued': now, 'attempts': 0, 'not_before': 0}
+        self._write('new', name, entry)
+        self._event.set()
+        return name
+    
+    def depth(self):
+        """The number of messages waiting to be sent."""
+        
+        return len(os.listdir(join_path(self.directory, 'new')))
+    
+    def wait(self, timeout):
+        """Wait upto ``timeout`` seconds for a message to be enqueued."""
+        
+        self._event.wait(timeout)
+        self._event.clear()
+    
+    def claim(self, limit, now):
+        """Claim upto ``limit`` of the oldest messages that are due, returning
+          ``[(name, entry), ...]``.
+        """
+        
+        claimed = []
+        for name in sorted(os.listdir(join_path(self.directory, 'new'))):
+            if len(claimed) >= limit:
+                break
+            path = self._path('new', name)
+            try:
+                sock = open(path, 'rb')
+                try:
+                    entry = json.loads(sock.read())
+                finally:
+                    sock.close()
+            except (IOError, ValueError):
+                continue
+            if entry['not_before'] > now:
+                continue
+            try:
+                os.rename(path, self._path('cur', name))
+            except OSError:
+                # Claimed by another dispatcher.
+                continue
+            # The rename keeps the mtime, which ``recover()`` takes to be
+            # the claim time.
+            try:
+                os.utime(self._path('cur', name), None)
+            except OSError:
+                continue
+            claimed.append((name, entry))
+        return claimed
     
+    def complete(self, name):
+        os.remove(self._path('cur', name))
+    
+    def retry(self, name, entry, not_before):
+        entry['not_before'] = not_before
+        self._write('new', name, entry)
+        os.remove(self._path('cur', name))
+    
+    def fail(self, name, entry, error):
+        entry['error'] = error
+        self._write('failed', name, entry)
+        os.remove(self._path('cur', name))
+    
+    def recover(self, max_age):
+        """Return messages claimed more than ``max_age`` seconds ago, by a
+          dispatcher that must have died, to ``new``.
+        """
+        
+        count = 0
+        cutoff = time.time() - max_age
+        for name in os.listdir(join_path(self.directory, 'cur')):
+            path = self._path('cur', name)
+            try:
+                if getmtime(path) < cutoff:
+                    os.rename(path, self._path('new', name))
+                    count += 1
+            except OSError:
+                continue
+        return count
+
+
+
+class MailDispatcher(object):
+    """Sends the messages in a ``MailSpool`` to the Postmark batch api at
+      ``api_url``, upto ``batch_size`` at a time, from a background thread.
+      
+      If a batch can't be delivered, its messages are retried after
+      ``backoff`` seconds, doubling with each attempt upto ``max_backoff``.
+      Messages that still fail after ``max_attempts``, or that Postmark
+      rejects, are moved to the spool's ``failed`` folder.
+    """
+    
+    def __init__(self, spool, api_key, api_url=POSTMARK_URL, batch_size=100,
+            poll_interval=1, timeout=10, max_attempts=8, backoff=2,
+            max_backoff=3600, claim_timeout=300):
+        self.spool = spool
+        self.api_key = api_key
+        self.api_url = api_url
+        self.batch_size = min(batch_size, MAX_BATCH_SIZE)
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.claim_timeout = claim_timeout
+        self.batches = 0
+        self.sent = 0
+        self.retried = 0
+        self.failed = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+        self.last_error = None
+        self._stopped = threading.Event()
+        self._thread = None
+    
+    def start(self):
+        self._stopped.clear()
+        self._thread = threading.Thread(target=self.run)
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def stop(self):
+        self._stopped.set()
+        self.spool._event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    
+    def run(self):
+        self.spool.recover(self.claim_timeout)
+        while not self._stopped.is_set():
+            try:
+                count = self.dispatch()
+            except Exception:
+                logging.error('Mail dispatch failed.', exc_info=True)
+                count = 0
+            if not count:
+                self.spool.wait(self.poll_interval)
+    
+    def dispatch(self, now=None):
+        """Send a batch of the due messages, returning how many there were."""
+        
+        if now is None:
+            now = time.time()
+        claimed = self.spool.claim(self.batch_size, now)
+        if not claimed:
+            return 0
+        # Postmark takes messages with and without templates at different
+        # endpoints.
+        plain = [item for item in claimed if not is_template_message(item[1]['message'])]
+        templated = [item for item in claimed if is_template_message(item[1]['message'])]
+        if plain:
+            self.send_batch(plain, 'email/batch', now)
+        if templated:
+            self.send_batch(templated, 'email/batchWithTemplates', now)
+        return len(claimed)
+    
+    def post(self, endpoint, messages):
+        """Post ``messages`` to ``endpoint``, returning the per message
+          results.
+        """
+        
+        if endpoint == 'email/batchWithTemplates':
+            payload = {'Messages': messages}
+        else:
+            payload = messages
+        request = urllib2.Request(self.api_url + endpoint, json.dumps(payload), {
+            'Accept': 'application/json',
+            'Content-Type': 'application/json',
+            'X-Postmark-Server-Token': self.api_key
+        })
+        response = urllib2.urlopen(request, timeout=self.timeout)
+        try:
+            return json.loads(response.read())
+        finally:
+            response.close()
+    
+    def send_batch(self, items, endpoint, now):
+        self.batches += 1
+        try:
+            results = self.post(endpoint, [entry['message'] for name, entry in items])
+        except urllib2.HTTPError as err:
+            if err.code == 422:
+                # The batch itself was rejected, so retrying won't help.
+                for name, entry in items:
+                    self._fail(name, entry, 'HTTP 422: %s' % err.read())
+                return
+            self._retry_all(items, 'HTTP %s' % err.code, now)
+            return
+        except Exception as err:
+            self._retry_all(items, '%s: %s' % (err.__class__.__name__, err), now)
+            return
+        finished = time.time()
+        for (name, entry), result in zip(items, results):
+            if result.get('ErrorCode', 0) == 0:
+                self.spool.complete(name)
+                latency = finished - entry['queued']
+                self.sent += 1
+                self.total_latency += latency
+                self.max_latency = max(self.max_latency, latency)
+            else:
+                self._fail(name, entry, '%s: %s' % (result.get('ErrorCode'),
+                        result.get('Message')))
+        for name, entry in items[len(results):]:
+            self._retry(name, entry, 'Missing result', now)
+    
+    def stats(self):
+        sent = self.sent
+        return {
+            'depth': self.spool.depth(),
+            'batches': self.batches,
+            'sent': sent,
+            'retried': self.retried,
+            'failed': self.failed,
+            'mean_latency': self.total_latency / sent if sent else 0,
+            'max_latency': self.max_latency,
+            'last_error': self.last_error
+        }
+    
+    def _retry_all(self, items, error, now):
+        logging.warning('Mail batch failed: %s' % error)
+        for name, entry in items:
+            self._retry(name, entry, error, now)
+    
+    def _retry(self, name, entry, error, now):
+        self.last_error = error
+        entry['attempts'] += 1
+        if entry['attempts'] >= self.max_attempts:
+            self._fail(name, entry, error)
+            return
+        delay = min(self.max_backoff, self.backoff * 2 ** (entry['attempts'] - 1))
+        self.spool.retry(name, entry, now + delay)
+        self.retried += 1
+    
+    def _fail(self, name, entry, error):
+        logging.warning('Mail %s failed: %s' % (name, error))
+        self.last_error = error
+        self.spool.fail(name, entry, error)
+        self.failed += 1
+
 
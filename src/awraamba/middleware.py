@@ -0,0 +1,308 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Provides WSGI middleware, e.g.: ``GzipMiddleware``, which compresses
+  dynamic responses, and ``MicroCacheMiddleware``, which briefly caches
+  public responses to anonymous requests::
+      
+      app = GzipMiddleware(app, min_size=1024)
+      app = MicroCacheMiddleware(app, LocalBackend(max_items=1000), ttl=2)
+  
+"""
+
+import zlib
+
+# Content types worth compressing on the fly.  Static assets aren't listed
+# because they're served precompressed, by ``static.asset_view``.
+COMPRESSIBLE_TYPES = (
+    'application/javascript',
+    'application/json',
+    'application/xml',
+    'text/html',
+    'text/plain',
+)
+
+# ``wbits`` for the ``zlib`` formats of the supported content codings, in
+# order of preference.
+CODINGS = (('gzip', 16 + zlib.MAX_WBITS), ('deflate', zlib.MAX_WBITS))
+
+def get_accepted_codings(header):
+    """Return the content codings that an ``Accept-Encoding`` header accepts,
+      i.e.: those listed without ``q=0``.
+    """
+    
+    accepted = set()
+    for item in (header or '').split(','):
+        parts = item.strip().split(';')
+        coding = parts[0].strip().lower()
+        quality = 1.0
+        for param in parts[1:]:
+            name, _, value = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0
+        if coding and quality > 0:
+            accepted.add(coding)
+    return accepted
+
+def get_coding(environ):
+    """Return the preferred ``(coding, wbits)`` that the request accepts, or
+      ``(None, None)`` if it doesn't accept any.
+    """
+    
+    accepted = get_accepted_codings(environ.get('HTTP_ACCEPT_ENCODING'))
+    for item in CODINGS:
+        if item[0] in accepted:
+            return item
+    return None, None
+
+def iter_compressed(app_iter, wbits, level):
+    """Compress ``app_iter`` as it's iterated, flushing after each chunk, so
+      streamed responses stay streamed, then close it.
+    """
+    
+    compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+    try:
+        for data in app_iter:
+            if data:
+                data = compressor.compress(data) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                if data:
+                    yield data
+        yield compressor.flush()
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+class GzipMiddleware(object):
+    """Compresses responses with ``gzip`` or ``deflate``, if the client
+      accepts them and the response is a ``200`` with one of
+      ``content_types`` that's at least ``min_size`` bytes (if its size is
+      known) and isn't encoded already.
+      
+      Compressed responses lose their ``Content-Length`` and their ``ETag``
+      is made weak, as the compressed bytes differ from the representation
+      it identifies.  Responses that could be compressed, ``HEAD`` responses
+      for them and ``304``s all have ``Vary: Accept-Encoding``.
+    """
+    
+    def __init__(self, app, min_size=1024, level=6, content_types=None):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        if content_types is None:
+            content_types = COMPRESSIBLE_TYPES
+        self.content_types = frozenset(content_types)
+    
+    def __call__(self, environ, start_response):
+        coding, wbits = get_coding(environ)
+        is_head = environ.get('REQUEST_METHOD') == 'HEAD'
+        state = {}
+        def _start_response(status, headers, exc_info=None):
+            if self.should_compress(status, headers):
+                # Responses that could be compressed vary by whether they
+                # are, even when this one isn't.  ``HEAD`` responses get the
+                # headers a ``GET`` would, without a body to compress.
+                headers = self.update_headers(headers, coding)
+                state['compress'] = coding is not None and not is_head
+            elif self.should_vary(status, headers):
+                headers = self.update_headers(headers, None)
+            return start_response(status, headers, exc_info)
+        
+        app_iter = self.app(environ, _start_response)
+        if not state.get('compress'):
+            return app_iter
+        return iter_compressed(app_iter, wbits, self.level)
+    
+    def should_compress(self, status, headers):
+        if not status.startswith('200'):
+            return False
+        content_type = None
+        for name, value in headers:
+            name = name.lower()
+            if name in ('content-encoding', 'content-range'):
+                return False
+            if name == 'content-type':
+                content_type = value.split(';')[0].strip().lower()
+            elif name == 'content-length':
+                try:
+                    if int(value) < self.min_size:
+                        return False
+                except ValueError:
+                    return False
+            elif name == 'cache-control' and 'no-transform' in value.lower():
+                return False
+        return content_type in self.content_types
+    
+    def should_vary(self, status, headers):
+        """Does a ``304`` vary by ``Accept-Encoding``?  It does unless it has
+          a content type that isn't compressed, as the response it
+          revalidates may have been.
+        """
+        
+        if not status.startswith('304'):
+            return False
+        for name, value in headers:
+            if name.lower() == 'content-type':
+                content_type = value.split(';')[0].strip().lower()
+                return content_type in self.content_types
+        return True
+    
+    def update_headers(self, headers, coding):
+        """Add ``Accept-Encoding`` to the ``Vary`` header and, if the
+          response will be encoded with ``coding``, update its headers to
+          match.
+        """
+        
+        updated = []
+        vary = None
+        for name, value in headers:
+            lower = name.lower()
+            if coding is not None:
+                if lower == 'content-length':
+                    continue
+                if lower == 'etag' and not value.startswith('W/'):
+                    value = 'W/' + value
+            if lower == 'vary':
+                vary = value
+                continue
+            updated.append((name, value))
+        if vary is None:
+            vary = 'Accept-Encoding'
+        elif 'accept-encoding' not in vary.lower():
+            vary = '%s, Accept-Encoding' % vary
+        updated.append(('Vary', vary))
+        if coding is not None:
+            updated.append(('Content-Encoding', coding))
+        return updated
+
+# Requests with these headers are never served from, or stored in, the micro
+# cache: they either identify the user or ask for a conditional or partial
+# response.
+UNCACHEABLE_REQUEST_HEADERS = (
+    'HTTP_AUTHORIZATION',
+    'HTTP_COOKIE',
+    'HTTP_IF_MODIFIED_SINCE',
+    'HTTP_IF_NONE_MATCH',
+    'HTTP_RANGE',
+)
+
+class MicroCacheMiddleware(object):
+    """Caches ``200`` responses to anonymous ``GET`` requests for ``ttl``
+      seconds in ``backend``, keyed by url and by the content coding that
+      ``GzipMiddleware`` (which must be wrapped by this) would choose.
+      
+      Only responses explicitly marked ``Cache-Control: public`` without a
+      ``Set-Cookie`` header, that vary by nothing but ``Accept-Encoding``
+      and ``Cookie`` and whose bodies are no more than ``max_size`` bytes,
+      are cached.  So a burst of identical requests costs one call to the
+      app, at the price of serving a response upto ``ttl`` seconds stale.
+      
+      Responses already encoded with another coding than the key's, e.g.:
+      precompressed ``br`` assets, aren't cached, and nor are files served
+      with the server's ``wsgi.file_wrapper``, which would lose sendfile.
+    """
+    
+    def __init__(self, app, backend, ttl=2, max_size=65536):
+        self.app = app
+        self.backend = backend
+        self.ttl = ttl
+        self.max_size = max_size
+    
+    def __call__(self, environ, start_response):
+        if environ.get('REQUEST_METHOD') != 'GET':
+            return self.app(environ, start_response)
+        for name in UNCACHEABLE_REQUEST_HEADERS:
+            if environ.get(name):
+                return self.app(environ, start_response)
+        coding = get_coding(environ)[0]
+        key = self.make_key(environ, coding)
+        entry = self.backend.get(key)
+        if entry is not None:
+            status, headers, body = entry
+            start_response(status, list(headers))
+            return [body]
+        state = {}
+        def _start_response(status, headers, exc_info=None):
+            if exc_info is None and self.should_cache(status, headers, coding):
+                state['response'] = (status, tuple(headers))
+            return start_response(status, headers, exc_info)
+        
+        app_iter = self.app(environ, _start_response)
+        if 'response' not in state:
+            return app_iter
+        # Don't buffer files that the server would send with sendfile.
+        wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(wrapper, type) and isinstance(app_iter, wrapper):
+            return app_iter
+        return self.iter_and_store(app_iter, key, state['response'])
+    
+    def make_key(self, environ, coding):
+        return '%s|%s%s?%s|%s' % (
+            environ.get('HTTP_HOST', ''),
+            environ.get('SCRIPT_NAME', ''),
+            environ.get('PATH_INFO', ''),
+            environ.get('QUERY_STRING', ''),
+            coding
+        )
+    
+    def should_cache(self, status, headers, coding):
+        """Should a response be cached under the key for ``coding``?"""
+        
+        if not status.startswith('200'):
+            return False
+        is_public = False
+        for name, value in headers:
+            name = name.lower()
+            if name == 'set-cookie':
+                return False
+            if name == 'content-encoding':
+                # Not chosen by ``GzipMiddleware``, so other requests with
+                # the same key may not accept it.
+                if value.strip().lower() != coding:
+                    return False
+            elif name == 'content-length':
+                try:
+                    if int(value) > self.max_size:
+                        return False
+                except ValueError:
+                    return False
+            elif name == 'cache-control':
+                directives = [item.strip().split('=')[0].lower()
+                              for item in value.split(',')]
+                if 'private' in directives or 'no-store' in directives:
+                    return False
+                is_public = 'public' in directives
+            elif name == 'vary':
+                for item in value.split(','):
+                    if item.strip().lower() not in ('accept-encoding', 'cookie'):
+                        return False
+        return is_public
+    
+    def iter_and_store(self, app_iter, key, response):
+        """Yield the chunks of ``app_iter`` and, if it's iterated to the end
+          without exceeding ``max_size``, store the response under ``key``.
+        """
+        
+        chunks = []
+        size = 0
+        try:
+            for data in app_iter:
+                if chunks is not None:
+                    size += len(data)
+                    if size > self.max_size:
+                        chunks = None
+                    else:
+                        chunks.append(data)
+                yield data
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+        if chunks is not None:
+            status, headers = response
+            self.backend.set(key, (status, headers, ''.join(chunks)), ttl=self.ttl)
+    
+
+
@@ -14,18 +14,20 @@ __all__ = [
     'Session',
     'SQLModel',
     'Theme',
+    'Tombstone',
     'User',
 ]
 
 import logging
 
-from sqlalchemy import desc, event
-from sqlalchemy import Column, ForeignKey, Table
+from sqlalchemy import and_, desc, event, func, literal, select
+from sqlalchemy import Column, ForeignKey, Index, Table
 from sqlalchemy import BigInteger, Boolean, Integer, Numeric, Unicode, UnicodeText
 from sqlalchemy.orm import backref, relationship
 
 from basemodel import Session, SQLModel
 from basemodel import AuthMixin, BaseMixin, SearchMixin, SlugMixin
+from basemodel import decode_cursor, encode_cursor, get_serializer, keyset_clause
 
 t_chars = Table(
     't_chars',
@@ -142,6 +144,8 @@ class Reaction(SQLModel, BaseMixin, SearchMixin):
         'v'
     ]
     
+    __public_aliases__ = {'reaction_id': 'id'}
+    
     @property
     def reaction_id(self):
         return self.id
@@ -155,8 +159,133 @@ class Reaction(SQLModel, BaseMixin, SearchMixin):
     user_username = Column(Unicode, ForeignKey('users.username'))
     
     parent_id = Column(Integer, ForeignKey('reactions.id'))
-    children = relationship("Reaction", lazy='eager')
+    children = relationship("Reaction")
+    
+    @classmethod
+    def get_threads(cls, theme_slug, limit, cursor=None, max_depth=3,
+            max_replies=10):
+        """Return ``(threads, next_cursor)`` for a page of ``limit`` top level
+          reactions to a theme, newest first, with their replies nested in
+          ``children`` lists, oldest first.
+          
+          The page's top level reactions are looked up first, then all of
+          their replies are fetched in one recursive CTE query, following
+          replies at most ``max_depth`` levels deep and taking the first
+          ``max_replies`` replies to each reaction, so the cost is bounded by
+          the size of the page rather than the theme.  Replies are assumed to
+          share their parent's ``theme_slug``.
+        """
+        
+        table = cls.__table__
+        columns = [table.c[k] for k in table.c.keys()]
+        keys = (table.c.c, table.c.id)
+        
+        # The page of top level reactions, plus one to see if there's more.
+        top = select([table.c.c, table.c.id]).where(and_(
+            table.c.theme_slug == theme_slug,
+            table.c.parent_id == None
+        ))
+        if cursor is not None:
+            values = decode_cursor(cursor, keys)
+            top = top.where(keyset_clause(keys, values, descending=True))
+        top = top.order_by(table.c.c.desc(), table.c.id.desc())
+        top_rows = Session.execute(top.limit(limit + 1)).fetchall()
+        next_cursor = None
+        if len(top_rows) > limit:
+            top_rows = top_rows[:limit]
+            next_cursor = encode_cursor([top_rows[-1].c, top_rows[-1].id])
+        if not top_rows:
+            return [], next_cursor
+        
+        # Walk down from the top level reactions through the first replies
+        # to each reaction.
+        anchor = select(columns + [literal(0).label('depth')]).where(
+            table.c.id.in_([row.id for row in top_rows])
+        )
+        threads = anchor.cte('threads', recursive=True)
+        reply = table.alias('reply')
+        sibling = table.alias('sibling')
+        first_replies = select([sibling.c.id]).where(
+            sibling.c.parent_id == reply.c.parent_id
+        ).order_by(sibling.c.c, sibling.c.id).limit(max_replies)
+        threads = threads.union_all(
+            select([reply.c[k] for k in table.c.keys()] + [
+                (threads.c.depth + 1).label('depth')
+            ]).where(and_(
+                reply.c.parent_id == threads.c.id,
+                threads.c.depth < max_depth,
+                reply.c.id.in_(first_replies)
+            ))
+        )
+        query = select([threads, threads.c.id.label('reaction_id')]).order_by(
+            threads.c.depth,
+            threads.c.c,
+            threads.c.id
+        )
+        rows = Session.execute(query).fetchall()
+        
+        # Assemble the tree in a single pass: as rows are ordered by depth,
+        # parents are always seen before their children.
+        roots = []
+        nodes = {}
+        serializer = get_serializer(cls)
+        for row in rows:
+            node = serializer(row)
+            node['children'] = []
+            nodes[row.id] = node
+            if row.depth == 0:
+                roots.append(node)
+            else:
+                nodes[row.parent_id]['children'].append(node)
+        roots.reverse()
+        return roots, next_cursor
+        
+    
+
+class Tombstone(SQLModel, BaseMixin):
+    """Records the deletion of a row, so clients syncing changes since a given
+      time can be told to remove it.  ``target`` is the deleted row's table
+      name and ``target_id`` its id.  ``theme_slug`` and ``user_username``
+      are copied from deleted reactions to allow filtering.
+    """
+    
+    target = Column(Unicode, nullable=False)
+    target_id = Column(Integer, nullable=False)
+    
+    theme_slug = Column(Unicode)
+    user_username = Column(Unicode)
+    
+
+def add_reaction_tombstone(mapper, connection, target):
+    """Insert a ``Tombstone`` when a reaction is deleted."""
     
+    connection.execute(Tombstone.__table__.insert().values(
+        target=unicode(Reaction.__tablename__),
+        target_id=target.id,
+        theme_slug=target.theme_slug,
+        user_username=target.user_username
+    ))
+
+event.listen(Reaction, 'after_delete', add_reaction_tombstone)
+
+# Composite indexes backing the ``(c, id)`` keyset pagination of reactions
+# by theme, by user and across the whole table.
+Index('ix_reactions_theme_slug_c_id', Reaction.theme_slug, Reaction.c, Reaction.id)
+Index('ix_reactions_user_username_c_id', Reaction.user_username, Reaction.c, Reaction.id)
+Index('ix_reactions_c_id', Reaction.c, Reaction.id)
+
+# Backs fetching the reactions to a window of a theme's video.
+Index('ix_reactions_theme_slug_timecode_id', Reaction.theme_slug,
+      Reaction.timecode, Reaction.id)
+
+# Backs finding the first replies to each reaction in a thread.
+Index('ix_reactions_parent_id_c_id', Reaction.parent_id, Reaction.c,
+      Reaction.id)
+
+# Backs looking up the reactions modified since a watermark and the
+# tombstones of those deleted since then.
+Index('ix_reactions_m_id', Reaction.m, Reaction.id)
+Index('ix_tombstones_target_c', Tombstone.target, Tombstone.c)
 
 # bind searchable class create events to ``target._setup_search()``.
 for model_class in (Character, Location, Reaction, Theme, User):
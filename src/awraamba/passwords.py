@@ -0,0 +1,210 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Provides ``password_hasher``, which hashes and verifies passwords in a
+  dedicated pool of worker processes, so that a burst of signups or logins
+  doesn't stall the request threads, e.g.::
+      
+      password_hasher.configure(processes=2, rounds=90000)
+      hash = password_hasher.hash(u'secret')
+      password_hasher.verify(u'secret', hash)
+      => True
+  
+  At most ``max_waiting`` jobs can wait for a free process: more raise
+  ``PasswordHasherBusy`` straight away, so a spike only degrades the routes
+  that check passwords.  A job counts until it's done, even if its caller
+  timed out waiting for it, so the pool's queue is bounded too.  Hashes
+  with other than the configured ``rounds`` are rehashed when they're
+  verified, by ``verify_and_update()``, so rounds can be tuned without a
+  migration.
+  
+  Until it's configured with ``processes``, passwords are hashed in the
+  calling thread, e.g.: in scripts.  Otherwise, ``start()`` the pool before
+  the process starts any threads.
+"""
+
+import threading
+import time
+
+from multiprocessing import Pool, TimeoutError
+
+from passlib.context import CryptContext
+
+# Passwords are hashed with the first scheme.  Hashes in the others (which
+# ``passlib.apps.custom_app_context`` may have made) are verified and then
+# rehashed.
+SCHEMES = ('sha512_crypt', 'sha256_crypt')
+
+_contexts = {}
+
+def get_context(rounds):
+    """Return a ``CryptContext`` that hashes with ``rounds`` and deems
+      hashes with any other number of rounds in need of an update.
+    """
+    
+    context = _contexts.get(rounds)
+    if context is None:
+        context = _contexts[rounds] = CryptContext(
+            schemes=SCHEMES,
+            default=SCHEMES[0],
+            deprecated=SCHEMES[1:],
+            sha512_crypt__default_rounds=rounds,
+            sha512_crypt__min_rounds=rounds,
+            sha512_crypt__max_rounds=rounds
+        )
+    return context
+
+def run_hash(raw_password, rounds):
+    """Hash ``raw_password``, in a worker process.  Returns ``(started,
+      hash)``, so the caller can tell how long the job was queued.
+    """
+    
+    started = time.time()
+    return started, get_context(rounds).encrypt(raw_password)
+
+def run_verify_and_update(raw_password, hash, rounds):
+    """Returns ``(started, ok, new_hash)``, where ``new_hash`` is ``None``
+      unless ``hash`` needs updating.
+    """
+    
+    started = time.time()
+    ok, new_hash = get_context(rounds).verify_and_update(raw_password, hash)
+    return started, ok, new_hash
+
+
+def run_job(f, args):
+    """Return ``(error, f(*args))``, in a worker process, so that the pool
+      calls back when the job is done, even if it fails.
+    """
+    
+    try:
+        return None, f(*args)
+    except Exception as err:
+        return err, None
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when there are too many calls waiting for a free process, or
+      a call times out waiting for one.
+    """
+
+
+
+class PasswordHasher(object):
+    """Hashes and verifies passwords in a pool of ``processes``, created by
+      ``start()`` or else on first use, with upto ``max_waiting`` jobs
+      waiting for one.  Callers wait upto ``timeout`` seconds for their job.
+      Counts the calls and the time they spent queued and computing.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pool = None
+        self.configure()
+    
+    def configure(self, processes=0, max_waiting=16, timeout=30, rounds=90000):
+        self.close()
+        self.processes = processes
+        self.max_waiting = max_waiting
+        self.timeout = timeout
+        self.rounds = rounds
+        self._slots = threading.BoundedSemaphore(processes + max_waiting)
+        self.calls = 0
+        self.rehashed = 0
+        self.rejected = 0
+        self.timeouts = 0
+        self.queue_time = 0.0
+        self.max_queue_time = 0.0
+        self.compute_time = 0.0
+    
+    def hash(self, raw_password):
+        return self._call(run_hash, raw_password, self.rounds)[0]
+    
+    def verify(self, raw_password, hash):
+        return self.verify_and_update(raw_password, hash)[0]
+    
+    def verify_and_update(self, raw_password, hash):
+        """Return ``(ok, new_hash)``.  If ``ok``, but ``hash`` was made with
+          an old scheme or number of rounds, ``new_hash`` is ``raw_password``
+          rehashed to replace it with.  Otherwise it's ``None``.
+        """
+        
+        ok, new_hash = self._call(run_verify_and_update, raw_password, hash,
+                self.rounds)
+        if new_hash is not None:
+            with self._lock:
+                self.rehashed += 1
+        return ok, new_hash
+    
+    def start(self):
+        """Fork the worker processes, if configured with any."""
+        
+        if self.processes:
+            self._get_pool()
+    
+    def close(self):
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    def stats(self):
+        calls = self.calls
+        return {
+            'processes': self.processes,
+            'calls': calls,
+            'rehashed': self.rehashed,
+            'rejected': self.rejected,
+            'timeouts': self.timeouts,
+            'mean_queue_time': self.queue_time / calls if calls else 0,
+            'max_queue_time': self.max_queue_time,
+            'mean_compute_time': self.compute_time / calls if calls else 0
+        }
+    
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = Pool(self.processes)
+            return self._pool
+    
+    def _call(self, f, *args):
+        submitted = time.time()
+        if not self.processes:
+            result = f(*args)
+        else:
+            slots = self._slots
+            if not slots.acquire(False):
+                with self._lock:
+                    self.rejected += 1
+                raise PasswordHasherBusy('Too many password checks waiting.')
+            # The slot is released when the job is done, not when the caller
+            # stops waiting for it.
+            try:
+                async_result = self._get_pool().apply_async(run_job, (f, args),
+                        callback=lambda result: slots.release())
+            except Exception:
+                slots.release()
+                raise
+            try:
+                error, result = async_result.get(self.timeout)
+            except TimeoutError:
+                with self._lock:
+                    self.timeouts += 1
+                raise PasswordHasherBusy('Timed out checking a password.')
+            if error is not None:
+                raise error
+        started = result[0]
+        queue_time = max(0, started - submitted)
+        with self._lock:
+            self.calls += 1
+            self.queue_time += queue_time
+            self.max_queue_time = max(self.max_queue_time, queue_time)
+            self.compute_time += time.time() - started
+        return result[1:]
+
+
+
+password_hasher = PasswordHasher()
+
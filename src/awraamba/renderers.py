@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Provides a ``json_stream`` renderer that writes an iterable of items to
+  the response as a JSON array, element by element, e.g.::
+  
+      config.add_renderer('json_stream', JSONStreamRenderer)
+  
+  Views can then use it in place of the ``json`` renderer, or switch to it
+  for a particular request with::
+  
+      request.override_renderer = 'json_stream'
+  
+"""
+
+import json
+
+def iter_json_array(items, chunk_size=65536):
+    """Yield ``items`` encoded as a JSON array in chunks of roughly
+      ``chunk_size`` bytes.  Only the current chunk is ever held in memory.
+    """
+    
+    buf = ['[']
+    size = 1
+    separator = ''
+    for item in items:
+        s = separator + json.dumps(item)
+        separator = ','
+        buf.append(s)
+        size += len(s)
+        if size >= chunk_size:
+            yield ''.join(buf)
+            buf = []
+            size = 0
+    buf.append(']')
+    yield ''.join(buf)
+
+
+class JSONStreamRenderer(object):
+    """Renders an iterable of JSON serialisable items by setting the response
+      ``app_iter``, so the items are only produced (and their query only
+      run) as the WSGI server writes the response out.
+    """
+    
+    def __init__(self, info):
+        self.info = info
+    
+    def __call__(self, value, system):
+        request = system.get('request')
+        response = request.response
+        response.content_type = 'application/json'
+        response.content_length = None
+        response.app_iter = iter_json_array(value)
+        return None
+    
+
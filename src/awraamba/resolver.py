@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Provides ``domain_resolver``, which checks that email domains resolve,
+  caching the answers, e.g.::
+      
+      domain_resolver.configure(timeout=2, ttl=3600, negative_ttl=300)
+      domain_resolver.resolves('example.com')
+      => True
+  
+  Lookups have a hard ``timeout`` and fail open: if the DNS servers can't be
+  reached in time (or pyDNS isn't installed) the domain is deemed to
+  resolve, so a slow or broken resolver never blocks signups.
+"""
+
+import logging
+import threading
+
+try:
+    import DNS
+except ImportError:
+    DNS = None
+
+from .caching import LocalBackend
+
+class _Lookup(object):
+    """An in-flight lookup, run in its own thread so callers can stop
+      waiting for it.
+    """
+    
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+
+
+
+class DomainResolver(object):
+    """Looks up whether domains have both ``A`` and ``MX`` records (as
+      ``formencode.validators.Email(resolve_domain=True)`` does), using the
+      DNS ``servers`` or, by default, those in ``/etc/resolv.conf``.
+      
+      Answers are cached for ``ttl`` seconds if the domain resolves and
+      ``negative_ttl`` seconds if it doesn't.  Failed lookups are deemed to
+      resolve and are cached for ``negative_ttl`` seconds too.
+      Concurrent lookups of the same domain share one query.
+    """
+    
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.configure()
+    
+    def configure(self, servers=None, timeout=2, ttl=3600, negative_ttl=300,
+            max_items=10000):
+        self.servers = servers
+        self.timeout = timeout
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache = LocalBackend(max_items=max_items)
+        self.lookups = 0
+        self.failures = 0
+        self.timeouts = 0
+        self._lookups = {}
+    
+    def resolves(self, domain):
+        """Does ``domain`` resolve?  ``True`` if it can't be looked up."""
+        
+        domain = domain.lower()
+        result = self.cache.get(domain)
+        if result is not None:
+            return result
+        with self._lock:
+            lookup = self._lookups.get(domain)
+            if lookup is None:
+                lookup = self._lookups[domain] = _Lookup()
+                thread = threading.Thread(target=self._lookup,
+                        args=(domain, lookup))
+                thread.daemon = True
+                thread.start()
+        if not lookup.event.wait(self.timeout):
+            with self._lock:
+                self.timeouts += 1
+            logging.warning('Timed out resolving %s.' % domain)
+            return True
+        return lookup.result
+    
+    def stats(self):
+        stats = self.cache.stats()
+        stats.update({
+            'lookups': self.lookups,
+            'failures': self.failures,
+            'timeouts': self.timeouts
+        })
+        return stats
+    
+    def _query(self, domain, qtype):
+        kwargs = {'qtype': qtype, 'timeout': self.timeout}
+        if self.servers:
+            kwargs['server'] = self.servers
+        return DNS.DnsRequest(domain, **kwargs).req().answers
+    
+    def _lookup(self, domain, lookup):
+        """Look ``domain`` up and cache the result, in a lookup thread."""
+        
+        result, ttl = True, self.negative_ttl
+        try:
+            if DNS is None:
+                raise ImportError('pyDNS is not installed.')
+            if not self.servers and not DNS.defaults['server']:
+                DNS.DiscoverNameServers()
+            answers = self._query(domain, 'a')
+            if answers:
+                answers = self._query(domain, 'mx')
+        except Exception as err:
+            # Fail open, but not for long.
+            logging.warning('Failed to resolve %s: %s' % (domain, err))
+            with self._lock:
+                self.failures += 1
+        else:
+            result = bool(answers)
+            if result:
+                ttl = self.ttl
+        self.cache.set(domain, result, ttl=ttl)
+        with self._lock:
+            self.lookups += 1
+            self._lookups.pop(domain, None)
+        lookup.result = result
+        lookup.event.set()
+
+
+
+domain_resolver = DomainResolver()
+
@@ -5,26 +5,19 @@
 
 import cgi
 import dateutil.parser
-import hashlib
 import logging
 import re
 import urllib
-import urllib2
 import urlparse
 
-try:
-    import Image
-except ImportError:
-    from PIL import Image
-
-from cStringIO import StringIO
-from os.path import join as join_path, exists as path_exists
-
 import formencode
 from formencode import validators
-from passlib.apps import custom_app_context as pwd_context
+from sqlalchemy import or_
 
-from .model import User
+from .model import Session, User
+from .passwords import password_hasher
+from .resolver import domain_resolver
+from .thumbnails import ThumbnailError
 
 id_pattern = r'\d+'
 valid_id = re.compile(r'^%s$' % id_pattern, re.U)
@@ -41,6 +34,15 @@ valid_password = re.compile(r'^%s$' % password_pattern, re.U)
 confirmation_hash_pattern = r'[a-z0-9]{32}'
 valid_confirmation_hash = re.compile(r'^%s$' % confirmation_hash_pattern, re.U)
 
+md5_digest_pattern = r'[a-f0-9]{32}'
+valid_md5_digest = re.compile(r'^%s$' % md5_digest_pattern, re.U)
+
+cursor_pattern = r'[\w-]{1,512}'
+valid_cursor = re.compile(r'^%s$' % cursor_pattern, re.U)
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
 def _(msg):
     """Fake _() so babel extracts the message strings."""
     
@@ -132,8 +134,8 @@ class RawPassword(validators.UnicodeString):
 
 class EncryptedPassword(validators.UnicodeString):
     """Validates that the user input matches ``valid_password`` and converts it
-      to an encrypted hash using passlib_.  Note that all passwords are forced 
-      to lowercase.
+      to an encrypted hash using passlib_, in the ``password_hasher``'s worker
+      processes.  Note that all passwords are forced to lowercase.
       
       _passlib: http://packages.python.org/passlib
     """
@@ -150,7 +152,7 @@ class EncryptedPassword(validators.UnicodeString):
             if not valid_password.match(value):
                 return 'invalid'
             v = value.strip().lower()
-            h = pwd_context.encrypt(v, scheme="sha512_crypt", rounds=90000)
+            h = password_hasher.hash(v)
             return unicode(h)
             
         
@@ -222,21 +224,42 @@ class UniqueUsername(Username):
     
     
 
-class UniqueEmail(UnicodeEmail):
-    """Courtesy check to see that a username doesn't exist,
-      prior to uniqueness being enforced by constraint.
+class LowercaseEmail(UnicodeEmail):
+    """A lowercase email address.  If ``check_domain`` is true, its domain
+      must resolve, as checked by the caching ``domain_resolver``.
     """
     
-    messages = {
-        'taken': _(u'Email address has already been registered.')
-    }
+    check_domain = False
     
     def _to_python(self, value, state):
-        value = super(UniqueEmail, self)._to_python(value, state)
+        value = super(LowercaseEmail, self)._to_python(value, state)
         return value.strip().lower()
         
     
     
+    def validate_python(self, value, state):
+        super(LowercaseEmail, self).validate_python(value, state)
+        if self.check_domain:
+            domain = value.split('@', 1)[1]
+            if not domain_resolver.resolves(domain):
+                raise validators.Invalid(
+                    self.message('domainDoesNotExist', state, domain=domain),
+                    value,
+                    state
+                )
+        
+    
+    
+
+class UniqueEmail(LowercaseEmail):
+    """Courtesy check to see that an email address isn't registered,
+      prior to uniqueness being enforced by constraint.
+    """
+    
+    messages = {
+        'taken': _(u'Email address has already been registered.')
+    }
+    
     def validate_python(self, value, state):
         super(UniqueEmail, self).validate_python(value, state)
         if User.query.filter_by(email=value).first():
@@ -302,8 +325,45 @@ class ConfirmationHash(validators.UnicodeString):
         
     
 
+class Cursor(validators.UnicodeString):
+    """An opaque pagination cursor, as returned in the ``next`` value of a
+      page of results.
+    """
+    
+    messages = {
+        'invalid': _(u'Invalid cursor.')
+    }
+    
+    def _to_python(self, value, state):
+        value = super(Cursor, self)._to_python(value, state)
+        return value.strip()
+        
+    
+    
+    def validate_python(self, value, state):
+        super(Cursor, self).validate_python(value, state)
+        if value and not valid_cursor.match(value):
+            raise validators.Invalid(
+                self.message("invalid", state),
+                value,
+                state
+            )
+        
+    
+
+class PageSize(validators.Int):
+    """The number of items in a page of results.  Defaults to
+      ``DEFAULT_PAGE_SIZE``, upto a maximum of ``MAX_PAGE_SIZE``.
+    """
+    
+    min = 1
+    max = MAX_PAGE_SIZE
+    if_empty = DEFAULT_PAGE_SIZE
+    if_missing = DEFAULT_PAGE_SIZE
+    
+
 class ThumbnailImage(validators.UnicodeString):
-    """Takes an image upload or an image url and turns it into a digest
+    """Takes an image upload or an image url and turns it into the digest
       of a png encoded thumbnail.
     """
     
@@ -312,54 +372,24 @@ class ThumbnailImage(validators.UnicodeString):
         'invalid_digest': _(u'Not a valid digest.')
     }
     
-    SIZE = (100, 100)
-    
     def _to_python(self, value, state):
-        """Takes a file or a url and converts to an ``Image`` instance in
-          PNG format that has been thumbnailed.
+        """Takes a file or a url and submits it to ``state.thumbnailer``,
+          returning the thumbnail's digest as the python value from this
+          conversion method.
           
-          The ``Image`` is then saved into `/static/thumbnails/` using an
-          md5 hash as the filename, with the hash returned as the python
-          value from this conversion method.
+          The thumbnail is made in the background and saved into
+          ``thumbnails_dir`` as ``$digest.png``: until then it's pending.
         """
         
-        img = None
-        if isinstance(value, cgi.FieldStorage):
-            img = Image.open(value.file)
-        elif isinstance(value, basestring):
-            try:
-                response = urllib2.urlopen(value)
-            except urllib2.URLError, err:
-                logging.warning(err)
-            else:
-                if response.getcode() == 200:
-                    img = Image.open(StringIO(response.read()))
-        if img:
-            try:
-                # thumbnail it
-                img = img.convert('RGBA')
-                img.thumbnail(self.SIZE, Image.ANTIALIAS)
-                # save out to a buffer
-                buf = StringIO()
-                img.save(buf, 'PNG')
-            except Exception, err: # XXX <-- nasty
-                logging.warning(err, exc_info=True)
-                return err
-            # get an md5 hash
-            digest = hashlib.md5(buf.getvalue()).hexdigest()
-            # if ``settings['thumbnails_dir']/$digest`` doesn't already exist then save it
-            settings = state.settings
-            target_dir = settings.get('thumbnails_directory')
-            thumbnail_path = join_path(target_dir, '%s.png' % digest)
-            if not path_exists(thumbnail_path):
-                try:
-                    sock = open(thumbnail_path, 'wb')
-                    img.save(sock)
-                    sock.close()
-                except IOError, err:
-                    logging.warning(err, exc_info=True)
-                    return err
-            return digest
+        thumbnailer = state.thumbnailer
+        try:
+            if isinstance(value, cgi.FieldStorage):
+                return thumbnailer.submit_file(value.file)
+            if isinstance(value, basestring) and value:
+                return thumbnailer.submit_url(value)
+        except (ThumbnailError, IOError), err:
+            logging.warning(err)
+            return err
         return None
         
     
@@ -438,7 +468,7 @@ class PasswordsMatch(validators.FieldsMatch):
                     ok = True
                 else:
                     try:
-                        ok = pwd_context.verify(raw_password, encrypted_password)
+                        ok = password_hasher.verify(raw_password, encrypted_password)
                     except ValueError:
                         pass
                 if not ok:
@@ -459,14 +489,119 @@ class PasswordsMatch(validators.FieldsMatch):
     
 
 
+class UniqueUser(validators.FormValidator):
+    """Courtesy check that neither the username nor the email address have
+      been taken, with a single query, prior to uniqueness being enforced by
+      constraint.
+      
+      It also runs when other fields are invalid, so a taken username is
+      reported along with their errors, rather than after they're fixed.
+    """
+    
+    validate_partial_form = True
+    
+    messages = {
+        'username_taken': _(u'Username has already been taken.'),
+        'email_taken': _(u'Email address has already been registered.')
+    }
+    
+    def __init__(self, username_field='username', email_field='email', *args,
+            **kwargs):
+        super(UniqueUser, self).__init__(*args, **kwargs)
+        self.username_field = username_field
+        self.email_field = email_field
+    
+    def validate_partial(self, field_dict, state):
+        """Check the raw ``field_dict`` of a form with invalid fields,
+          normalising the values as ``Username`` and ``LowercaseEmail`` do.
+        """
+        
+        values = {}
+        for name in (self.username_field, self.email_field):
+            value = field_dict.get(name)
+            if isinstance(value, str):
+                value = value.decode('utf-8', 'replace')
+            if isinstance(value, unicode):
+                values[name] = value.strip().lower()
+        self.validate_python(values, state)
+    
+    def validate_python(self, field_dict, state):
+        username = field_dict.get(self.username_field)
+        email = field_dict.get(self.email_field)
+        clauses = []
+        if username:
+            clauses.append(User.username == username)
+        if email:
+            clauses.append(User.email == email)
+        if not clauses:
+            return
+        query = Session.query(User.username, User.email).filter(or_(*clauses))
+        errors = {}
+        for row in query.limit(2):
+            if username and row.username == username:
+                errors[self.username_field] = self.message('username_taken',
+                        state)
+            if email and row.email == email:
+                errors[self.email_field] = self.message('email_taken', state)
+        if errors:
+            error_list = errors.items()
+            error_list.sort()
+            lines = ['%s: %s' % (name, value) for name, value in error_list]
+            raise validators.Invalid(
+                '<br>\n'.join(lines),
+                field_dict,
+                state,
+                error_dict=errors
+            )
+        
+    
+    
+
+
+class TimecodeWindow(validators.FormValidator):
+    """Tests that a ``timecode_from`` / ``timecode_to`` window is only given
+      in the context of a theme and that it isn't back to front.
+    """
+    
+    messages = {
+        'no_theme': _(u'A timecode window needs a theme.'),
+        'invalid': _(u'The end of the window must be after the start.')
+    }
+    
+    def validate_python(self, field_dict, state):
+        start = field_dict.get('timecode_from')
+        end = field_dict.get('timecode_to')
+        if start is None and end is None:
+            return
+        if not field_dict.get('theme_slug'):
+            raise validators.Invalid(
+                self.message('no_theme', state),
+                field_dict,
+                state
+            )
+        if start is not None and end is not None and end <= start:
+            raise validators.Invalid(
+                self.message('invalid', state),
+                field_dict,
+                state
+            )
+        
+    
+    
+
+
 class Signup(formencode.Schema):
     """Fields to validate on signup."""
     
-    username = UniqueUsername(not_empty=True)
-    email = UniqueEmail(resolve_domain=True, not_empty=True)
+    username = Username(not_empty=True)
+    email = LowercaseEmail(check_domain=True, not_empty=True)
     password = EncryptedPassword(not_empty=True)
     confirm = RawPassword(not_empty=True)
     chained_validators = [
+        UniqueUser(
+            'username',
+            'email'
+        ),
         PasswordsMatch(
             'password', 
             'confirm'
@@ -513,6 +648,22 @@ class ContextType(validators.UnicodeString):
 class ContextData(formencode.Schema):
     theme_slug = Slug()
     by_username = Username()
+    timecode_from = validators.Number(min=0)
+    timecode_to = validators.Number(min=0)
+    since = DateTimeString(if_empty=None, if_missing=None)
+    cursor = Cursor()
+    limit = PageSize()
+    stream = validators.StringBool(if_missing=False, if_empty=False)
+    chained_validators = [
+        TimecodeWindow()
+    ]
+
+class ThreadData(formencode.Schema):
+    theme_slug = Slug(not_empty=True)
+    cursor = Cursor()
+    limit = PageSize()
+    depth = validators.Int(min=0)
+    replies = validators.Int(min=0)
 
 class AddReaction(formencode.Schema):
     theme_slug = Slug(not_empty=True)
@@ -0,0 +1,104 @@
+import gzip
+import json
+import logging
+import os
+import sys
+
+from os.path import basename, exists as path_exists, getmtime, join as join_path
+
+from pyramid.paster import get_appsettings, setup_logging
+from pyramid.path import AssetResolver
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Assets worth compressing, by extension.
+COMPRESSIBLE = ('.css', '.js', '.json', '.svg', '.txt')
+
+def usage(argv):
+    """Print usage instructions and exit."""
+    
+    cmd = basename(argv[0])
+    print('usage: %s <config_uri>\n'
+          '(example: "%s development.ini")' % (cmd, cmd))
+    sys.exit(1)
+
+def is_stale(path, variant):
+    return not path_exists(variant) or getmtime(variant) < getmtime(path)
+
+def write_gzip(path, data):
+    """Write ``data`` gzipped to ``path``.  The header has a zero mtime, so
+      rebuilding the same asset produces the same bytes.
+    """
+    
+    sock = open(path, 'wb')
+    try:
+        f = gzip.GzipFile(basename(path)[:-3], 'wb', 9, sock, mtime=0)
+        f.write(data)
+        f.close()
+    finally:
+        sock.close()
+
+def write_brotli(path, data):
+    sock = open(path, 'wb')
+    try:
+        sock.write(brotli.compress(data))
+    finally:
+        sock.close()
+
+def compress_file(path):
+    """Write any stale ``.gz`` and ``.br`` variants of the file at ``path``,
+      skipping those that aren't smaller than it.  Returns the number of
+      variants written.
+    """
+    
+    writers = [('.gz', write_gzip)]
+    if brotli is not None:
+        writers.append(('.br', write_brotli))
+    data = None
+    count = 0
+    for ext, write in writers:
+        variant = path + ext
+        if not is_stale(path, variant):
+            continue
+        if data is None:
+            sock = open(path, 'rb')
+            data = sock.read()
+            sock.close()
+        write(variant, data)
+        if os.path.getsize(variant) >= len(data):
+            os.remove(variant)
+        else:
+            count += 1
+    return count
+
+def compress(argv=sys.argv):
+    """Write precompressed variants of the text assets in the assetgen
+      manifest, for the static views to serve, e.g.::
+          
+          $ assetgen etc/assetgen.yaml
+          $ compress_assets etc/production.ini
+    
+    """
+    
+    if len(argv) != 2:
+        usage(argv)
+    config_uri = argv[1]
+    setup_logging(config_uri)
+    settings = get_appsettings(config_uri)
+    static_dir = AssetResolver().resolve(settings['static_dir']).abspath()
+    sock = open(join_path(static_dir, 'assets.json'), 'rb')
+    manifest = json.loads(sock.read())
+    sock.close()
+    if brotli is None:
+        logging.warning('Brotli is not installed: only writing .gz variants.')
+    count = 0
+    for name in sorted(set(manifest.values())):
+        if name.endswith(COMPRESSIBLE):
+            path = join_path(static_dir, name)
+            if path_exists(path):
+                count += compress_file(path)
+    logging.info('Wrote %d compressed variants.' % count)
+
@@ -0,0 +1,96 @@
+import sys
+import time
+
+from datetime import datetime, timedelta
+from decimal import Decimal
+from os.path import basename
+
+from ..basemodel import get_public_keys, get_serializer
+from ..model import Reaction
+
+SIZES = (10000, 100000)
+
+def usage(argv):
+    """Print usage instructions and exit."""
+    
+    cmd = basename(argv[0])
+    print('usage: %s [size ...]\n'
+          '(example: "%s 10000 100000")' % (cmd, cmd))
+    sys.exit(1)
+
+def _make_reactions(n):
+    """Return ``n`` transient reactions with realistic looking values."""
+    
+    now = datetime.utcnow()
+    reactions = []
+    for i in xrange(n):
+        created = now - timedelta(seconds=i)
+        reaction = Reaction(
+            id=i + 1,
+            v=1,
+            c=created,
+            m=created,
+            url=u'http://example.com/%d' % i,
+            message=u'Reaction number %d to the theme.' % i,
+            timecode=Decimal('%d.%03d' % (i % 3600, i % 1000)),
+            theme_slug=u'gender',
+            user_username=u'thruflo',
+            parent_id=None
+        )
+        reactions.append(reaction)
+    return reactions
+
+def _serialize(item, name, keys):
+    """The generic serialisation that ``BaseMixin.__json__`` used to do,
+      inspecting the type of every value.
+    """
+    
+    d = {'__name__': name}
+    for k in keys:
+        v = getattr(item, k)
+        if isinstance(v, datetime):
+            v = v.isoformat()
+        elif isinstance(v, Decimal):
+            v = float(v)
+        elif hasattr(v, '__json__'):
+            v = v.__json__()
+        else:
+            try:
+                unicode(v)
+            except TypeError:
+                continue
+        d[k] = v
+    return d
+
+def _time(f, items):
+    start = time.time()
+    for item in items:
+        f(item)
+    return time.time() - start
+
+def serialization(argv=sys.argv):
+    """Compare the generic ``_serialize()`` path with the compiled per-class
+      serializer that ``BaseMixin.__json__`` uses, e.g.::
+          
+          $ bench_serialize 10000 100000
+    
+    """
+    
+    try:
+        sizes = [int(item) for item in argv[1:]] or SIZES
+    except ValueError:
+        usage(argv)
+    keys = get_public_keys(Reaction)
+    generic = lambda item: _serialize(item, 'reaction', keys)
+    compiled = get_serializer(Reaction)
+    for n in sizes:
+        reactions = _make_reactions(n)
+        # Sanity check that both paths produce the same output.
+        assert generic(reactions[0]) == compiled(reactions[0])
+        t1 = _time(generic, reactions)
+        t2 = _time(compiled, reactions)
+        print('%d reactions: generic %.3fs, compiled %.3fs (%.1fx)' % (
+            n, t1, t2, t1 / t2
+        ))
+
+
@@ -6,8 +6,9 @@ import transaction
 from os.path import basename, join as join_path
 
 from pyramid.paster import get_appsettings, setup_logging
-from sqlalchemy import engine_from_config
+from sqlalchemy import bindparam, engine_from_config, select
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import class_mapper, configure_mappers
 
 from ..model import *
 
@@ -60,61 +61,160 @@ def create_admin():
         Session.add(user)
     
 
-def populate():
-    """ Populate the database.
+# The fixture files, in the order they're loaded, and the model classes
+# their items are loaded into.
+FIXTURES = (
+    ('themes', Theme),
+    ('locations', Location),
+    ('characters', Character),
+)
+
+# How many rows to insert or update per ``executemany``.
+BATCH_SIZE = 1000
+
+def load_fixture(path):
+    """Parse the YAML fixture at ``path``, with the libyaml C loader if it's
+      available.
     """
     
     import yaml
     
+    Loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+    sock = open(path, 'r')
+    try:
+        return yaml.load(sock, Loader=Loader)
+    finally:
+        sock.close()
+    
+
+def normalise(value):
+    """Normalise for strings that are wrapped with double quotes and / or
+      need to have whitespace stripped.
+    """
+    
+    if isinstance(value, basestring):
+        value = value.strip()
+        if value.startswith('"') and value.endswith('"'):
+            value = value[1:-1]
+        if isinstance(value, str):
+            value = value.decode('utf-8')
+    return value
+
+def get_association(model_cls, relation):
+    """Return the ``(table, column, other_column)`` of the association table
+      behind ``model_cls.relation``, where ``column`` references
+      ``model_cls``.
+    """
+    
+    prop = class_mapper(model_cls).get_property(relation)
+    table = prop.secondary
+    column = other_column = None
+    for item in table.c:
+        for foreign_key in item.foreign_keys:
+            if foreign_key.column.table is model_cls.__table__:
+                column = item
+            elif foreign_key.column.table is prop.mapper.local_table:
+                other_column = item
+    return table, column, other_column
+
+def get_slug_map(connection, table):
+    query = select([table.c.slug, table.c.id])
+    return dict(connection.execute(query).fetchall())
+
+def execute_many(connection, statement, rows):
+    """Execute ``statement`` with ``rows`` in batches of ``BATCH_SIZE``.  Rows
+      are grouped by their keys, as each ``executemany`` needs the same
+      parameters.
+    """
+    
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(sorted(row)), []).append(row)
+    for group in groups.values():
+        for i in xrange(0, len(group), BATCH_SIZE):
+            connection.execute(statement, group[i:i + BATCH_SIZE])
+    
+
+def populate():
+    """ Populate the database.  Items are upserted by slug and the relations
+      of items that list them are replaced, so it can be rerun to reload the
+      fixtures without a ``reset``.
+    """
+    
     settings, engine = setup()
+    configure_mappers()
+    relation_names = frozenset(name for name, model_cls in FIXTURES)
     data = {}
-    item_types = ('themes', 'locations', 'characters')
-    def _get_model_cls(item_type):
-        if item_type == 'themes':
-            return Theme
-        elif item_type == 'locations':
-            return Location
-        elif item_type == 'characters':
-            return Character
-    
-    for item in item_types:
-        sock = open(join_path(settings['fixtures_dir'], '%s.yaml' % item), 'r')
-        data[item] = yaml.load(sock)
-        sock.close()
-    for k, v in data.iteritems():
-        with transaction.manager:
-            entities = []
-            model_cls = _get_model_cls(k)
-            for item in v[k]:
-                kwargs = item.copy()
-                kwargs['slug'] = kwargs.pop('value')
-                # Normalise for strings that are wrapped with double quotes
-                # and / or need to have whitespace stripped.
-                for j, w in kwargs.items():
-                    if isinstance(w, basestring):
-                        w = w.strip()
-                        if w.startswith('"') and w.endswith('"'):
-                            w = w[1:-1]
-                        kwargs[j] = w
-                # Setup any relations by finding the related entity by type and slug.
-                for t in item_types:
-                    try:
-                        relation_slugs = kwargs.pop(t)
-                    except KeyError:
-                        pass
-                    else:
-                        relation_cls = _get_model_cls(t)
-                        relations = []
-                        for item_ in relation_slugs:
-                            relation = relation_cls.get_by_slug(item_)
-                            relations.append(relation)
-                        kwargs[t] = relations
-                entity = model_cls(**kwargs)
-                entities.append(entity)
-            logging.info('Adding %d %s.' % (len(entities), k))
-            Session.add_all(entities)
-            transaction.commit()
-        
+    for name, model_cls in FIXTURES:
+        path = join_path(settings['fixtures_dir'], '%s.yaml' % name)
+        data[name] = load_fixture(path)[name]
+    connection = engine.connect()
+    trans = connection.begin()
+    try:
+        # Upsert the items, then map their slugs to their ids.
+        slug_maps = {}
+        for name, model_cls in FIXTURES:
+            table = model_cls.__table__
+            columns = frozenset(table.c.keys())
+            existing = get_slug_map(connection, table)
+            inserts = []
+            updates = []
+            for item in data[name]:
+                row = {}
+                for key, value in item.iteritems():
+                    if key not in relation_names:
+                        row[key] = normalise(value)
+                row['slug'] = row.pop('value')
+                unknown = set(row).difference(columns)
+                if unknown:
+                    raise ValueError('Unknown %s columns: %s' % (name,
+                            ', '.join(sorted(unknown))))
+                if row['slug'] in existing:
+                    row['_id'] = existing[row['slug']]
+                    updates.append(row)
+                else:
+                    inserts.append(row)
+            logging.info('Adding %d and updating %d %s.' % (len(inserts),
+                    len(updates), name))
+            execute_many(connection, table.insert(), inserts)
+            statement = table.update().where(table.c.id == bindparam('_id'))
+            execute_many(connection, statement.values(v=table.c.v + 1), updates)
+            slug_maps[name] = get_slug_map(connection, table)
+        # Gather the association rows and the ids whose rows they replace,
+        # per table, as both sides of a relation may list it.
+        associations = {}
+        for name, model_cls in FIXTURES:
+            for item in data[name]:
+                slug = normalise(item['value'])
+                for relation in relation_names.intersection(item):
+                    table, column, other_column = get_association(model_cls,
+                            relation)
+                    replaced, rows = associations.setdefault(table, ({}, set()))
+                    id_ = slug_maps[name][slug]
+                    replaced.setdefault(column, set()).add(id_)
+                    for other_slug in item[relation] or ():
+                        other_slug = normalise(other_slug)
+                        try:
+                            other_id = slug_maps[relation][other_slug]
+                        except KeyError:
+                            raise ValueError('Unknown %s %r related to %s %r.' % (
+                                    relation, other_slug, name, slug))
+                        row = ((column.name, id_), (other_column.name, other_id))
+                        rows.add(tuple(sorted(row)))
+        for table, (replaced, rows) in associations.iteritems():
+            logging.info('Adding %d %s.' % (len(rows), table.name))
+            for column, ids in replaced.iteritems():
+                ids = sorted(ids)
+                for i in xrange(0, len(ids), BATCH_SIZE):
+                    clause = column.in_(ids[i:i + BATCH_SIZE])
+                    connection.execute(table.delete().where(clause))
+            execute_many(connection, table.insert(), [dict(item) for item in rows])
+        trans.commit()
+    except:
+        trans.rollback()
+        raise
+    finally:
+        connection.close()
     
 
 def bootstrap():
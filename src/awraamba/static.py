@@ -0,0 +1,528 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Provides ``media_view``, which serves the theme videos with support for
+  ``Range`` requests, so that seeking in the player only fetches the bytes it
+  needs, e.g.::
+      
+      GET /static/videos/gender.mp4
+      Range: bytes=1048576-2097151
+      
+      206 Partial Content
+      Content-Range: bytes 1048576-2097151/73400320
+  
+  Single ranges are served by seeking the open file and handing it to the
+  server's ``wsgi.file_wrapper``, which (with waitress) streams it from the
+  non-blocking main loop rather than the worker thread.  Multiple ranges
+  are served as ``multipart/byteranges`` from a memory map of the file.
+  
+  Also provides ``asset_view``, which serves the text assets, choosing the
+  ``.br`` or ``.gz`` variant written by the ``compress_assets`` script, if
+  there is one that the client accepts, rather than compressing per request.
+  
+  And ``TourIndex``, which content hashes the panorama tour's files, and the
+  views that serve them: ``versioned_tour_view`` at immutable urls like
+  ``/tour/<version>/tour.swf`` and ``tour_view`` at revalidating urls like
+  ``/tour/tour.xml``.
+"""
+
+import hashlib
+import json
+import logging
+import mimetypes
+import mmap
+import os
+
+from datetime import datetime
+from os.path import exists as path_exists, getmtime, isfile, join as join_path
+from os.path import relpath
+
+from pyramid.httpexceptions import HTTPFound, HTTPNotFound
+from pyramid.path import AssetResolver
+from pyramid.response import Response
+from webob.datetime_utils import UTC, parse_date
+
+from .thumbnails import FORMATS, WEBP_SUPPORTED, ThumbnailError
+from .views import generate_etag, is_not_modified, not_modified
+
+BLOCK_SIZE = 65536
+MAX_AGE = 1209600
+MAX_RANGES = 16
+
+# The precompressed variants of assets that ``asset_view`` can serve, in
+# order of preference.
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+# Versioned tour urls can be cached forever, apart from its entry documents,
+# which are always revalidated.
+IMMUTABLE = 'public, max-age=31536000, immutable'
+TOUR_ENTRY_EXTENSIONS = ('.xml',)
+
+def parse_ranges(header, size):
+    """Parse a ``Range`` ``header`` for a ``size`` byte file into a sorted
+      list of ``(start, stop)`` byte offsets, merging overlapping and
+      adjacent ranges.
+      
+      Returns ``None`` if the header is malformed (so should be ignored) or
+      ``[]`` if none of the ranges are satisfiable.
+    """
+    
+    units, _, specs = header.partition('=')
+    if units.strip().lower() != 'bytes' or not specs.strip():
+        return None
+    ranges = []
+    for spec in specs.split(','):
+        spec = spec.strip()
+        first, dash, last = spec.partition('-')
+        if not dash:
+            return None
+        try:
+            if not first:
+                # A suffix range: the last ``last`` bytes.
+                length = int(last)
+                if length <= 0:
+                    continue
+                start, stop = max(size - length, 0), size
+            else:
+                start = int(first)
+                stop = int(last) + 1 if last else size
+                if start < 0 or (last and stop <= start):
+                    return None
+                stop = min(stop, size)
+        except ValueError:
+            return None
+        if start < size:
+            ranges.append((start, stop))
+    ranges.sort()
+    merged = []
+    for start, stop in ranges:
+        if merged and start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    return merged
+
+def iter_file(f, start, stop, block_size=BLOCK_SIZE):
+    """Yield the bytes of ``f`` from ``start`` to ``stop`` in blocks and then
+      close it.  The fallback when the server has no ``wsgi.file_wrapper``.
+    """
+    
+    try:
+        f.seek(start)
+        remaining = stop - start
+        while remaining > 0:
+            data = f.read(min(block_size, remaining))
+            if not data:
+                break
+            remaining -= len(data)
+            yield data
+    finally:
+        f.close()
+
+def iter_byteranges(f, parts, block_size=BLOCK_SIZE):
+    """Yield the ``multipart/byteranges`` body for ``parts``, a list of
+      ``(headers, start, stop)``, sliced from a memory map of ``f``.
+    """
+    
+    try:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for headers, start, stop in parts:
+                yield headers
+                for offset in xrange(start, stop, block_size):
+                    yield data[offset:min(offset + block_size, stop)]
+                yield '\r\n'
+            yield parts.closing
+        finally:
+            data.close()
+    finally:
+        f.close()
+
+
+class ByteRangeParts(list):
+    """The ``(headers, start, stop)`` parts of a multipart response."""
+    
+    def __init__(self, ranges, size, content_type):
+        self.boundary = os.urandom(16).encode('hex')
+        self.closing = '--%s--\r\n' % self.boundary
+        for start, stop in ranges:
+            headers = '--%s\r\nContent-Type: %s\r\nContent-Range: %s\r\n\r\n' % (
+                self.boundary,
+                content_type,
+                'bytes %d-%d/%d' % (start, stop - 1, size)
+            )
+            self.append((headers, start, stop))
+    
+    @property
+    def content_length(self):
+        length = len(self.closing)
+        for headers, start, stop in self:
+            length += len(headers) + stop - start + 2
+        return length
+
+
+
+def set_file_body(request, response, f, start, stop):
+    """Make the bytes of the open file ``f`` from ``start`` to ``stop`` the
+      ``response`` body, without reading them into memory.
+    """
+    
+    file_wrapper = request.environ.get('wsgi.file_wrapper')
+    if file_wrapper is None:
+        response.app_iter = iter_file(f, start, stop)
+    else:
+        # The server sends ``Content-Length`` bytes from the file's
+        # current position.
+        f.seek(start)
+        response.app_iter = file_wrapper(f, BLOCK_SIZE)
+    response.content_length = stop - start
+
+def get_static_dir(registry):
+    """Return the absolute path of ``settings['static_dir']``."""
+    
+    static_dir = getattr(registry, 'static_path', None)
+    if static_dir is None:
+        spec = registry.settings['static_dir']
+        static_dir = registry.static_path = AssetResolver().resolve(spec).abspath()
+    return static_dir
+
+def get_file_path(directory, subpath):
+    """Return the path to the file at ``subpath`` within ``directory``, or
+      ``None`` if there isn't one.
+    """
+    
+    if not subpath:
+        return None
+    for item in subpath:
+        if not item or item.startswith('.') or os.sep in item:
+            return None
+    path = join_path(directory, *subpath)
+    return path if isfile(path) else None
+
+def get_media_path(request):
+    """Return the path to the requested file, or ``None`` if the path isn't
+      a file within the ``videos`` directory.
+    """
+    
+    directory = join_path(get_static_dir(request.registry), 'videos')
+    return get_file_path(directory, request.matchdict.get('subpath', ()))
+
+def is_range_current(request, etag, last_modified):
+    """Does the ``If-Range`` precondition (if any) match the current file?"""
+    
+    value = request.headers.get('If-Range')
+    if not value:
+        return True
+    if value.startswith('"') or value.startswith('W/'):
+        return value == '"%s"' % etag
+    return parse_date(value) == last_modified
+
+def media_view(request):
+    """Serve the requested video, or the requested ``Range``s of it."""
+    
+    path = get_media_path(request)
+    if path is None:
+        raise HTTPNotFound
+    f = open(path, 'rb')
+    try:
+        stat = os.fstat(f.fileno())
+        last_modified = datetime.fromtimestamp(int(stat.st_mtime), UTC)
+        size = stat.st_size
+        etag = generate_etag(path, stat.st_mtime, size)
+        if is_not_modified(request, etag, last_modified):
+            f.close()
+            return not_modified(etag, last_modified)
+        content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        ranges = None
+        header = request.headers.get('Range')
+        if header and is_range_current(request, etag, last_modified):
+            ranges = parse_ranges(header, size)
+            if ranges is not None and len(ranges) > MAX_RANGES:
+                logging.warning('Ignoring %d ranges for %s' % (len(ranges), path))
+                ranges = None
+        response = Response(content_type=content_type)
+        response.accept_ranges = 'bytes'
+        response.etag = etag
+        response.last_modified = last_modified
+        response.cache_control.public = True
+        response.cache_control.max_age = MAX_AGE
+        if ranges == []:
+            f.close()
+            response.status = 416
+            response.content_range = 'bytes */%d' % size
+            response.content_length = 0
+            return response
+        if ranges is not None and len(ranges) > 1:
+            parts = ByteRangeParts(ranges, size, content_type)
+            response.status = 206
+            response.content_type = 'multipart/byteranges; boundary=%s' % parts.boundary
+            response.app_iter = iter_byteranges(f, parts)
+            response.content_length = parts.content_length
+            return response
+        if ranges:
+            start, stop = ranges[0]
+            response.status = 206
+            response.content_range = 'bytes %d-%d/%d' % (start, stop - 1, size)
+        else:
+            start, stop = 0, size
+        set_file_body(request, response, f, start, stop)
+        return response
+    except:
+        f.close()
+        raise
+
+def get_variant(request, path):
+    """Return ``(path, encoding)`` for the best precompressed variant of the
+      file at ``path`` that the client accepts, falling back to
+      ``(path, None)``.  Variants older than the file are ignored.
+    """
+    
+    accept_encoding = request.accept_encoding
+    for encoding, ext in ENCODINGS:
+        if accept_encoding.quality(encoding):
+            variant = path + ext
+            if isfile(variant) and getmtime(variant) >= getmtime(path):
+                return variant, encoding
+    return path, None
+
+def asset_view(request):
+    """Serve the requested text asset, choosing a precompressed variant
+      written by ``compress_assets`` by ``Accept-Encoding``.
+    """
+    
+    static_dir = get_static_dir(request.registry)
+    path = get_file_path(static_dir, (request.matchdict['filename'],))
+    if path is None:
+        raise HTTPNotFound
+    content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+    path, encoding = get_variant(request, path)
+    f = open(path, 'rb')
+    try:
+        stat = os.fstat(f.fileno())
+        last_modified = datetime.fromtimestamp(int(stat.st_mtime), UTC)
+        etag = generate_etag(path, stat.st_mtime, stat.st_size)
+        if is_not_modified(request, etag, last_modified):
+            f.close()
+            response = not_modified(etag, last_modified)
+        else:
+            response = Response(content_type=content_type)
+            response.content_encoding = encoding
+            response.etag = etag
+            response.last_modified = last_modified
+            set_file_body(request, response, f, 0, stat.st_size)
+    except:
+        f.close()
+        raise
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = MAX_AGE
+    response.vary = ('Accept-Encoding',)
+    return response
+
+
+def get_derivative_formats(fmt, accepts_webp=True):
+    """Return the formats that a request for a ``fmt`` derivative can be
+      served in.  ``.png`` requests are served the smallest of PNG, JPEG and,
+      if the client accepts it, WebP.
+    """
+    
+    if fmt != 'png':
+        return [fmt]
+    formats = ['png', 'jpg']
+    if WEBP_SUPPORTED and accepts_webp:
+        formats.append('webp')
+    return formats
+
+def derivative_view(request):
+    """Serve a derivative of a thumbnailed image, at ``/thumbs/<digest>/
+      <width>x<height>.<fmt>``, rendering it from the stored original, in the
+      thumbnailer's pool, the first time it's requested.
+    """
+    
+    registry = request.registry
+    thumbnailer = registry.thumbnailer
+    max_dimension = int(registry.settings.get('thumbnails.max_dimension', 1024))
+    digest = request.matchdict['digest']
+    size = int(request.matchdict['width']), int(request.matchdict['height'])
+    fmt = request.matchdict['fmt']
+    if not (0 < size[0] <= max_dimension and 0 < size[1] <= max_dimension):
+        raise HTTPNotFound
+    if fmt == 'webp' and not WEBP_SUPPORTED:
+        raise HTTPNotFound
+    accepts_webp = 'image/webp' in request.headers.get('Accept', '')
+    formats = get_derivative_formats(fmt, accepts_webp)
+    paths = thumbnailer.find_derivatives(digest, size, formats)
+    if not paths:
+        if thumbnailer.get_original_path(digest) is None:
+            raise HTTPNotFound
+        # Render every format a ``.png`` could be served in at once, so the
+        # clients that accept different formats share the work.
+        key = ('derivative', digest, size, fmt)
+        try:
+            registry.single_flight.do(key, thumbnailer.render_derivatives,
+                    digest, size, get_derivative_formats(fmt))
+        except ThumbnailError as err:
+            logging.warning(err)
+            raise HTTPNotFound
+        paths = thumbnailer.find_derivatives(digest, size, formats)
+        if not paths:
+            raise HTTPNotFound
+    path = min(paths, key=os.path.getsize)
+    content_type = FORMATS[path.rsplit('.', 1)[1]]
+    f = open(path, 'rb')
+    try:
+        stat = os.fstat(f.fileno())
+        last_modified = datetime.fromtimestamp(int(stat.st_mtime), UTC)
+        etag = generate_etag(path, stat.st_mtime, stat.st_size)
+        if is_not_modified(request, etag, last_modified):
+            f.close()
+            response = not_modified(etag, last_modified)
+        else:
+            response = Response(content_type=content_type)
+            response.etag = etag
+            response.last_modified = last_modified
+            set_file_body(request, response, f, 0, stat.st_size)
+    except:
+        f.close()
+        raise
+    response.cache_control.no_cache = None
+    response.cache_control.public = True
+    response.cache_control.max_age = MAX_AGE
+    if fmt == 'png':
+        response.vary = ('Accept',)
+    return response
+
+
+class TourIndex(object):
+    """Content hashes of the files in the tour ``directory`` and a
+      ``version`` that changes whenever any of them do.
+      
+      Hashing hundreds of tiles is slow, so the hashes are persisted to
+      ``index_file`` with each file's mtime and size, and only the files
+      that have changed since are rehashed by ``load()``.
+    """
+    
+    def __init__(self, directory, index_file=None):
+        self.directory = directory
+        self.index_file = index_file
+        self.files = {}
+        self.version = None
+    
+    def load(self):
+        previous = {}
+        if self.index_file and path_exists(self.index_file):
+            sock = open(self.index_file, 'rb')
+            try:
+                previous = json.loads(sock.read())['files']
+            except (ValueError, KeyError):
+                logging.warning('Ignoring invalid tour index.', exc_info=True)
+            finally:
+                sock.close()
+        files = {}
+        for root, dirs, names in os.walk(self.directory, followlinks=True):
+            dirs[:] = [item for item in dirs if not item.startswith('.')]
+            for name in names:
+                if name.startswith('.'):
+                    continue
+                path = join_path(root, name)
+                key = relpath(path, self.directory).replace(os.sep, '/')
+                stat = os.stat(path)
+                entry = previous.get(key)
+                if entry is None or entry[:2] != [stat.st_mtime, stat.st_size]:
+                    entry = [stat.st_mtime, stat.st_size, self.hash_file(path)]
+                files[key] = entry
+        self.files = files
+        digest = hashlib.md5()
+        for key in sorted(files):
+            digest.update('%s\0%s\n' % (key.encode('utf-8'), files[key][2]))
+        self.version = digest.hexdigest()[:12]
+        if self.index_file and files != previous:
+            self.save()
+        return self
+    
+    def save(self):
+        """Atomically replace the ``index_file``."""
+        
+        tmp = '%s.%d.tmp' % (self.index_file, os.getpid())
+        sock = open(tmp, 'wb')
+        try:
+            json.dump({'version': self.version, 'files': self.files}, sock)
+        finally:
+            sock.close()
+        os.rename(tmp, self.index_file)
+    
+    def hash_file(self, path):
+        digest = hashlib.md5()
+        sock = open(path, 'rb')
+        try:
+            for data in iter(lambda: sock.read(BLOCK_SIZE), ''):
+                digest.update(data)
+        finally:
+            sock.close()
+        return digest.hexdigest()
+    
+    def get_path(self, subpath):
+        """Return ``(path, digest)`` for the indexed file at ``subpath``, or
+          ``(None, None)`` if there isn't one.
+        """
+        
+        path = get_file_path(self.directory, subpath)
+        if path is None:
+            return None, None
+        key = '/'.join(subpath)
+        entry = self.files.get(key)
+        if entry is None:
+            return None, None
+        return path, entry[2]
+    
+
+
+def get_tour_path(request):
+    """Return the versioned path prefix of the tour files, e.g.:
+      ``/tour/0123456789ab/``.
+    """
+    
+    return '/tour/%s/' % request.registry.tour_index.version
+
+def serve_tour_file(request, immutable):
+    index = request.registry.tour_index
+    path, digest = index.get_path(request.matchdict.get('subpath', ()))
+    if path is None:
+        raise HTTPNotFound
+    if path.endswith(TOUR_ENTRY_EXTENSIONS):
+        immutable = False
+    if is_not_modified(request, digest):
+        response = not_modified(digest)
+    else:
+        f = open(path, 'rb')
+        try:
+            size = os.fstat(f.fileno()).st_size
+            content_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            response = Response(content_type=content_type)
+            response.etag = digest
+            set_file_body(request, response, f, 0, size)
+        except:
+            f.close()
+            raise
+        if not immutable:
+            response.cache_control.no_cache = True
+    if immutable:
+        response.headers['Cache-Control'] = IMMUTABLE
+    return response
+
+def versioned_tour_view(request):
+    """Serve a tour file at its versioned url, redirecting requests for
+      previous versions to the current one.
+    """
+    
+    index = request.registry.tour_index
+    if request.matchdict['version'] != index.version:
+        subpath = '/'.join(request.matchdict.get('subpath', ()))
+        raise HTTPFound(location=get_tour_path(request) + subpath)
+    return serve_tour_file(request, True)
+
+def tour_view(request):
+    """Serve a tour file at its unversioned url, to be revalidated."""
+    
+    return serve_tour_file(request, False)
+
@@ -64,7 +64,7 @@
               <button class="btn primary" type="submit">${_(u'Signup')}</button>
             </form>
             <form action="/login" method="post" class="pull-right">
-              <input type="hidden" name="csrf_token" value="${request.session.get_csrf_token()}" />
+              <input type="hidden" name="csrf_token" value="${csrf_token or request.session.get_csrf_token()}" />
               <input class="input-small" type="text" placeholder="${_(u'Username')}" />
               <input class="input-small" type="password" placeholder="${_(u'Password')}">
               <button class="btn" type="submit">${_(u'Login')}</button>
@@ -96,7 +96,7 @@
     % if not is_ajax:
       <script type="text/javascript" src="//ajax.googleapis.com/ajax/libs/jquery/1.6.4/jquery.min.js">
       </script>
-      <script type="text/javascript" src="${request.static_url('awraamba:tour/tour.js')}">
+      <script type="text/javascript" src="${request.tour_path}tour.js">
       </script>
       <script type="text/javascript" src="${request.static_url('awraamba:assets/base.js')}">
       </script>
@@ -105,7 +105,8 @@
       <script type="text/javascript">
         window.awraamba = {};
         window.awraamba['template_variables'] = {
-          'is_first_time': ${is_first_time and "true" or "false"}
+          'is_first_time': ${is_first_time and "true" or "false"},
+          'tour_path': '${request.tour_path}'
         };
         // Setup the static urls.
         assetgen.add_manifest('/static', ${manifest_data | n});
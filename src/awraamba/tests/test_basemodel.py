@@ -0,0 +1,251 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for keyset pagination, the compiled serializers, Core row
+  projections and ``query_cache``, against a ``FakeMemcacheClient`` and an
+  in memory sqlite db.
+"""
+
+import pickle
+import unittest
+
+from datetime import datetime
+from decimal import Decimal
+
+import transaction
+
+from sqlalchemy import MetaData, create_engine
+
+from awraamba.basemodel import decode_cursor, encode_cursor, paginate
+from awraamba.basemodel import compile_serializer, get_public_keys
+from awraamba.basemodel import get_serializer, query_cache
+from awraamba.caching import FakeMemcacheClient, MemcachedBackend
+from awraamba.model import Reaction, Session, SQLModel, Theme, User
+from awraamba.scripts.bench import _make_reactions, _serialize
+
+def create_tables(engine):
+    """Create the tables without the postgres only full text search
+      triggers, which are bound to ``SQLModel.metadata``'s tables.
+    """
+    
+    metadata = MetaData()
+    for table in SQLModel.metadata.sorted_tables:
+        table.tometadata(metadata)
+    metadata.create_all(engine)
+
+
+class TestKeysetPagination(unittest.TestCase):
+    
+    def setUp(self):
+        Session.remove()
+        Session.configure(bind=create_engine('sqlite://'))
+        create_tables(Session.bind)
+        self.table = Reaction.__table__
+        self.columns = [self.table.c.c, self.table.c.id]
+        # Reactions created in pairs, so sorting on ``c`` alone is ambiguous.
+        with transaction.manager:
+            for i in range(7):
+                Session.add(Reaction(theme_slug=u'gender', timecode=i,
+                        user_username=u'bob', message=u'%d' % i,
+                        c=datetime(2012, 6, 1, 12, 0, i // 2)))
+        Session.remove()
+    
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+    
+    def test_cursor_round_trip(self):
+        values = (datetime(2012, 6, 1, 12, 30, 0, 5), 7)
+        token = encode_cursor(values)
+        self.assertFalse('=' in token)
+        self.assertEqual(decode_cursor(token, self.columns), values)
+        values = (datetime(2012, 6, 1), 8)
+        self.assertEqual(decode_cursor(encode_cursor(values), self.columns),
+                values)
+        columns = [self.table.c.timecode, self.table.c.id]
+        values = (Decimal('1.5'), 9)
+        self.assertEqual(decode_cursor(encode_cursor(values), columns), values)
+    
+    def test_invalid_cursors(self):
+        for token in ('', 'garbage', encode_cursor([1]),
+                encode_cursor(['yesterday', 1]), encode_cursor({'c': 1})):
+            self.assertRaises(ValueError, decode_cursor, token, self.columns)
+    
+    def get_pages(self, limit, descending=False):
+        pages = []
+        cursor = None
+        while True:
+            rows, cursor = paginate(Reaction.select_public(), self.columns,
+                    limit, cursor=cursor, descending=descending)
+            pages.append([row.message for row in rows])
+            if cursor is None:
+                Session.remove()
+                return pages
+    
+    def test_page_boundaries(self):
+        # Pages that split a pair of reactions created at the same time.
+        self.assertEqual(self.get_pages(3), [
+            [u'0', u'1', u'2'],
+            [u'3', u'4', u'5'],
+            [u'6']
+        ])
+        self.assertEqual(self.get_pages(3, descending=True), [
+            [u'6', u'5', u'4'],
+            [u'3', u'2', u'1'],
+            [u'0']
+        ])
+        # An exactly full last page has no next cursor.
+        self.assertEqual(self.get_pages(7), [[unicode(i) for i in range(7)]])
+        self.assertEqual(len(self.get_pages(1)), 7)
+
+
+
+class TestSerializers(unittest.TestCase):
+    
+    def assertParity(self, cls, item):
+        keys = get_public_keys(cls)
+        expected = _serialize(item, cls.__name__.lower(), keys)
+        self.assertEqual(get_serializer(cls)(item), expected)
+        self.assertEqual(item.__json__(), expected)
+    
+    def test_parity(self):
+        reactions = _make_reactions(20)
+        reactions[1].parent_id = reactions[0].id
+        reactions[2].url = reactions[2].m = reactions[2].timecode = None
+        reactions.append(Reaction(message=u'Unsaved'))
+        for reaction in reactions:
+            self.assertParity(Reaction, reaction)
+        self.assertEqual(reactions[0].__json__()['timecode'], 0.0)
+        self.assertParity(Theme, Theme(id=1, slug=u'gender', title=u'Gender',
+                c=datetime(2012, 6, 1), v=1))
+        self.assertParity(User, User(username=u'bob', name=u'Bob'))
+    
+    def test_keys(self):
+        serializer = compile_serializer(Reaction, keys=['reaction_id', 'c'])
+        reaction = _make_reactions(1)[0]
+        self.assertEqual(serializer(reaction), {
+            '__name__': 'reaction',
+            'reaction_id': 1,
+            'c': reaction.c.isoformat()
+        })
+        self.assertTrue(get_serializer(Reaction) is get_serializer(Reaction))
+
+
+
+class TestProjections(unittest.TestCase):
+    
+    def setUp(self):
+        Session.remove()
+        Session.configure(bind=create_engine('sqlite://'))
+        create_tables(Session.bind)
+        with transaction.manager:
+            for reaction in _make_reactions(5):
+                reaction.id = None
+                Session.add(reaction)
+            Session.add(Reaction(theme_slug=u'sex', user_username=u'bob',
+                    message=u'Sex', timecode=Decimal('1.5'), parent_id=1))
+        Session.remove()
+    
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+    
+    def test_public_columns(self):
+        names = [column.name for column in Reaction.get_public_columns()]
+        self.assertEqual(names, get_public_keys(Reaction))
+        self.assertTrue('id' not in names)
+    
+    def test_rows_serialise_like_instances(self):
+        table = Reaction.__table__
+        query = Reaction.select_public(table.c.theme_slug == u'sex')
+        rows = Session.execute(query.order_by(table.c.id)).fetchall()
+        self.assertEqual(len(rows), 1)
+        query = Reaction.select_public().order_by(table.c.id)
+        rows = Session.execute(query).fetchall()
+        reactions = Reaction.query.order_by(Reaction.id).all()
+        serializer = get_serializer(Reaction)
+        self.assertEqual([serializer(row) for row in rows],
+                [reaction.__json__() for reaction in reactions])
+        self.assertEqual(len(rows), 6)
+
+
+
+class TestQueryCache(unittest.TestCase):
+    
+    def setUp(self):
+        Session.remove()
+        Session.configure(bind=create_engine('sqlite://'))
+        create_tables(Session.bind)
+        self.backend = MemcachedBackend(FakeMemcacheClient())
+        query_cache.configure(self.backend, ttl=60)
+        with transaction.manager:
+            Session.add(Theme(slug=u'gender', title=u'Gender'))
+            Session.add(User(username=u'bob', email=u'bob@example.com',
+                    password=u'secret-hash', confirmation_hash=u'abc'))
+        Session.remove()
+    
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        query_cache.configure(None)
+    
+    def get_theme(self, slug):
+        with transaction.manager:
+            theme = Theme.get_by_slug(slug)
+            values = theme and (theme.id, theme.title, theme.v)
+        Session.remove()
+        return values
+    
+    def test_caches_lookups(self):
+        self.get_theme(u'gender')
+        hits = query_cache.hits
+        self.assertEqual(self.get_theme(u'gender'), (1, u'Gender', 1))
+        self.assertEqual(query_cache.hits, hits + 1)
+    
+    def test_update_invalidates(self):
+        self.get_theme(u'gender')
+        with transaction.manager:
+            Theme.get_by_slug(u'gender').title = u'Changed'
+        Session.remove()
+        self.assertEqual(self.get_theme(u'gender'), (1, u'Changed', 2))
+        self.assertEqual(self.get_theme(u'gender'), (1, u'Changed', 2))
+    
+    def test_unique_column_change_invalidates(self):
+        self.get_theme(u'gender')
+        with transaction.manager:
+            Theme.get_by_slug(u'gender').slug = u'sex'
+        Session.remove()
+        self.assertEqual(self.get_theme(u'gender'), None)
+        self.assertEqual(self.get_theme(u'sex'), (1, u'Gender', 2))
+    
+    def test_stale_reader_cant_store_old_version(self):
+        """A reader that loaded a row before an update committed mustn't put
+          its copy back over the new version's marker.
+        """
+        
+        self.get_theme(u'gender')
+        stale = Theme(id=1, slug=u'gender', title=u'Gender', v=1)
+        with transaction.manager:
+            Theme.get_by_slug(u'gender').title = u'Changed'
+        Session.remove()
+        key = query_cache.make_key(Theme, 'slug', u'gender')
+        self.assertEqual(self.backend.get(key), (2, None))
+        query_cache.get(Theme, 'slug', u'gender', lambda: stale)
+        self.assertEqual(self.backend.get(key), (2, None))
+        self.assertEqual(self.get_theme(u'gender'), (1, u'Changed', 2))
+    
+    def test_secrets_arent_cached(self):
+        with transaction.manager:
+            User.get_by_id(1)
+        Session.remove()
+        version, data = self.backend.get(query_cache.make_key(User, 'id', 1))
+        values = pickle.loads(data)
+        self.assertEqual(values['username'], u'bob')
+        self.assertFalse('password' in values)
+        self.assertFalse('confirmation_hash' in values)
+        with transaction.manager:
+            user = User.get_by_id(1)
+            self.assertEqual(user.password, u'secret-hash')
+        Session.remove()
+
+
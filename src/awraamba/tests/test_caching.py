@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for ``LRUCache`` and ``SingleFlight``."""
+
+import threading
+import time
+import unittest
+
+from awraamba.caching import LRUCache, SingleFlight
+
+class TestLRUCache(unittest.TestCase):
+    
+    def test_byte_budget(self):
+        cache = LRUCache(10)
+        self.assertTrue(cache.set('a', 'aaaa'))
+        self.assertTrue(cache.set('b', 'bbbb'))
+        self.assertEqual(cache.get('a'), 'aaaa')
+        # Evicts ``b``, as ``a`` has been used since.
+        self.assertTrue(cache.set('c', 'cccc'))
+        self.assertEqual(cache.get('b'), None)
+        self.assertEqual((cache.get('a'), cache.get('c')), ('aaaa', 'cccc'))
+        self.assertEqual((cache.size, cache.evictions), (8, 1))
+        # Replacing a value resizes it.
+        cache.set('a', 'a')
+        self.assertEqual(cache.size, 5)
+        cache.delete('c')
+        self.assertEqual(cache.size, 1)
+        # Values larger than the whole budget aren't stored.
+        self.assertFalse(cache.set('d', 'd' * 11))
+        self.assertEqual((len(cache), cache.size), (1, 1))
+    
+    def test_sizeof(self):
+        cache = LRUCache(10, sizeof=lambda entry: len(entry[0]))
+        cache.set('a', ('aaaaaa', 'etag'))
+        cache.set('b', ('bbbbbb', 'etag'))
+        self.assertEqual(cache.get('a'), None)
+        self.assertEqual(cache.stats()['size'], 6)
+    
+    def test_tags(self):
+        cache = LRUCache(100)
+        cache.set('a', 'a', tags=['gender'])
+        cache.set('b', 'b', tags=['gender', 'sex'])
+        cache.set('c', 'c', tags=['sex'])
+        cache.invalidate('gender')
+        self.assertEqual([cache.get(key) for key in 'abc'], [None, None, 'c'])
+        self.assertEqual(cache.invalidations, 2)
+        cache.invalidate('sex')
+        self.assertEqual((len(cache), cache.size), (0, 0))
+        # Invalidating an unused tag is fine.
+        cache.invalidate('religion')
+    
+    def test_evicted_keys_arent_invalidated(self):
+        cache = LRUCache(2)
+        cache.set('a', 'a', tags=['gender'])
+        cache.set('b', 'b', tags=['gender'])
+        cache.set('c', 'c', tags=['sex'])
+        cache.invalidate('gender')
+        self.assertEqual(cache.invalidations, 1)
+        self.assertEqual(cache.get('c'), 'c')
+    
+    def test_stale_values_arent_stored(self):
+        cache = LRUCache(100)
+        generation = cache.generation(['gender'])
+        # Invalidated whilst the value was being computed.
+        cache.invalidate('gender')
+        self.assertFalse(cache.set('a', 'a', tags=['gender'],
+                generation=generation))
+        self.assertEqual(cache.get('a'), None)
+        generation = cache.generation(['gender'])
+        self.assertTrue(cache.set('a', 'a', tags=['gender'],
+                generation=generation))
+        cache.clear()
+        self.assertFalse(cache.set('a', 'a', tags=['gender'],
+                generation=generation))
+        self.assertEqual(cache.size, 0)
+
+
+
+class TestSingleFlight(unittest.TestCase):
+    
+    def setUp(self):
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+    
+    def compute(self, fail=False):
+        """Count the call and, for the first caller, wait to be released."""
+        
+        self.calls += 1
+        count = self.calls
+        if count == 1:
+            self.started.set()
+            self.release.wait(5)
+            if fail:
+                raise ValueError
+        return count
+    
+    def call(self, single_flight, results, *args):
+        def target():
+            try:
+                results.append(single_flight.do('key', self.compute, *args))
+            except ValueError as err:
+                results.append(err)
+        thread = threading.Thread(target=target)
+        thread.start()
+        return thread
+    
+    def wait_for(self, single_flight, name, value):
+        for i in range(500):
+            if single_flight.stats()[name] == value:
+                return
+            time.sleep(0.01)
+        self.fail('%s never reached %s' % (name, value))
+    
+    def test_coalesces(self):
+        single_flight = SingleFlight()
+        results = []
+        threads = [self.call(single_flight, results)]
+        self.started.wait(5)
+        threads.extend(self.call(single_flight, results) for i in range(4))
+        self.wait_for(single_flight, 'coalesced', 4)
+        self.release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [1] * 5)
+        self.assertEqual(self.calls, 1)
+        self.assertEqual(single_flight.stats()['in_flight'], 0)
+        # Calls that don't overlap aren't coalesced.
+        self.assertEqual(single_flight.do('key', self.compute), 2)
+    
+    def test_timeout(self):
+        single_flight = SingleFlight(timeout=0.05)
+        results = []
+        leader = self.call(single_flight, results)
+        self.started.wait(5)
+        # Gives up waiting and computes the result itself.
+        self.assertEqual(single_flight.do('key', self.compute), 2)
+        self.assertEqual(single_flight.stats()['timeouts'], 1)
+        self.release.set()
+        leader.join()
+        self.assertEqual(results, [1])
+    
+    def test_leader_failure(self):
+        single_flight = SingleFlight()
+        results = []
+        leader = self.call(single_flight, results, True)
+        self.started.wait(5)
+        waiter = self.call(single_flight, results, True)
+        self.wait_for(single_flight, 'coalesced', 1)
+        self.release.set()
+        leader.join()
+        waiter.join()
+        # The waiter computes the result itself, rather than failing too.
+        self.assertTrue(isinstance(results[0], ValueError))
+        self.assertEqual(results[1:], [2])
+        self.assertEqual(single_flight.stats()['failures'], 1)
+
+
+
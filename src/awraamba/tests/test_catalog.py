@@ -0,0 +1,130 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the in memory catalog, against an in memory sqlite db."""
+
+import json
+import unittest
+
+import transaction
+
+from pyramid import testing
+from pyramid.httpexceptions import HTTPForbidden, HTTPNotModified
+from pyramid.request import Request
+from sqlalchemy import create_engine
+
+from awraamba import views
+
+from awraamba.catalog import get_catalog, load_catalog
+from awraamba.model import Character, Location, Session, Theme, User
+from awraamba.tests.test_basemodel import create_tables
+
+class TestCatalog(unittest.TestCase):
+    
+    def setUp(self):
+        Session.remove()
+        Session.configure(bind=create_engine('sqlite://'))
+        create_tables(Session.bind)
+        with transaction.manager:
+            theme = Theme(slug=u'gender', title=u'Gender')
+            character = Character(slug=u'ali', name=u'Ali')
+            location = Location(slug=u'cairo', title=u'Cairo')
+            theme.characters.append(character)
+            theme.locations.append(location)
+            character.locations.append(location)
+            Session.add(theme)
+        Session.remove()
+    
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+    
+    def load(self):
+        try:
+            return load_catalog(Session)
+        finally:
+            Session.remove()
+    
+    def test_load(self):
+        catalog = self.load()
+        theme = catalog.themes.get_by_slug(u'gender')
+        character = catalog.characters.get_by_slug(u'ali')
+        location = catalog.locations.get_by_slug(u'cairo')
+        self.assertEqual(theme.character_ids, (character.id,))
+        self.assertEqual(character.location_ids, (location.id,))
+        self.assertEqual(location.theme_ids, (theme.id,))
+        self.assertEqual(catalog.themes.get_by_slug(u'sex'), None)
+        data = json.loads(catalog.body)
+        self.assertEqual(data['themes'][0]['characters'], [u'ali'])
+    
+    def test_read_only(self):
+        catalog = self.load()
+        theme = catalog.themes.get_by_slug(u'gender')
+        self.assertRaises(AttributeError, setattr, theme, 'slug', u'sex')
+        self.assertRaises(AttributeError, setattr, catalog, 'etag', 'abc')
+        by_id = catalog.themes.by_id
+        self.assertRaises(TypeError, by_id.__setitem__, 2, theme)
+        self.assertRaises(TypeError, by_id.pop, theme.id)
+        self.assertRaises(TypeError, by_id.update, {2: theme})
+        ids_by_slug = catalog.themes.ids_by_slug
+        self.assertRaises(TypeError, ids_by_slug.__delitem__, u'gender')
+        self.assertRaises(TypeError, ids_by_slug.setdefault, u'sex', 2)
+        self.assertRaises(TypeError, ids_by_slug.clear)
+        self.assertEqual(catalog.themes.get_by_slug(u'gender'), theme)
+    
+    def test_etag(self):
+        first = self.load()
+        self.assertEqual(self.load().etag, first.etag)
+        with transaction.manager:
+            Theme.query.filter_by(slug=u'gender').one().title = u'Genders'
+        self.assertNotEqual(self.load().etag, first.etag)
+    
+    def test_loads_lazily(self):
+        registry = testing.setUp().registry
+        try:
+            registry.catalog = None
+            request = testing.DummyRequest()
+            catalog = get_catalog(request)
+            self.assertEqual(len(catalog.themes), 1)
+            self.assertTrue(registry.catalog is catalog)
+            self.assertTrue(get_catalog(request) is catalog)
+        finally:
+            testing.tearDown()
+    
+    def test_conditional_gets(self):
+        registry = testing.setUp().registry
+        def get(**environ):
+            request = Request.blank('/api/catalog', environ)
+            request.registry = registry
+            return views.catalog_view(request)
+        def reload(user):
+            request = Request.blank('/api/catalog', {'REQUEST_METHOD': 'POST'})
+            request.registry = registry
+            request.user = user
+            try:
+                return views.reload_catalog_view(request)
+            finally:
+                Session.remove()
+        try:
+            registry.catalog = self.load()
+            response = get()
+            self.assertEqual(response.body, registry.catalog.body)
+            etag = response.headers['ETag']
+            self.assertEqual(etag, '"%s"' % registry.catalog.etag)
+            response = get(HTTP_IF_NONE_MATCH=etag)
+            self.assertTrue(isinstance(response, HTTPNotModified))
+            # Reloading changed data changes the etag.
+            with transaction.manager:
+                Session.add(Theme(slug=u'sex', title=u'Sex'))
+            Session.remove()
+            self.assertRaises(HTTPForbidden, reload, None)
+            self.assertTrue(isinstance(get(HTTP_IF_NONE_MATCH=etag),
+                    HTTPNotModified))
+            admin = User(username=u'admin', is_admin=True)
+            self.assertEqual(reload(admin)['themes'], 2)
+            self.assertEqual(get(HTTP_IF_NONE_MATCH=etag).status_int, 200)
+        finally:
+            testing.tearDown()
+
+
+
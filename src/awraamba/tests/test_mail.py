@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for ``MailSpool`` and ``MailDispatcher``, against a local fake
+  Postmark api.
+"""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+
+from awraamba.mail import MailDispatcher, MailSpool, PostmarkMailer
+
+class PostmarkHandler(BaseHTTPRequestHandler):
+    """Records the batches posted to it and responds with the next of the
+      ``server.statuses``, or accepts every message but those to
+      ``bad@example.com``.
+    """
+    
+    def log_message(self, *args):
+        pass
+    
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        self.server.batches.append((self.path, body))
+        if self.server.statuses:
+            self.send_response(self.server.statuses.pop(0))
+            self.end_headers()
+            self.wfile.write('{"ErrorCode": 300, "Message": "Invalid."}')
+            return
+        results = []
+        for message in body:
+            if message['To'] == 'bad@example.com':
+                results.append({'ErrorCode': 300, 'Message': 'Invalid.'})
+            else:
+                results.append({'ErrorCode': 0, 'Message': 'OK'})
+        data = json.dumps(results)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+
+class TestMailDispatcher(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spool = MailSpool(self.directory)
+        self.server = HTTPServer(('127.0.0.1', 0), PostmarkHandler)
+        self.server.batches = []
+        self.server.statuses = []
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.api_url = 'http://127.0.0.1:%d/' % self.server.server_address[1]
+    
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+    
+    def make_dispatcher(self, **kwargs):
+        return MailDispatcher(self.spool, 'KEY', api_url=self.api_url, **kwargs)
+    
+    def enqueue(self, count, to='user@example.com'):
+        mailer = PostmarkMailer('KEY', spool=self.spool)
+        for i in range(count):
+            self.assertEqual(mailer.send(sender='app@example.com', to=to,
+                    subject='Hello', text_body='Hello.'), True)
+    
+    def listdir(self, folder):
+        return os.listdir(os.path.join(self.directory, folder))
+    
+    def test_sends_in_batches(self):
+        self.enqueue(5)
+        dispatcher = self.make_dispatcher(batch_size=2)
+        counts = [dispatcher.dispatch() for i in range(4)]
+        self.assertEqual(counts, [2, 2, 1, 0])
+        self.assertEqual([len(body) for path, body in self.server.batches],
+                [2, 2, 1])
+        self.assertEqual(self.server.batches[0][0], '/email/batch')
+        stats = dispatcher.stats()
+        self.assertEqual((stats['batches'], stats['sent'], stats['depth']),
+                (3, 5, 0))
+        self.assertEqual(self.listdir('cur'), [])
+    
+    def test_batch_size_is_capped(self):
+        self.assertEqual(self.make_dispatcher(batch_size=1000).batch_size, 500)
+    
+    def test_rejected_batch_fails(self):
+        self.enqueue(2)
+        self.server.statuses.append(422)
+        dispatcher = self.make_dispatcher()
+        self.assertEqual(dispatcher.dispatch(), 2)
+        self.assertEqual(len(self.listdir('failed')), 2)
+        self.assertEqual(self.spool.depth(), 0)
+        self.assertEqual(dispatcher.stats()['failed'], 2)
+        self.assertEqual(dispatcher.dispatch(), 0)
+    
+    def test_rejected_message_fails(self):
+        self.enqueue(1)
+        self.enqueue(1, to='bad@example.com')
+        dispatcher = self.make_dispatcher()
+        dispatcher.dispatch()
+        self.assertEqual((dispatcher.sent, dispatcher.failed), (1, 1))
+        name = self.listdir('failed')[0]
+        with open(os.path.join(self.directory, 'failed', name)) as sock:
+            entry = json.load(sock)
+        self.assertEqual(entry['message']['To'], 'bad@example.com')
+        self.assertEqual(entry['error'], '300: Invalid.')
+    
+    def test_retries_with_backoff(self):
+        self.enqueue(1)
+        self.server.statuses.extend([500, 503])
+        dispatcher = self.make_dispatcher(backoff=10, max_backoff=15)
+        now = 1000
+        self.assertEqual(dispatcher.dispatch(now), 1)
+        self.assertEqual(dispatcher.dispatch(now + 9), 0)
+        self.assertEqual(dispatcher.dispatch(now + 10), 1)
+        # The delay doubles, upto ``max_backoff``.
+        self.assertEqual(dispatcher.dispatch(now + 24), 0)
+        self.assertEqual(dispatcher.dispatch(now + 25), 1)
+        stats = dispatcher.stats()
+        self.assertEqual((stats['retried'], stats['sent']), (2, 1))
+        self.assertEqual(stats['last_error'], 'HTTP 503')
+    
+    def test_fails_after_max_attempts(self):
+        self.enqueue(1)
+        self.server.statuses.extend([500, 500])
+        dispatcher = self.make_dispatcher(backoff=0, max_attempts=2)
+        dispatcher.dispatch()
+        dispatcher.dispatch()
+        self.assertEqual((dispatcher.retried, dispatcher.failed), (1, 1))
+        self.assertEqual(len(self.listdir('failed')), 1)
+    
+    def test_fresh_claims_of_old_messages_arent_recovered(self):
+        self.enqueue(1)
+        name = self.listdir('new')[0]
+        os.utime(os.path.join(self.directory, 'new', name), (0, 0))
+        self.assertEqual(self.spool.claim(1, time.time())[0][0], name)
+        self.assertEqual(self.spool.recover(60), 0)
+        self.assertEqual(self.listdir('cur'), [name])
+    
+    def test_recovers_stale_claims_on_start(self):
+        self.enqueue(2)
+        stale, fresh = self.spool.claim(2, time.time())
+        os.utime(os.path.join(self.directory, 'cur', stale[0]), (0, 0))
+        dispatcher = self.make_dispatcher(poll_interval=0.05,
+                claim_timeout=60)
+        dispatcher.start()
+        try:
+            for i in range(100):
+                if dispatcher.sent:
+                    break
+                time.sleep(0.01)
+        finally:
+            dispatcher.stop()
+        self.assertEqual(dispatcher.sent, 1)
+        # The fresh claim may belong to a live dispatcher, so is left alone.
+        self.assertEqual(self.listdir('cur'), [fresh[0]])
+
+
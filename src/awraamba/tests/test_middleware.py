@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for ``GzipMiddleware`` and ``MicroCacheMiddleware``."""
+
+import gzip
+import unittest
+import zlib
+
+from cStringIO import StringIO
+
+from awraamba.caching import LocalBackend
+from awraamba.middleware import GzipMiddleware, MicroCacheMiddleware
+
+BODY = '{"reactions": []}' * 100
+
+class FileWrapper(object):
+    """A stand-in for a server's ``wsgi.file_wrapper``."""
+    
+    def __init__(self, f, block_size=8192):
+        self.f = f
+        self.block_size = block_size
+    
+    def __iter__(self):
+        return iter(lambda: self.f.read(self.block_size), '')
+    
+    def close(self):
+        self.f.close()
+
+
+
+class DummyApp(object):
+    """Responds with ``status``, ``headers`` and ``body``, counting calls."""
+    
+    def __init__(self, status='200 OK', headers=None, body=BODY):
+        self.status = status
+        if headers is None:
+            headers = [('Content-Type', 'application/json'),
+                       ('Content-Length', str(len(body))),
+                       ('ETag', '"abc"')]
+        self.headers = headers
+        self.body = body
+        self.calls = 0
+    
+    def __call__(self, environ, start_response):
+        self.calls += 1
+        start_response(self.status, list(self.headers))
+        if environ['REQUEST_METHOD'] == 'HEAD':
+            return []
+        return [self.body]
+
+
+
+def call(app, method='GET', **environ):
+    environ.setdefault('PATH_INFO', '/api/reactions/')
+    environ.update({'REQUEST_METHOD': method, 'HTTP_HOST': 'example.com'})
+    response = {}
+    def start_response(status, headers, exc_info=None):
+        response['status'] = status
+        response['headers'] = dict((k.lower(), v) for k, v in headers)
+    app_iter = app(environ, start_response)
+    try:
+        body = ''.join(app_iter)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+    return response['status'], response['headers'], body
+
+
+def gunzip(data):
+    return gzip.GzipFile(fileobj=StringIO(data)).read()
+
+
+
+class TestGzipMiddleware(unittest.TestCase):
+    
+    def test_compresses(self):
+        app = GzipMiddleware(DummyApp())
+        status, headers, body = call(app, HTTP_ACCEPT_ENCODING='gzip, deflate')
+        self.assertEqual(gunzip(body), BODY)
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertEqual(headers['vary'], 'Accept-Encoding')
+        self.assertEqual(headers['etag'], 'W/"abc"')
+        self.assertFalse('content-length' in headers)
+        status, headers, body = call(app, HTTP_ACCEPT_ENCODING='deflate')
+        self.assertEqual(zlib.decompress(body), BODY)
+        self.assertEqual(headers['content-encoding'], 'deflate')
+    
+    def test_uncompressed_responses_vary(self):
+        app = GzipMiddleware(DummyApp())
+        for accept in (None, 'gzip;q=0', 'br'):
+            status, headers, body = call(app, HTTP_ACCEPT_ENCODING=accept)
+            self.assertEqual(body, BODY)
+            self.assertFalse('content-encoding' in headers)
+            self.assertEqual(headers['vary'], 'Accept-Encoding')
+            self.assertEqual(headers['etag'], '"abc"')
+    
+    def test_head(self):
+        app = GzipMiddleware(DummyApp())
+        status, headers, body = call(app, method='HEAD',
+                HTTP_ACCEPT_ENCODING='gzip')
+        # The headers a ``GET`` would have, without a body.
+        self.assertEqual(body, '')
+        self.assertEqual(headers['vary'], 'Accept-Encoding')
+        self.assertEqual(headers['content-encoding'], 'gzip')
+        self.assertFalse('content-length' in headers)
+    
+    def test_not_modified(self):
+        app = GzipMiddleware(DummyApp('304 Not Modified', [('ETag', '"abc"')],
+                ''))
+        status, headers, body = call(app, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(headers['vary'], 'Accept-Encoding')
+        self.assertFalse('content-encoding' in headers)
+        app = GzipMiddleware(DummyApp('304 Not Modified',
+                [('Content-Type', 'image/png'), ('Vary', 'Cookie')], ''))
+        status, headers, body = call(app, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(headers['vary'], 'Cookie')
+    
+    def test_skips(self):
+        cases = [
+            [('Content-Type', 'application/json'), ('Content-Length', '10')],
+            [('Content-Type', 'image/png')],
+            [('Content-Type', 'text/css'), ('Content-Encoding', 'br')],
+            [('Content-Type', 'text/html'), ('Cache-Control', 'no-transform')]
+        ]
+        for response_headers in cases:
+            app = GzipMiddleware(DummyApp(headers=response_headers))
+            status, headers, body = call(app, HTTP_ACCEPT_ENCODING='gzip')
+            self.assertEqual(body, BODY)
+            self.assertEqual(headers.get('content-encoding'),
+                    dict(response_headers).get('Content-Encoding'))
+
+
+
+class TestMicroCacheMiddleware(unittest.TestCase):
+    
+    def setUp(self):
+        self.backend = LocalBackend()
+        self.headers = [('Content-Type', 'application/json'),
+                        ('Cache-Control', 'public, max-age=10'),
+                        ('Vary', 'Accept-Encoding')]
+    
+    def make_app(self, app=None, max_size=65536):
+        if app is None:
+            app = DummyApp(headers=self.headers)
+        self.app = app
+        return MicroCacheMiddleware(GzipMiddleware(app), self.backend,
+                max_size=max_size)
+    
+    def test_caches_by_coding(self):
+        app = self.make_app()
+        plain = call(app)
+        self.assertEqual(call(app), plain)
+        gzipped = call(app, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(gunzip(gzipped[2]), BODY)
+        self.assertEqual(call(app, HTTP_ACCEPT_ENCODING='gzip'), gzipped)
+        self.assertEqual(self.app.calls, 2)
+    
+    def test_skips_uncacheable_requests(self):
+        app = self.make_app()
+        call(app)
+        call(app, HTTP_COOKIE='session=1')
+        call(app, HTTP_IF_NONE_MATCH='"abc"')
+        call(app, method='POST')
+        self.assertEqual(self.app.calls, 4)
+    
+    def test_skips_uncacheable_responses(self):
+        for headers in (
+                [('Cache-Control', 'public'), ('Set-Cookie', 'a=b')],
+                [('Cache-Control', 'private')],
+                [('Cache-Control', 'public'), ('Vary', 'Accept-Language')],
+                [('Content-Type', 'text/css')]):
+            app = self.make_app(DummyApp(headers=headers))
+            call(app)
+            call(app)
+            self.assertEqual(self.app.calls, 2)
+        self.assertEqual(len(self.backend), 0)
+    
+    def test_head_and_not_modified_arent_cached(self):
+        app = self.make_app()
+        call(app, method='HEAD')
+        self.assertEqual(len(self.backend), 0)
+        app = self.make_app(DummyApp('304 Not Modified', self.headers, ''))
+        call(app)
+        self.assertEqual(len(self.backend), 0)
+    
+    def test_precompressed_responses_arent_shared(self):
+        headers = [('Content-Type', 'text/css'), ('Content-Encoding', 'br'),
+                   ('Cache-Control', 'public'), ('Vary', 'Accept-Encoding')]
+        app = self.make_app(DummyApp(headers=headers, body='brotli'))
+        # The ``br`` responses to these would otherwise be stored under the
+        # keys for gzip only and identity clients.
+        call(app, HTTP_ACCEPT_ENCODING='br, gzip')
+        call(app, HTTP_ACCEPT_ENCODING='br')
+        self.assertEqual(len(self.backend), 0)
+        headers[1] = ('Content-Encoding', 'gzip')
+        call(app, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(len(self.backend), 1)
+    
+    def test_large_responses_arent_buffered(self):
+        headers = self.headers + [('Content-Length', str(len(BODY)))]
+        app = MicroCacheMiddleware(DummyApp(headers=headers), self.backend,
+                max_size=100)
+        environ = {'REQUEST_METHOD': 'GET', 'PATH_INFO': '/'}
+        self.assertEqual(app(environ, lambda *args: None), [BODY])
+        # Without a ``Content-Length``, only once they turn out too large.
+        app = self.make_app(DummyApp(headers=self.headers), max_size=100)
+        self.assertEqual(call(app)[2], BODY)
+        self.assertEqual(len(self.backend), 0)
+    
+    def test_file_wrapper_bodies_arent_buffered(self):
+        def serve_file(environ, start_response):
+            start_response('200 OK', [('Content-Type', 'image/png'),
+                    ('Cache-Control', 'public')])
+            return environ['wsgi.file_wrapper'](StringIO('png data'))
+        app = MicroCacheMiddleware(serve_file, self.backend)
+        environ = {'wsgi.file_wrapper': FileWrapper}
+        status, headers, body = call(app, **environ)
+        self.assertEqual(body, 'png data')
+        self.assertEqual(len(self.backend), 0)
+        app_iter = app(dict(environ, REQUEST_METHOD='GET'),
+                lambda *args: None)
+        self.assertTrue(isinstance(app_iter, FileWrapper))
+
+
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for ``Reaction.get_threads``, against an in memory sqlite db."""
+
+import unittest
+
+from datetime import datetime, timedelta
+
+import transaction
+
+from sqlalchemy import create_engine, event
+
+from awraamba.model import Reaction, Session
+from awraamba.tests.test_basemodel import create_tables
+
+class TestThreads(unittest.TestCase):
+    
+    def setUp(self):
+        Session.remove()
+        Session.configure(bind=create_engine('sqlite://'))
+        create_tables(Session.bind)
+        self.now = datetime(2012, 6, 1)
+        self.count = 0
+        # Three threads, the newest of which is::
+        #
+        #     root
+        #       a
+        #         aa
+        #           aaa
+        #       b
+        #       c
+        with transaction.manager:
+            self.old = self.add(u'old')
+            self.add(u'old reply', self.old)
+            self.middle = self.add(u'middle')
+            root = self.add(u'root')
+            a = self.add(u'a', root)
+            aa = self.add(u'aa', a)
+            self.add(u'aaa', aa)
+            self.add(u'b', root)
+            self.add(u'c', root)
+            self.add(u'other theme', theme_slug=u'sex')
+        Session.remove()
+    
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+    
+    def add(self, message, parent_id=None, theme_slug=u'gender'):
+        self.count += 1
+        reaction = Reaction(theme_slug=theme_slug, user_username=u'bob',
+                message=message, parent_id=parent_id, timecode=1,
+                c=self.now + timedelta(seconds=self.count))
+        Session.add(reaction)
+        Session.flush()
+        return reaction.id
+    
+    def get_threads(self, *args, **kwargs):
+        try:
+            return Reaction.get_threads(u'gender', *args, **kwargs)
+        finally:
+            Session.remove()
+    
+    def flatten(self, nodes):
+        return [(node['message'], self.flatten(node['children']))
+                for node in nodes]
+    
+    def test_threads(self):
+        threads, next_cursor = self.get_threads(10)
+        self.assertEqual(self.flatten(threads), [
+            (u'root', [
+                (u'a', [(u'aa', [(u'aaa', [])])]),
+                (u'b', []),
+                (u'c', [])
+            ]),
+            (u'middle', []),
+            (u'old', [(u'old reply', [])])
+        ])
+        self.assertEqual(next_cursor, None)
+        self.assertEqual(threads[0]['children'][0]['parent_id'],
+                threads[0]['reaction_id'])
+    
+    def test_max_depth(self):
+        threads = self.get_threads(1, max_depth=0)[0]
+        self.assertEqual(self.flatten(threads), [(u'root', [])])
+        threads = self.get_threads(1, max_depth=2)[0]
+        self.assertEqual(self.flatten(threads), [(u'root', [
+            (u'a', [(u'aa', [])]),
+            (u'b', []),
+            (u'c', [])
+        ])])
+    
+    def test_max_replies(self):
+        threads = self.get_threads(1, max_replies=2)[0]
+        self.assertEqual(self.flatten(threads), [(u'root', [
+            (u'a', [(u'aa', [(u'aaa', [])])]),
+            (u'b', [])
+        ])])
+        threads = self.get_threads(1, max_replies=0)[0]
+        self.assertEqual(self.flatten(threads), [(u'root', [])])
+    
+    def test_cursor_paging(self):
+        threads, cursor = self.get_threads(2, max_depth=0)
+        self.assertEqual(self.flatten(threads),
+                [(u'root', []), (u'middle', [])])
+        self.assertNotEqual(cursor, None)
+        threads, cursor = self.get_threads(2, cursor=cursor)
+        self.assertEqual(self.flatten(threads),
+                [(u'old', [(u'old reply', [])])])
+        self.assertEqual(cursor, None)
+        # An exactly full last page has no next cursor.
+        threads, cursor = self.get_threads(3, max_depth=0)
+        self.assertEqual(len(threads), 3)
+        self.assertEqual(cursor, None)
+    
+    def test_look_ahead_root_isnt_walked(self):
+        statements = []
+        def record(conn, cursor, statement, parameters, context, many):
+            statements.append(statement)
+        event.listen(Session.bind, 'before_cursor_execute', record)
+        threads, cursor = self.get_threads(2)
+        self.assertNotEqual(cursor, None)
+        # The thread query is anchored on the two roots in the page only.
+        self.assertTrue('reactions.id IN (?, ?)' in statements[-1])
+
+
+
@@ -0,0 +1,50 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for ``PasswordHasher``'s admission control."""
+
+import time
+import unittest
+
+from awraamba.passwords import PasswordHasher, PasswordHasherBusy
+
+def sleep(seconds):
+    """A stand-in for a slow hash, returning ``(started, seconds)``."""
+    
+    started = time.time()
+    time.sleep(seconds)
+    return started, seconds
+
+
+class TestPasswordHasher(unittest.TestCase):
+    
+    def setUp(self):
+        self.hasher = PasswordHasher()
+        self.hasher.configure(processes=1, max_waiting=1, timeout=0.1)
+        self.hasher.start()
+    
+    def tearDown(self):
+        self.hasher.close()
+    
+    def test_too_many_waiting_are_rejected(self):
+        self.assertEqual(self.hasher._call(sleep, 0), (0,))
+        self.assertRaises(PasswordHasherBusy, self.hasher._call, sleep, 0.3)
+        self.assertRaises(PasswordHasherBusy, self.hasher._call, sleep, 0.3)
+        # Both jobs are still queued or running, so there's no room for more.
+        self.assertRaises(PasswordHasherBusy, self.hasher._call, sleep, 0)
+        stats = self.hasher.stats()
+        self.assertEqual(stats['timeouts'], 2)
+        self.assertEqual(stats['rejected'], 1)
+    
+    def test_slots_are_freed_when_jobs_are_done(self):
+        self.assertRaises(PasswordHasherBusy, self.hasher._call, sleep, 0.3)
+        self.assertRaises(PasswordHasherBusy, self.hasher._call, sleep, 0.3)
+        time.sleep(0.8)
+        self.assertEqual(self.hasher._call(sleep, 0), (0,))
+    
+    def test_errors_are_raised_in_the_caller(self):
+        self.hasher.configure(processes=1, timeout=5)
+        self.assertRaises(ValueError, self.hasher.verify, u'secret', 'junk')
+        self.assertEqual(self.hasher._call(sleep, 0), (0,))
+
+
@@ -0,0 +1,165 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for ``DomainResolver``, against a local stub DNS server."""
+
+import socket
+import struct
+import threading
+import time
+import unittest
+
+import DNS
+
+from awraamba.resolver import DomainResolver
+
+# Query types.
+A = 1
+MX = 15
+
+
+class StubDNSServer(object):
+    """Answers ``A`` and ``MX`` queries for domains ending in ``good.com`` and
+      says every other domain doesn't exist, after any of the ``delays``.
+    """
+    
+    def __init__(self):
+        self.delays = {}
+        self.queries = []
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        thread = threading.Thread(target=self.serve)
+        thread.daemon = True
+        thread.start()
+    
+    def serve(self):
+        while True:
+            try:
+                data, addr = self.sock.recvfrom(512)
+            except socket.error:
+                return
+            thread = threading.Thread(target=self.reply, args=(data, addr))
+            thread.daemon = True
+            thread.start()
+    
+    def reply(self, data, addr):
+        labels = []
+        i = 12
+        while ord(data[i]):
+            length = ord(data[i])
+            labels.append(data[i + 1:i + 1 + length])
+            i += length + 1
+        name = '.'.join(labels).lower()
+        qtype = struct.unpack('>H', data[i + 1:i + 3])[0]
+        question = data[12:i + 5]
+        self.queries.append((name, qtype))
+        time.sleep(self.delays.get(name, 0))
+        if name.endswith('good.com'):
+            if qtype == A:
+                rdata = socket.inet_aton('127.0.0.2')
+            else:
+                rdata = struct.pack('>H', 10) + '\x04mail\xc0\x0c'
+            answer = '\xc0\x0c' + struct.pack('>HHIH', qtype, 1, 60,
+                    len(rdata)) + rdata
+            header = data[:2] + '\x81\x80' + struct.pack('>HHHH', 1, 1, 0, 0)
+            response = header + question + answer
+        else:
+            header = data[:2] + '\x81\x83' + struct.pack('>HHHH', 1, 0, 0, 0)
+            response = header + question
+        try:
+            self.sock.sendto(response, addr)
+        except socket.error:
+            pass
+    
+    def close(self):
+        self.sock.close()
+
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+    
+    def __call__(self):
+        return self.now
+
+
+
+class TestDomainResolver(unittest.TestCase):
+    
+    def setUp(self):
+        self.server = StubDNSServer()
+        self.port = DNS.defaults['port']
+        DNS.defaults['port'] = self.server.port
+        self.resolver = DomainResolver()
+        self.resolver.configure(servers=['127.0.0.1'], timeout=1, ttl=3600,
+                negative_ttl=300)
+        self.clock = self.resolver.cache.clock = Clock()
+    
+    def tearDown(self):
+        DNS.defaults['port'] = self.port
+        self.server.close()
+    
+    def count_queries(self, name):
+        return len([item for item in self.server.queries if item[0] == name])
+    
+    def test_resolves(self):
+        self.assertTrue(self.resolver.resolves('good.com'))
+        self.assertEqual(sorted(self.server.queries),
+                [('good.com', A), ('good.com', MX)])
+        self.assertFalse(self.resolver.resolves('nope.com'))
+    
+    def test_caches_for_ttl(self):
+        self.assertTrue(self.resolver.resolves('good.com'))
+        self.assertTrue(self.resolver.resolves('GOOD.com'))
+        self.assertEqual(self.count_queries('good.com'), 2)
+        self.clock.now += 3599
+        self.assertTrue(self.resolver.resolves('good.com'))
+        self.assertEqual(self.count_queries('good.com'), 2)
+        self.clock.now += 2
+        self.assertTrue(self.resolver.resolves('good.com'))
+        self.assertEqual(self.count_queries('good.com'), 4)
+    
+    def test_caches_failures_for_negative_ttl(self):
+        self.assertFalse(self.resolver.resolves('nope.com'))
+        self.assertFalse(self.resolver.resolves('nope.com'))
+        self.assertEqual(self.count_queries('nope.com'), 1)
+        self.clock.now += 301
+        self.assertFalse(self.resolver.resolves('nope.com'))
+        self.assertEqual(self.count_queries('nope.com'), 2)
+    
+    def test_timeout_fails_open(self):
+        self.server.delays['slow.com'] = 1
+        self.resolver.timeout = 0.2
+        started = time.time()
+        self.assertTrue(self.resolver.resolves('slow.com'))
+        self.assertTrue(time.time() - started < 0.5)
+        self.assertEqual(self.resolver.stats()['timeouts'], 1)
+    
+    def test_unreachable_server_fails_open(self):
+        # Nothing listens on port 1, so the query is refused.
+        DNS.defaults['port'] = 1
+        self.assertTrue(self.resolver.resolves('nope.com'))
+        # The failure is cached, but only for ``negative_ttl``.
+        self.assertTrue(self.resolver.resolves('nope.com'))
+        self.assertEqual(self.resolver.stats()['failures'], 1)
+        self.assertEqual(self.resolver.cache._items['nope.com'][1],
+                self.clock.now + 300)
+    
+    def test_concurrent_lookups_share_a_query(self):
+        self.server.delays['shared.good.com'] = 0.2
+        results = []
+        def resolve():
+            results.append(self.resolver.resolves('shared.good.com'))
+        threads = [threading.Thread(target=resolve) for i in range(5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, [True] * 5)
+        self.assertEqual(sorted(self.server.queries),
+                [('shared.good.com', A), ('shared.good.com', MX)])
+        self.assertEqual(self.resolver.stats()['lookups'], 1)
+
+
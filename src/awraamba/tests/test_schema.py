@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the ``Signup`` schema's uniqueness checks."""
+
+import unittest
+
+import formencode
+import transaction
+
+from sqlalchemy import create_engine
+
+from awraamba import schema
+from awraamba.model import Session, User
+from awraamba.resolver import domain_resolver
+from awraamba.tests.test_basemodel import create_tables
+
+
+class TestSignup(unittest.TestCase):
+    
+    def setUp(self):
+        Session.remove()
+        Session.configure(bind=create_engine('sqlite://'))
+        create_tables(Session.bind)
+        with transaction.manager:
+            Session.add(User(username=u'bob', email=u'bob@example.com',
+                    password=u'hash'))
+        Session.remove()
+        # Deem every domain to resolve.
+        domain_resolver.cache.set('example.com', True)
+    
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        domain_resolver.configure()
+    
+    def signup(self, **kwargs):
+        data = {
+            'username': u'alice',
+            'email': u'alice@example.com',
+            'password': u'secretpw',
+            'confirm': u'secretpw'
+        }
+        data.update(kwargs)
+        try:
+            return schema.Signup.to_python(data)
+        except formencode.Invalid as err:
+            return err.unpack_errors()
+        finally:
+            Session.remove()
+    
+    def test_valid(self):
+        self.assertEqual(self.signup(email=u' Alice@Example.com')['email'],
+                u'alice@example.com')
+    
+    def test_taken(self):
+        errors = self.signup(username=u'Bob', email=u'BOB@example.com')
+        self.assertEqual(sorted(errors), ['email', 'username'])
+        self.assertTrue('taken' in errors['username'])
+        self.assertTrue('registered' in errors['email'])
+    
+    def test_taken_is_reported_with_other_errors(self):
+        errors = self.signup(username=u'bob', confirm=u'different')
+        self.assertTrue('taken' in errors['username'])
+        self.assertTrue('confirm' in errors or 'password' in errors, errors)
+        errors = self.signup(username=u'bob', email=u'not an email')
+        self.assertTrue('taken' in errors['username'])
+        self.assertTrue('email' in errors)
+
+
+
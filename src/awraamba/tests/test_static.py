@@ -0,0 +1,329 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for ``media_view``, ``asset_view`` and the ``TourIndex``, against
+  files in a temporary static dir.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from pyramid import testing
+from pyramid.httpexceptions import HTTPFound, HTTPNotFound, HTTPNotModified
+from pyramid.request import Request
+
+from awraamba.static import IMMUTABLE, MAX_AGE, MAX_RANGES, TourIndex
+from awraamba.static import asset_view, media_view, tour_view
+from awraamba.static import versioned_tour_view
+
+DATA = ''.join(chr(i % 256) for i in range(1000))
+
+class FileWrapper(object):
+    """A stand-in for a server's ``wsgi.file_wrapper``."""
+    
+    def __init__(self, f, block_size=8192):
+        self.f = f
+        self.block_size = block_size
+
+
+
+def read(response):
+    app_iter = response.app_iter
+    try:
+        return ''.join(app_iter)
+    finally:
+        if hasattr(app_iter, 'close'):
+            app_iter.close()
+
+
+class TestMediaView(unittest.TestCase):
+    
+    def setUp(self):
+        self.config = testing.setUp()
+        self.directory = tempfile.mkdtemp()
+        self.config.registry.static_path = self.directory
+        os.mkdir(os.path.join(self.directory, 'videos'))
+        with open(os.path.join(self.directory, 'videos', 'clip.mp4'), 'wb') as f:
+            f.write(DATA)
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        testing.tearDown()
+    
+    def get(self, subpath=('clip.mp4',), **environ):
+        request = Request.blank('/static/videos/%s' % '/'.join(subpath),
+                environ)
+        request.registry = self.config.registry
+        request.matchdict = {'subpath': subpath}
+        return media_view(request)
+    
+    def test_whole_file(self):
+        response = self.get()
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.content_type, 'video/mp4')
+        self.assertEqual(response.accept_ranges, 'bytes')
+        self.assertEqual(response.content_length, 1000)
+        self.assertEqual(read(response), DATA)
+        for subpath in (('missing.mp4',), ('..', 'videos', 'clip.mp4'), ()):
+            self.assertRaises(HTTPNotFound, self.get, subpath)
+    
+    def test_ranges(self):
+        for header, start, stop in (('bytes=100-199', 100, 200),
+                ('bytes=900-', 900, 1000), ('bytes=-100', 900, 1000),
+                ('bytes=990-2000', 990, 1000), ('bytes=0-9, 5-14', 0, 15)):
+            response = self.get(HTTP_RANGE=header)
+            self.assertEqual(response.status_int, 206)
+            self.assertEqual(response.headers['Content-Range'],
+                    'bytes %d-%d/1000' % (start, stop - 1))
+            self.assertEqual(response.content_length, stop - start)
+            self.assertEqual(read(response), DATA[start:stop])
+    
+    def test_invalid_ranges(self):
+        # Malformed headers are ignored.
+        for header in ('bytes=abc', 'items=0-9', 'bytes=9-0', 'bytes=1'):
+            response = self.get(HTTP_RANGE=header)
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(read(response), DATA)
+        # As are too many ranges.
+        header = 'bytes=' + ','.join('%d-%d' % (i * 10, i * 10)
+                for i in range(MAX_RANGES + 1))
+        self.assertEqual(self.get(HTTP_RANGE=header).status_int, 200)
+        response = self.get(HTTP_RANGE='bytes=1000-')
+        self.assertEqual(response.status_int, 416)
+        self.assertEqual(response.headers['Content-Range'], 'bytes */1000')
+        self.assertEqual(response.body, '')
+    
+    def test_if_range(self):
+        response = self.get()
+        read(response)
+        etag = response.headers['ETag']
+        last_modified = response.headers['Last-Modified']
+        for value in (etag, last_modified):
+            response = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=value)
+            self.assertEqual(response.status_int, 206)
+            self.assertEqual(read(response), DATA[:10])
+        # If the file has changed, the whole of it is sent.
+        for value in ('"other"', 'Fri, 01 Jun 2012 12:00:00 GMT'):
+            response = self.get(HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE=value)
+            self.assertEqual(response.status_int, 200)
+            self.assertEqual(read(response), DATA)
+        response = self.get(HTTP_IF_NONE_MATCH=etag)
+        self.assertTrue(isinstance(response, HTTPNotModified))
+    
+    def test_multiple_ranges(self):
+        response = self.get(HTTP_RANGE='bytes=20-29,0-9,5-14,-10')
+        self.assertEqual(response.status_int, 206)
+        content_type, boundary = response.headers['Content-Type'].split('; ')
+        self.assertEqual(content_type, 'multipart/byteranges')
+        boundary = boundary[len('boundary='):]
+        body = read(response)
+        self.assertEqual(response.content_length, len(body))
+        parts = body.split('--%s' % boundary)
+        self.assertEqual(parts[0], '')
+        self.assertEqual(parts[-1], '--\r\n')
+        expected = [(0, 15), (20, 30), (990, 1000)]
+        self.assertEqual(len(parts[1:-1]), len(expected))
+        for part, (start, stop) in zip(parts[1:-1], expected):
+            headers, data = part.split('\r\n\r\n', 1)
+            self.assertEqual(headers.split('\r\n')[1:], [
+                'Content-Type: video/mp4',
+                'Content-Range: bytes %d-%d/1000' % (start, stop - 1)
+            ])
+            self.assertEqual(data, DATA[start:stop] + '\r\n')
+    
+    def test_file_wrapper(self):
+        response = self.get(HTTP_RANGE='bytes=100-199',
+                **{'wsgi.file_wrapper': FileWrapper})
+        wrapper = response.app_iter
+        try:
+            # The server sends ``Content-Length`` bytes from the file's
+            # position.
+            self.assertTrue(isinstance(wrapper, FileWrapper))
+            self.assertEqual(wrapper.f.tell(), 100)
+            self.assertEqual(response.content_length, 100)
+        finally:
+            wrapper.f.close()
+
+
+
+class TestAssetView(unittest.TestCase):
+    
+    def setUp(self):
+        self.config = testing.setUp()
+        self.directory = tempfile.mkdtemp()
+        self.config.registry.static_path = self.directory
+        for ext, data in (('', 'css'), ('.gz', 'gzipped'), ('.br', 'brotli')):
+            with open(self.path(ext), 'wb') as f:
+                f.write(data)
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+        testing.tearDown()
+    
+    def path(self, ext=''):
+        return os.path.join(self.directory, 'app.css' + ext)
+    
+    def get(self, accept_encoding=None, filename='app.css', **environ):
+        if accept_encoding is not None:
+            environ['HTTP_ACCEPT_ENCODING'] = accept_encoding
+        request = Request.blank('/static/%s' % filename, environ)
+        request.registry = self.config.registry
+        request.matchdict = {'filename': filename}
+        return asset_view(request)
+    
+    def test_negotiation(self):
+        for accept_encoding, encoding, body in (
+                ('gzip, deflate, br', 'br', 'brotli'),
+                ('gzip, br;q=0', 'gzip', 'gzipped'),
+                ('gzip', 'gzip', 'gzipped'),
+                ('deflate', None, 'css'),
+                ('identity', None, 'css'),
+                (None, None, 'css')):
+            response = self.get(accept_encoding)
+            self.assertEqual(response.content_encoding, encoding)
+            self.assertEqual(read(response), body)
+            self.assertEqual(response.content_type, 'text/css')
+            self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+            self.assertEqual(response.cache_control.max_age, MAX_AGE)
+        # Each variant has its own etag.
+        etags = set(self.get(accept_encoding).etag
+                for accept_encoding in ('br', 'gzip', None))
+        self.assertEqual(len(etags), 3)
+    
+    def test_missing_and_stale_variants(self):
+        os.remove(self.path('.br'))
+        self.assertEqual(self.get('br, gzip').content_encoding, 'gzip')
+        # Variants older than the file are ignored.
+        os.utime(self.path('.gz'), (0, 0))
+        response = self.get('br, gzip')
+        self.assertEqual(response.content_encoding, None)
+        self.assertEqual(read(response), 'css')
+        for filename in ('missing.css', '.hidden'):
+            self.assertRaises(HTTPNotFound, self.get, filename=filename)
+    
+    def test_not_modified(self):
+        response = self.get('br')
+        read(response)
+        response = self.get('br', HTTP_IF_NONE_MATCH=response.headers['ETag'])
+        self.assertTrue(isinstance(response, HTTPNotModified))
+        self.assertEqual(response.headers['Vary'], 'Accept-Encoding')
+        self.assertTrue(response.cache_control.public)
+        self.assertEqual(response.cache_control.no_cache, None)
+        # Another variant's etag doesn't match.
+        response = self.get('gzip', HTTP_IF_NONE_MATCH=response.headers['ETag'])
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(read(response), 'gzipped')
+
+
+
+class TestTourIndex(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.tour_dir = os.path.join(self.directory, 'tour')
+        self.index_file = os.path.join(self.directory, 'tour-index.json')
+        os.makedirs(os.path.join(self.tour_dir, 'tiles'))
+        self.write('tour.xml', '<krpano />')
+        self.write('tiles/a.jpg', 'a')
+        self.write('tiles/b.jpg', 'b')
+        self.write('.DS_Store', 'hidden')
+        self.hashed = []
+    
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+    
+    def write(self, name, data, mtime=1000000000):
+        path = os.path.join(self.tour_dir, *name.split('/'))
+        with open(path, 'wb') as f:
+            f.write(data)
+        os.utime(path, (mtime, mtime))
+    
+    def load(self):
+        """Load a new index, recording the files it hashes."""
+        
+        index = TourIndex(self.tour_dir, self.index_file)
+        hash_file = index.hash_file
+        def record(path):
+            self.hashed.append(os.path.basename(path))
+            return hash_file(path)
+        index.hash_file = record
+        return index.load()
+    
+    def test_load(self):
+        index = self.load()
+        self.assertEqual(sorted(index.files),
+                ['tiles/a.jpg', 'tiles/b.jpg', 'tour.xml'])
+        self.assertEqual(len(index.version), 12)
+        self.assertEqual(sorted(self.hashed), ['a.jpg', 'b.jpg', 'tour.xml'])
+        path, digest = index.get_path(('tiles', 'a.jpg'))
+        self.assertEqual(path, os.path.join(self.tour_dir, 'tiles', 'a.jpg'))
+        self.assertEqual(digest, index.files['tiles/a.jpg'][2])
+        for subpath in (('.DS_Store',), ('tiles', 'c.jpg'), ('..', 'tour')):
+            self.assertEqual(index.get_path(subpath), (None, None))
+    
+    def test_only_changed_files_are_rehashed(self):
+        version = self.load().version
+        self.hashed = []
+        self.assertEqual(self.load().version, version)
+        self.assertEqual(self.hashed, [])
+        # A changed size or mtime is rehashed.
+        self.write('tiles/a.jpg', 'aa')
+        self.write('tiles/b.jpg', 'c', mtime=1000000001)
+        index = self.load()
+        self.assertEqual(sorted(self.hashed), ['a.jpg', 'b.jpg'])
+        self.assertNotEqual(index.version, version)
+        # As are new files, and removing a file changes the version.
+        self.hashed = []
+        version = index.version
+        self.write('tiles/c.jpg', 'c')
+        os.remove(os.path.join(self.tour_dir, 'tiles', 'a.jpg'))
+        index = self.load()
+        self.assertEqual(self.hashed, ['c.jpg'])
+        self.assertNotEqual(index.version, version)
+        self.assertFalse('tiles/a.jpg' in index.files)
+    
+    def test_invalid_index_file(self):
+        version = self.load().version
+        with open(self.index_file, 'wb') as f:
+            f.write('{"files"')
+        self.hashed = []
+        self.assertEqual(self.load().version, version)
+        self.assertEqual(len(self.hashed), 3)
+        self.hashed = []
+        self.load()
+        self.assertEqual(self.hashed, [])
+    
+    def test_views(self):
+        config = testing.setUp()
+        try:
+            index = config.registry.tour_index = self.load()
+            def get(view, version=None, *subpath, **environ):
+                request = Request.blank('/tour/', environ)
+                request.registry = config.registry
+                request.matchdict = {'version': version, 'subpath': subpath}
+                return view(request)
+            response = get(versioned_tour_view, index.version, 'tiles', 'a.jpg')
+            self.assertEqual(read(response), 'a')
+            self.assertEqual(response.headers['Cache-Control'], IMMUTABLE)
+            # Entry documents are revalidated, even at versioned urls.
+            response = get(versioned_tour_view, index.version, 'tour.xml')
+            self.assertTrue(response.cache_control.no_cache)
+            read(response)
+            response = get(tour_view, None, 'tour.xml',
+                    HTTP_IF_NONE_MATCH=response.headers['ETag'])
+            self.assertTrue(isinstance(response, HTTPNotModified))
+            # Old versions redirect to the current one.
+            try:
+                get(versioned_tour_view, 'old', 'tiles', 'a.jpg')
+            except HTTPFound as err:
+                self.assertEqual(err.location,
+                        '/tour/%s/tiles/a.jpg' % index.version)
+            else:
+                self.fail('Not redirected.')
+        finally:
+            testing.tearDown()
+
+
+
@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for ``Thumbnailer``, fetching images from a local HTTP server."""
+
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from BaseHTTPServer import BaseHTTPRequestHandler
+from cStringIO import StringIO
+from SocketServer import ThreadingTCPServer
+
+from awraamba.thumbnails import Image, ThumbnailError, Thumbnailer
+from awraamba.thumbnails import read_limited, run_job
+
+def encode(size, fmt='PNG'):
+    buf = StringIO()
+    Image.new('RGB', size, 'red').save(buf, fmt)
+    return buf.getvalue()
+
+
+class ImageHandler(BaseHTTPRequestHandler):
+    """Serves the ``server.images``, optionally without a ``Content-Length``,
+      after waiting for ``server.release`` to be set.
+    """
+    
+    def log_message(self, *args):
+        pass
+    
+    def do_GET(self):
+        self.server.release.wait(10)
+        path, _, query = self.path.partition('?')
+        data = self.server.images.get(path)
+        if data is None:
+            self.send_response(404)
+            self.end_headers()
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', 'image/png')
+        if query != 'chunked':
+            self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+
+class TestThumbnailer(unittest.TestCase):
+    
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = ThreadingTCPServer(('127.0.0.1', 0), ImageHandler)
+        self.server.daemon_threads = True
+        self.server.release = threading.Event()
+        self.server.release.set()
+        self.server.images = {
+            '/small.png': encode((300, 200)),
+            '/large.png': encode((2000, 1500)),
+            '/big.bmp': encode((200, 200), 'BMP')
+        }
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base_url = 'http://127.0.0.1:%d' % self.server.server_address[1]
+        self.thumbnailer = None
+    
+    def tearDown(self):
+        self.server.release.set()
+        if self.thumbnailer is not None:
+            self.thumbnailer.close()
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.directory)
+    
+    def make_job(self, url, max_bytes=1000000, max_pixels=1000000):
+        path = os.path.join(self.directory, 'thumb.png')
+        return (hashlib.md5(url).hexdigest(), url, None, path, None, (100, 100),
+                max_bytes, max_pixels, 5)
+    
+    def test_fetches_and_thumbnails(self):
+        job = self.make_job(self.base_url + '/small.png')
+        self.assertEqual(run_job(job), (job[0], None))
+        self.assertEqual(Image.open(job[3]).size[0], 100)
+    
+    def test_byte_limit(self):
+        self.assertRaises(ThumbnailError, read_limited,
+                StringIO('x' * 101), 100)
+        self.assertEqual(read_limited(StringIO('x' * 100), 100), 'x' * 100)
+        # Rejected by its ``Content-Length`` and, without one, as it's read.
+        for query in ('', '?chunked'):
+            job = self.make_job(self.base_url + '/big.bmp' + query,
+                    max_bytes=50000)
+            digest, error = run_job(job)
+            self.assertTrue('larger than 50000 bytes' in error)
+            self.assertFalse(os.path.exists(job[3]))
+    
+    def test_uploads_over_the_byte_limit_are_rejected(self):
+        self.thumbnailer = Thumbnailer(self.directory, processes=1,
+                max_bytes=100)
+        self.assertRaises(ThumbnailError, self.thumbnailer.submit_file,
+                StringIO('x' * 101))
+        self.assertEqual(self.thumbnailer.submitted, 0)
+    
+    def test_pixel_limit(self):
+        job = self.make_job(self.base_url + '/large.png', max_pixels=1000000)
+        digest, error = run_job(job)
+        self.assertTrue('larger than 1000000 pixels' in error)
+        job = self.make_job(self.base_url + '/large.png', max_pixels=3000000)
+        self.assertEqual(run_job(job), (job[0], None))
+    
+    def test_only_http_urls(self):
+        self.thumbnailer = Thumbnailer(self.directory, processes=1)
+        for url in (u'file:///etc/passwd', u'ftp://example.com/a.png',
+                u'/small.png'):
+            self.assertRaises(ThumbnailError, self.thumbnailer.submit_url, url)
+        self.assertEqual(self.thumbnailer.submitted, 0)
+    
+    def test_max_pending(self):
+        self.thumbnailer = Thumbnailer(self.directory, processes=1,
+                max_pending=2)
+        self.thumbnailer.start()
+        self.server.release.clear()
+        first = self.thumbnailer.submit_url(self.base_url + '/small.png')
+        second = self.thumbnailer.submit_url(self.base_url + '/small.png?2')
+        # Already pending, so deduplicated rather than rejected.
+        self.assertEqual(self.thumbnailer.submit_url(
+                self.base_url + '/small.png'), first)
+        self.assertRaises(ThumbnailError, self.thumbnailer.submit_url,
+                self.base_url + '/small.png?3')
+        stats = self.thumbnailer.stats()
+        self.assertEqual(stats['pending'], 2)
+        self.assertEqual(stats['deduplicated'], 1)
+        self.assertEqual(stats['rejected'], 1)
+        self.server.release.set()
+        self.thumbnailer.close()
+        self.assertEqual(self.thumbnailer.stats()['completed'], 2)
+        for digest in (first, second):
+            self.assertFalse(self.thumbnailer.is_pending(digest))
+            self.assertTrue(os.path.exists(self.thumbnailer.get_path(digest)))
+
+
@@ -0,0 +1,555 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Tests for the views."""
+
+import json
+import unittest
+import urllib
+
+from datetime import datetime, timedelta
+
+import transaction
+
+from pyramid import testing
+from pyramid.httpexceptions import HTTPBadRequest, HTTPNotModified
+from pyramid.request import Request
+from pyramid_assetgen import IAssetGenManifest
+from sqlalchemy import create_engine, event
+
+from awraamba import views
+from awraamba.caching import LRUCache, SingleFlight
+from awraamba.catalog import load_catalog
+from awraamba.model import Reaction, Session, Theme
+from awraamba.tests.test_basemodel import create_tables
+
+def make_request(registry, path, params=None, **environ):
+    if params:
+        path += '?' + urllib.urlencode(params)
+    request = Request.blank(path, environ)
+    request.registry = registry
+    return request
+
+
+def add_theme_reactions(registry, *timecodes):
+    """Add a theme with reactions at ``timecodes``, returning their ids, and
+      configure the ``registry`` to serve them.
+    """
+    
+    ids = []
+    with transaction.manager:
+        Session.add(Theme(slug=u'gender', title=u'Gender'))
+        for i, timecode in enumerate(timecodes):
+            reaction = Reaction(theme_slug=u'gender', user_username=u'bob',
+                    message=u'%d' % i, timecode=timecode)
+            Session.add(reaction)
+            Session.flush()
+            ids.append(reaction.id)
+    registry.catalog = load_catalog(Session)
+    Session.remove()
+    sizeof = lambda entry: len(entry[0])
+    registry.reactions_cache = LRUCache(1000000, sizeof=sizeof)
+    registry.single_flight = SingleFlight()
+    return ids
+
+
+class DummyManifest(object):
+    _data = {'app.js': 'app-1234.js'}
+
+
+
+class DummyTourIndex(object):
+    version = 'v1'
+
+
+
+class TestAppView(unittest.TestCase):
+    
+    def setUp(self):
+        self.config = testing.setUp()
+        registry = self.config.registry
+        registry.registerUtility(DummyManifest(), IAssetGenManifest,
+                'awraamba:assets/')
+        registry.shell_cache = LRUCache(1000000)
+        registry.tour_index = DummyTourIndex()
+        self.renders = 0
+        self._render = views.render
+        views.render = self.render
+    
+    def tearDown(self):
+        views.render = self._render
+        testing.tearDown()
+    
+    def render(self, template, values, request=None):
+        """Render a form field from ``request.params``, as ``macros.mako``
+          does, and the csrf token.
+        """
+        
+        self.renders += 1
+        return u'<input name="message" value="%s" /><input value="%s" />' % (
+                request.params.get('message', u''), values['csrf_token'])
+    
+    def get(self, params=None):
+        request = make_request(self.config.registry, '/themes', params)
+        request.session = testing.DummySession()
+        request.is_authenticated = False
+        request.user = None
+        return views.app_view(request)
+    
+    def test_caches_the_shell(self):
+        first = self.get()
+        second = self.get()
+        self.assertEqual(self.renders, 1)
+        self.assertEqual(first.body, second.body)
+        self.assertFalse(views.CSRF_PLACEHOLDER in first.body)
+    
+    def test_query_strings_dont_reach_other_shells(self):
+        poisoned = self.get({'message': u'<b>Poisoned</b>'})
+        self.assertTrue('<b>Poisoned</b>' in poisoned.body)
+        self.assertFalse('Poisoned' in self.get().body)
+        self.assertFalse('Poisoned' in self.get().body)
+        self.assertFalse('Poisoned' in self.get({'message': u'x'}).body)
+        self.assertEqual(len(self.config.registry.shell_cache), 1)
+
+
+
+class TestConditionalGet(unittest.TestCase):
+    
+    def setUp(self):
+        self.config = testing.setUp()
+        self.modified = datetime(2012, 6, 1, 12, 0, 0, 500)
+    
+    def tearDown(self):
+        testing.tearDown()
+    
+    def request(self, **environ):
+        return make_request(self.config.registry, '/api/reactions/',
+                **environ)
+    
+    def test_is_not_modified(self):
+        is_not_modified = lambda request: views.is_not_modified(request,
+                'abc', self.modified)
+        self.assertFalse(is_not_modified(self.request()))
+        self.assertTrue(is_not_modified(self.request(
+                HTTP_IF_NONE_MATCH='"xyz", "abc"')))
+        self.assertTrue(is_not_modified(self.request(HTTP_IF_NONE_MATCH='*')))
+        self.assertFalse(is_not_modified(self.request(
+                HTTP_IF_NONE_MATCH='"xyz"')))
+        # Dates are compared to the second.
+        self.assertTrue(is_not_modified(self.request(
+                HTTP_IF_MODIFIED_SINCE='Fri, 01 Jun 2012 12:00:00 GMT')))
+        self.assertFalse(is_not_modified(self.request(
+                HTTP_IF_MODIFIED_SINCE='Fri, 01 Jun 2012 11:59:59 GMT')))
+        # ``If-None-Match`` takes precedence.
+        self.assertFalse(is_not_modified(self.request(
+                HTTP_IF_NONE_MATCH='"xyz"',
+                HTTP_IF_MODIFIED_SINCE='Fri, 01 Jun 2012 12:00:00 GMT')))
+    
+    def test_json_response(self):
+        response = views.json_response(self.request(), '[]', 'abc',
+                self.modified)
+        self.assertEqual(response.status_int, 200)
+        self.assertEqual(response.body, '[]')
+        self.assertEqual(response.headers['ETag'], '"abc"')
+        self.assertEqual(response.headers['Last-Modified'],
+                'Fri, 01 Jun 2012 12:00:00 GMT')
+        self.assertTrue(response.cache_control.no_cache)
+        response = views.json_response(self.request(
+                HTTP_IF_NONE_MATCH='"abc"'), '[]', 'abc', self.modified)
+        self.assertTrue(isinstance(response, HTTPNotModified))
+        self.assertEqual(response.headers['ETag'], '"abc"')
+        self.assertEqual(response.headers['Last-Modified'],
+                'Fri, 01 Jun 2012 12:00:00 GMT')
+    
+    def test_reactions(self):
+        Session.remove()
+        Session.configure(bind=create_engine('sqlite://'))
+        create_tables(Session.bind)
+        def get(etag=None, **params):
+            environ = {}
+            if etag:
+                environ['HTTP_IF_NONE_MATCH'] = etag
+            request = make_request(self.config.registry, '/api/reactions/',
+                    params, **environ)
+            try:
+                response = views.get_reactions_view(request)
+                if isinstance(response, HTTPNotModified):
+                    return None
+                return request.response.headers['ETag']
+            finally:
+                transaction.abort()
+                Session.remove()
+        def change(f):
+            with transaction.manager:
+                f()
+            Session.remove()
+        try:
+            etag = get()
+            self.assertEqual(get(etag), None)
+            change(lambda: Session.add(Reaction(theme_slug=u'gender',
+                    user_username=u'bob', message=u'1', timecode=1)))
+            self.assertNotEqual(get(etag), None)
+            etag = get()
+            self.assertEqual(get(etag), None)
+            # Each page has its own validator.
+            self.assertNotEqual(get(etag, limit=1), None)
+            def edit():
+                Reaction.query.get(1).message = u'2'
+            change(edit)
+            self.assertNotEqual(get(etag), None)
+            etag = get()
+            change(lambda: Session.delete(Reaction.query.get(1)))
+            self.assertNotEqual(get(etag), None)
+        finally:
+            transaction.abort()
+            Session.remove()
+
+
+
+class TestReactionPages(unittest.TestCase):
+    
+    def setUp(self):
+        self.config = testing.setUp()
+        Session.remove()
+        Session.configure(bind=create_engine('sqlite://'))
+        create_tables(Session.bind)
+        with transaction.manager:
+            for i in range(5):
+                Session.add(Reaction(theme_slug=u'gender', timecode=i,
+                        user_username=u'bob', message=u'%d' % i,
+                        c=datetime(2012, 6, 1, 12, 0, i // 2)))
+        Session.remove()
+    
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+    
+    def get(self, **params):
+        request = make_request(self.config.registry, '/api/reactions/',
+                params)
+        try:
+            return views.get_reactions_view(request)
+        finally:
+            transaction.abort()
+            Session.remove()
+    
+    def test_pages(self):
+        pages = []
+        cursor = ''
+        while cursor is not None:
+            page = self.get(limit=2, cursor=cursor)
+            pages.append([item['message'] for item in page['items']])
+            cursor = page['next']
+        self.assertEqual(pages, [[u'4', u'3'], [u'2', u'1'], [u'0']])
+    
+    def test_invalid_cursors(self):
+        for cursor in ('not a cursor', 'garbage'):
+            self.assertRaises(HTTPBadRequest, self.get, cursor=cursor)
+
+
+
+class DummyHub(object):
+    
+    def __init__(self):
+        self.published = []
+    
+    def publish(self, name, event, data, id=None):
+        self.published.append((name, event, id))
+
+
+
+class DummyUser(object):
+    username = u'bob'
+
+
+
+class TestReactionCache(unittest.TestCase):
+    
+    def setUp(self):
+        self.config = testing.setUp()
+        Session.remove()
+        Session.configure(bind=create_engine('sqlite://'))
+        create_tables(Session.bind)
+        self.registry = self.config.registry
+        add_theme_reactions(self.registry, 1, 2)
+        self.registry.live_hub = DummyHub()
+        self.cache = self.registry.reactions_cache
+    
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+    
+    def get(self):
+        request = make_request(self.registry, '/api/reactions/',
+                {'theme_slug': u'gender'})
+        try:
+            body = views.get_reactions_view(request).body
+            return [item['message'] for item in json.loads(body)['items']]
+        finally:
+            transaction.abort()
+            Session.remove()
+    
+    def post(self, commit=True):
+        request = make_request(self.registry, '/api/reactions/',
+                {'theme_slug': u'gender', 'timecode': 3, 'message': u'New'},
+                REQUEST_METHOD='POST')
+        request.user = DummyUser()
+        try:
+            reaction_id = views.post_reaction_view(request)['reaction_id']
+            if commit:
+                transaction.commit()
+            return reaction_id
+        finally:
+            transaction.abort()
+            Session.remove()
+    
+    def test_pages_are_cached(self):
+        self.assertEqual(self.get(), [u'1', u'0'])
+        self.assertEqual(self.get(), [u'1', u'0'])
+        self.assertEqual((self.cache.hits, len(self.cache)), (1, 1))
+    
+    def test_new_reactions_invalidate(self):
+        self.get()
+        reaction_id = self.post()
+        self.assertEqual(len(self.cache), 0)
+        self.assertEqual(self.get(), [u'New', u'1', u'0'])
+        self.assertEqual(self.registry.live_hub.published,
+                [(u'gender', 'reaction', reaction_id)])
+    
+    def test_aborted_reactions_dont_invalidate(self):
+        self.get()
+        self.post(commit=False)
+        self.assertEqual(len(self.cache), 1)
+        self.assertEqual(self.registry.live_hub.published, [])
+
+
+
+class TestTimecodeWindows(unittest.TestCase):
+    
+    def setUp(self):
+        self.config = testing.setUp()
+        Session.remove()
+        Session.configure(bind=create_engine('sqlite://'))
+        create_tables(Session.bind)
+        self.ids = add_theme_reactions(self.config.registry, 6, 3, 0, 4.5,
+                1.5, 3)
+    
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+    
+    def get(self, **params):
+        params.setdefault('theme_slug', u'gender')
+        request = make_request(self.config.registry, '/api/reactions/',
+                params)
+        try:
+            return json.loads(views.get_reactions_view(request).body)
+        finally:
+            transaction.abort()
+            Session.remove()
+    
+    def timecodes(self, **params):
+        return [item['timecode'] for item in self.get(**params)['items']]
+    
+    def test_windows(self):
+        # Windows include their start but not their end.
+        self.assertEqual(self.timecodes(timecode_from=1.5, timecode_to=4.5),
+                [1.5, 3, 3])
+        self.assertEqual(self.timecodes(timecode_from=3), [3, 3, 4.5, 6])
+        self.assertEqual(self.timecodes(timecode_to=3), [0, 1.5])
+        self.assertEqual(self.timecodes(timecode_from=7), [])
+    
+    def test_window_pages(self):
+        page = self.get(timecode_from=1, limit=2)
+        self.assertEqual([item['timecode'] for item in page['items']],
+                [1.5, 3])
+        page = self.get(timecode_from=1, limit=2, cursor=page['next'])
+        # The pages split the reactions at 3, which are ordered by id.
+        self.assertEqual([item['reaction_id'] for item in page['items']],
+                [self.ids[5], self.ids[3]])
+        page = self.get(timecode_from=1, limit=2, cursor=page['next'])
+        self.assertEqual([item['timecode'] for item in page['items']], [6])
+        self.assertEqual(page['next'], None)
+    
+    def test_invalid_windows(self):
+        self.assertRaises(HTTPBadRequest, self.get, theme_slug=u'',
+                timecode_from=1)
+        self.assertRaises(HTTPBadRequest, self.get, timecode_from=3,
+                timecode_to=3)
+        self.assertRaises(HTTPBadRequest, self.get, timecode_from=-1)
+
+
+
+class TestReactionDeltas(unittest.TestCase):
+    
+    def setUp(self):
+        self.config = testing.setUp()
+        Session.remove()
+        Session.configure(bind=create_engine('sqlite://'))
+        create_tables(Session.bind)
+        self.now = datetime.utcnow().replace(microsecond=0)
+    
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+    
+    def add(self, *ages):
+        """Add reactions last modified ``ages`` seconds ago, returning their
+          ids.
+        """
+        
+        ids = []
+        with transaction.manager:
+            for age in ages:
+                when = self.now - timedelta(seconds=age)
+                reaction = Reaction(theme_slug=u'gender', user_username=u'bob',
+                        message=u'%d' % age, timecode=1, c=when, m=when)
+                Session.add(reaction)
+                Session.flush()
+                ids.append(reaction.id)
+        Session.remove()
+        return ids
+    
+    def delete(self, reaction_id):
+        with transaction.manager:
+            Session.delete(Reaction.query.get(reaction_id))
+        Session.remove()
+    
+    def get(self, since, **params):
+        params['since'] = since.isoformat()
+        etag = params.pop('etag', None)
+        environ = {}
+        if etag:
+            environ['HTTP_IF_NONE_MATCH'] = etag
+        request = make_request(self.config.registry, '/api/reactions/',
+                params, **environ)
+        try:
+            return views.get_reactions_view(request), request.response.etag
+        finally:
+            transaction.abort()
+            Session.remove()
+    
+    def sync(self, since, limit=100):
+        """Follow the pages of changes ``since`` a watermark, returning the
+          ids changed, the ids deleted and the new watermark.
+        """
+        
+        changed, deleted, cursor = [], [], None
+        while True:
+            page = self.get(since, limit=limit, cursor=cursor or '')[0]
+            changed.extend(item['reaction_id'] for item in page['items'])
+            deleted.extend(page['deleted'])
+            cursor = page['next']
+            if cursor is None:
+                return changed, deleted, page['watermark']
+    
+    def test_changes_since(self):
+        old, overlapping, new, newer = self.add(300, 100, 30, 10)
+        since = self.now - timedelta(seconds=60)
+        changed, deleted, watermark = self.sync(since)
+        # The changes in the overlap before ``since`` are sent again.
+        self.assertEqual(changed, [overlapping, new, newer])
+        self.assertEqual(deleted, [])
+        self.assertEqual(watermark,
+                (self.now - timedelta(seconds=10)).isoformat())
+    
+    def test_watermark_doesnt_go_back(self):
+        self.add(100)
+        since = self.now - timedelta(seconds=60)
+        self.assertEqual(self.sync(since)[2], since.isoformat())
+    
+    def test_late_commits_arent_missed(self):
+        self.add(10)
+        watermark = self.sync(self.now - timedelta(seconds=60))[2]
+        since = datetime.strptime(watermark, '%Y-%m-%dT%H:%M:%S')
+        # Flushed before the watermark was given out, committed after.
+        late, = self.add(20)
+        self.assertTrue(late in self.sync(since)[0])
+    
+    def test_tombstones(self):
+        first, second = self.add(30, 20)
+        since = self.now - timedelta(seconds=60)
+        page, etag = self.get(since)
+        self.delete(first)
+        # Deleting a reaction changes the delta.
+        response = self.get(since, etag=etag)[0]
+        self.assertFalse(isinstance(response, HTTPNotModified))
+        self.assertEqual(response['deleted'], [first])
+        self.assertEqual([item['reaction_id'] for item in response['items']],
+                [second])
+        self.assertTrue(response['watermark'] > self.now.isoformat())
+        etag = self.get(since)[1]
+        response = self.get(since, etag=etag)[0]
+        self.assertTrue(isinstance(response, HTTPNotModified))
+    
+    def test_multiple_pages(self):
+        ids = self.add(50, 40, 30, 20, 10)
+        self.delete(ids[0])
+        since = self.now - timedelta(seconds=60)
+        first = self.get(since, limit=2)[0]
+        self.assertEqual(first['deleted'], [ids[0]])
+        second = self.get(since, limit=2, cursor=first['next'])[0]
+        # Tombstones come with the first page only.
+        self.assertEqual(second['deleted'], [])
+        changed, deleted, watermark = self.sync(since, limit=2)
+        self.assertEqual(changed, ids[1:])
+        self.assertEqual(deleted, [ids[0]])
+        self.assertEqual(watermark,
+                (self.now - timedelta(seconds=10)).isoformat())
+
+
+
+class TestReactionStreams(unittest.TestCase):
+    
+    def setUp(self):
+        self.config = testing.setUp()
+        Session.remove()
+        Session.configure(bind=create_engine('sqlite://'))
+        create_tables(Session.bind)
+        with transaction.manager:
+            for i in range(3):
+                Session.add(Reaction(theme_slug=u'gender', timecode=i,
+                        user_username=u'bob', message=u'%d' % i))
+        Session.remove()
+        self.checked_out = 0
+        def checkout(*args):
+            self.checked_out += 1
+        def checkin(*args):
+            self.checked_out -= 1
+        event.listen(Session.bind, 'checkout', checkout)
+        event.listen(Session.bind, 'checkin', checkin)
+    
+    def tearDown(self):
+        transaction.abort()
+        Session.remove()
+        testing.tearDown()
+    
+    def get(self, **environ):
+        request = make_request(self.config.registry, '/api/reactions/',
+                {'stream': 'true'}, **environ)
+        try:
+            return views.get_reactions_view(request), request
+        finally:
+            # As the request's transaction ends before the body is read.
+            transaction.abort()
+            Session.remove()
+    
+    def test_streams_with_the_validated_snapshot(self):
+        stream, request = self.get()
+        self.assertEqual(request.override_renderer, 'json_stream')
+        etag = request.response.etag
+        self.assertNotEqual(etag, None)
+        items = list(stream)
+        self.assertEqual([item['message'] for item in items],
+                [u'2', u'1', u'0'])
+        self.assertEqual(self.checked_out, 0)
+        response = self.get(HTTP_IF_NONE_MATCH='"%s"' % etag)[0]
+        self.assertTrue(isinstance(response, HTTPNotModified))
+        self.assertEqual(self.checked_out, 0)
+
+
+
@@ -0,0 +1,486 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Provides ``Thumbnailer``, which makes thumbnails of uploaded and remote
+  images in a pool of worker processes, so requests don't wait for them::
+      
+      thumbnailer = Thumbnailer(thumbnails_dir, processes=2)
+      digest = thumbnailer.submit_url(u'http://example.com/image.jpg')
+      thumbnailer.is_pending(digest)
+      => True
+  
+  Jobs are content addressed: an upload's thumbnail is saved as ``<md5 of
+  its bytes>.png`` and a url's as ``<md5 of the url>.png``, so the digest is
+  known, and returned, before the thumbnail is made.  Until it's saved, the
+  digest is pending.
+  
+  If the thumbnailer has a ``store_dir``, it keeps the original images there
+  and renders other sizes of them on demand, into a ``DiskCache``::
+      
+      paths = thumbnailer.find_derivatives(digest, (320, 240), ['png'])
+      if not paths:
+          paths = thumbnailer.render_derivatives(digest, (320, 240), ['png'])
+  
+"""
+
+import errno
+import hashlib
+import logging
+import os
+import threading
+import urllib2
+import urlparse
+
+try:
+    import Image
+except ImportError:
+    from PIL import Image
+
+try:
+    from PIL import features
+except ImportError:
+    WEBP_SUPPORTED = False
+else:
+    WEBP_SUPPORTED = features.check('webp')
+
+from collections import OrderedDict
+from cStringIO import StringIO
+from multiprocessing import Pool, TimeoutError
+from os.path import exists as path_exists, getsize, isfile, join as join_path
+
+# Read image data in chunks of this size.
+CHUNK_SIZE = 65536
+
+# Only fetch images from urls with these schemes.
+URL_SCHEMES = ('http', 'https')
+
+# Content types of the formats that derivatives can be encoded in.
+FORMATS = {'png': 'image/png', 'jpg': 'image/jpeg', 'webp': 'image/webp'}
+JPEG_QUALITY = 85
+WEBP_QUALITY = 80
+
+class ThumbnailError(ValueError):
+    """Raised when an image can't be thumbnailed."""
+
+
+def read_limited(sock, max_bytes):
+    """Read ``sock`` to the end, raising a ``ThumbnailError`` as soon as more
+      than ``max_bytes`` have been read.
+    """
+    
+    buf = StringIO()
+    size = 0
+    while True:
+        data = sock.read(CHUNK_SIZE)
+        if not data:
+            break
+        size += len(data)
+        if size > max_bytes:
+            raise ThumbnailError('Image is larger than %d bytes.' % max_bytes)
+        buf.write(data)
+    return buf.getvalue()
+
+def fetch(url, max_bytes, timeout):
+    """Return the body of the image at ``url``, upto ``max_bytes`` long."""
+    
+    response = urllib2.urlopen(url, timeout=timeout)
+    try:
+        if response.getcode() != 200:
+            raise ThumbnailError('Got a %s for %s.' % (response.getcode(), url))
+        length = response.info().getheader('Content-Length')
+        if length and length.isdigit() and int(length) > max_bytes:
+            raise ThumbnailError('Image is larger than %d bytes.' % max_bytes)
+        return read_limited(response, max_bytes)
+    finally:
+        response.close()
+
+def render_thumbnail(data, size, max_pixels):
+    """Return ``data``, an encoded image, thumbnailed to fit within ``size``
+      and encoded as PNG.  Only the image header is read before checking
+      that the image is no more than ``max_pixels`` big.
+    """
+    
+    img = Image.open(StringIO(data))
+    if img.format == 'JPEG':
+        # Have the decoder scale the image down (by upto 8x) as it decodes.
+        img.draft('RGB', size)
+    width, height = img.size
+    if width * height > max_pixels:
+        raise ThumbnailError('Image is larger than %d pixels.' % max_pixels)
+    img = img.convert('RGBA')
+    img.thumbnail(size, Image.ANTIALIAS)
+    buf = StringIO()
+    img.save(buf, 'PNG')
+    return buf.getvalue()
+
+def write_file(path, data):
+    """Write ``data`` to ``path`` via a temporary file, so it's never seen
+      half written.
+    """
+    
+    tmp_path = '%s.%d.tmp' % (path, os.getpid())
+    sock = open(tmp_path, 'wb')
+    try:
+        sock.write(data)
+    finally:
+        sock.close()
+    os.rename(tmp_path, path)
+
+def run_job(job):
+    """Make and save a thumbnail in a worker process.  Returns ``(digest,
+      error)``, as the pool doesn't pass exceptions to callbacks.
+    """
+    
+    digest, url, data, path, original_path, size, max_bytes, max_pixels, \
+            timeout = job
+    try:
+        if data is None:
+            data = fetch(url, max_bytes, timeout)
+        write_file(path, render_thumbnail(data, size, max_pixels))
+        if original_path is not None:
+            write_file(original_path, data)
+    except Exception as err:
+        return digest, '%s: %s' % (err.__class__.__name__, err)
+    return digest, None
+
+def is_opaque(img):
+    if img.mode in ('RGBA', 'LA'):
+        return img.split()[-1].getextrema()[0] == 255
+    return 'transparency' not in img.info
+
+def encode_image(img, fmt):
+    """Return ``img`` encoded in ``fmt``, one of the ``FORMATS``."""
+    
+    buf = StringIO()
+    if fmt == 'jpg':
+        if img.mode != 'RGB':
+            # Flatten any transparency onto white.
+            background = Image.new('RGB', img.size, (255, 255, 255))
+            img = img.convert('RGBA')
+            background.paste(img, mask=img.split()[-1])
+            img = background
+        img.save(buf, 'JPEG', quality=JPEG_QUALITY, optimize=True)
+    elif fmt == 'webp':
+        img.save(buf, 'WEBP', quality=WEBP_QUALITY)
+    else:
+        img.save(buf, 'PNG', optimize=True)
+    return buf.getvalue()
+
+def makedirs(directory):
+    try:
+        os.makedirs(directory)
+    except OSError as err:
+        if err.errno != errno.EEXIST:
+            raise
+
+def run_derivative_job(job):
+    """Render a derivative of an original image in a worker process, in
+      each of ``formats`` (apart from JPEG if there are others and the image
+      isn't opaque), saving them to ``paths``.  Returns ``(written, error)``.
+    """
+    
+    source_path, paths, size, formats, max_pixels = job
+    written = []
+    try:
+        img = Image.open(source_path)
+        if img.format == 'JPEG':
+            img.draft('RGB', size)
+        width, height = img.size
+        if width * height > max_pixels:
+            raise ThumbnailError('Image is larger than %d pixels.' % max_pixels)
+        opaque = is_opaque(img)
+        img = img.convert('RGB' if opaque else 'RGBA')
+        img.thumbnail(size, Image.ANTIALIAS)
+        for fmt, path in zip(formats, paths):
+            if fmt == 'jpg' and not opaque and len(formats) > 1:
+                continue
+            makedirs(os.path.dirname(path))
+            write_file(path, encode_image(img, fmt))
+            written.append(path)
+    except Exception as err:
+        return written, '%s: %s' % (err.__class__.__name__, err)
+    return written, None
+
+
+class DiskCache(object):
+    """Tracks the files in ``directory``, removing the least recently used
+      once they total more than ``max_bytes``.  Files that are already there
+      are ordered by their access times.
+    """
+    
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._files = OrderedDict()
+        self._scan()
+    
+    def __len__(self):
+        return len(self._files)
+    
+    def touch(self, path):
+        """Mark the file at ``path`` as recently used, returning whether it
+          exists.  Files written by other processes are tracked from when
+          they're first touched.
+        """
+        
+        exists = isfile(path)
+        with self._lock:
+            size = self._files.pop(path, None)
+            if not exists:
+                if size is not None:
+                    self.size -= size
+                self.misses += 1
+                return False
+            if size is None:
+                size = getsize(path)
+                self.size += size
+            self._files[path] = size
+            self.hits += 1
+        return True
+    
+    def add(self, path):
+        """Track the file just written to ``path`` and evict any others that
+          no longer fit.
+        """
+        
+        size = getsize(path)
+        with self._lock:
+            self.size -= self._files.pop(path, 0)
+            self._files[path] = size
+            self.size += size
+            self._evict()
+    
+    def stats(self):
+        return {
+            'files': len(self._files),
+            'size': self.size,
+            'max_bytes': self.max_bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions
+        }
+    
+    def _scan(self):
+        items = []
+        for root, dirs, files in os.walk(self.directory):
+            for name in files:
+                path = join_path(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                items.append((stat.st_atime, path, stat.st_size))
+        with self._lock:
+            for atime, path, size in sorted(items):
+                self._files[path] = size
+                self.size += size
+            self._evict()
+    
+    def _evict(self):
+        """Remove the least recently used files, keeping at least the most
+          recent.  Must be called with the lock held.
+        """
+        
+        while self.size > self.max_bytes and len(self._files) > 1:
+            path, size = self._files.popitem(last=False)
+            self.size -= size
+            self.evictions += 1
+            try:
+                os.remove(path)
+            except OSError as err:
+                logging.warning(err)
+    
+
+
+class Thumbnailer(object):
+    """Makes ``size`` PNG thumbnails in ``directory`` with a pool of
+      ``processes``, created by ``start()``, which should be called before
+      the process starts any threads, or else when it's first needed.
+      
+      Images are rejected if they're more than ``max_bytes`` long (checked
+      as they're read) or ``max_pixels`` big, and urls are fetched with a
+      ``timeout``.  At most ``max_pending`` jobs can be queued or in flight:
+      more are rejected, rather than queued without bound.  Jobs for a digest
+      that's already pending are deduplicated.
+      
+      If there's a ``store_dir``, the originals are kept in it and derivatives
+      are rendered from them into a ``DiskCache`` of upto ``cache_max_bytes``,
+      waiting upto ``timeout`` seconds for the pool.
+    """
+    
+    def __init__(self, directory, processes=2, size=(100, 100),
+            max_bytes=10485760, max_pixels=25000000, max_pending=100,
+            timeout=10, store_dir=None, cache_max_bytes=268435456):
+        self.directory = directory
+        self.store_dir = store_dir
+        self.processes = processes
+        self.size = size
+        self.max_bytes = max_bytes
+        self.max_pixels = max_pixels
+        self.max_pending = max_pending
+        self.timeout = timeout
+        self.submitted = 0
+        self.deduplicated = 0
+        self.rejected = 0
+        self.completed = 0
+        self.failed = 0
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._pool = None
+        self.derivatives = None
+        if store_dir is not None:
+            makedirs(join_path(store_dir, 'originals'))
+            makedirs(join_path(store_dir, 'derivatives'))
+            self.derivatives = DiskCache(join_path(store_dir, 'derivatives'),
+                    cache_max_bytes)
+    
+    def get_path(self, digest):
+        return join_path(self.directory, '%s.png' % digest)
+    
+    def get_original_path(self, digest):
+        """Return the path to the image to render ``digest``'s derivatives
+          from: its original or, failing that, its thumbnail.
+        """
+        
+        if self.store_dir is not None:
+            path = join_path(self.store_dir, 'originals', digest)
+            if path_exists(path):
+                return path
+        path = self.get_path(digest)
+        return path if path_exists(path) else None
+    
+    def get_derivative_path(self, digest, size, fmt):
+        return join_path(self.store_dir, 'derivatives', digest,
+                '%dx%d.%s' % (size[0], size[1], fmt))
+    
+    def find_derivatives(self, digest, size, formats):
+        """Return the paths of ``digest``'s derivatives of ``size`` that
+          have been rendered in any of ``formats``.
+        """
+        
+        if self.derivatives is None:
+            return []
+        paths = [self.get_derivative_path(digest, size, fmt) for fmt in formats]
+        return [path for path in paths if self.derivatives.touch(path)]
+    
+    def render_derivatives(self, digest, size, formats):
+        """Render ``digest``'s derivatives of ``size`` in ``formats`` in the
+          pool, waiting for them, and return their paths.
+        """
+        
+        if self.derivatives is None:
+            raise ThumbnailError('Derivatives need a store_dir.')
+        source_path = self.get_original_path(digest)
+        if source_path is None:
+            raise ThumbnailError('No image for %s.' % digest)
+        paths = [self.get_derivative_path(digest, size, fmt) for fmt in formats]
+        job = (source_path, paths, size, formats, self.max_pixels)
+        result = self._get_pool().apply_async(run_derivative_job, (job,))
+        try:
+            written, error = result.get(self.timeout)
+        except TimeoutError:
+            raise ThumbnailError('Timed out rendering %s.' % digest)
+        for path in written:
+            self.derivatives.add(path)
+        if error is not None:
+            raise ThumbnailError(error)
+        return written
+    
+    def is_pending(self, digest):
+        return digest in self._pending
+    
+    def submit_file(self, f):
+        """Read the image in the file like ``f`` and submit a job to thumbnail
+          it.  Returns its digest.
+        """
+        
+        data = read_limited(f, self.max_bytes)
+        digest = hashlib.md5(data).hexdigest()
+        return self._submit(digest, data=data)
+    
+    def submit_url(self, url):
+        """Submit a job to fetch and thumbnail the image at ``url``.  Returns
+          its digest.
+        """
+        
+        if urlparse.urlparse(url).scheme.lower() not in URL_SCHEMES:
+            raise ThumbnailError('Not an http url: %s' % url)
+        if isinstance(url, unicode):
+            url = url.encode('utf-8')
+        digest = hashlib.md5(url).hexdigest()
+        return self._submit(digest, url=url)
+    
+    def start(self):
+        """Fork the worker processes."""
+        
+        self._get_pool()
+    
+    def close(self):
+        """Wait for the pending jobs and stop the worker processes."""
+        
+        with self._lock:
+            pool = self._pool
+            self._pool = None
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
+    def stats(self):
+        stats = {
+            'pending': len(self._pending),
+            'submitted': self.submitted,
+            'deduplicated': self.deduplicated,
+            'rejected': self.rejected,
+            'completed': self.completed,
+            'failed': self.failed
+        }
+        if self.derivatives is not None:
+            stats['derivatives'] = self.derivatives.stats()
+        return stats
+    
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                self._pool = Pool(self.processes)
+            return self._pool
+    
+    def _submit(self, digest, url=None, data=None):
+        path = self.get_path(digest)
+        if path_exists(path):
+            return digest
+        with self._lock:
+            if digest in self._pending:
+                self.deduplicated += 1
+                return digest
+            if len(self._pending) >= self.max_pending:
+                self.rejected += 1
+                raise ThumbnailError('Too many pending thumbnails.')
+            self._pending.add(digest)
+            self.submitted += 1
+        original_path = None
+        if self.store_dir is not None:
+            original_path = join_path(self.store_dir, 'originals', digest)
+        job = (digest, url, data, path, original_path, self.size,
+               self.max_bytes, self.max_pixels, self.timeout)
+        self._get_pool().apply_async(run_job, (job,), callback=self._done)
+        return digest
+    
+    def _done(self, result):
+        """Called in the pool's result thread when a job is done."""
+        
+        digest, error = result
+        with self._lock:
+            self._pending.discard(digest)
+            if error is None:
+                self.completed += 1
+            else:
+                self.failed += 1
+        if error is not None:
+            logging.warning('Thumbnail %s failed: %s' % (digest, error))
+
+
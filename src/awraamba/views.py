@@ -5,21 +5,93 @@
 
 #import datetime
 import formencode
+import hashlib
 import logging
 import json
+import os
+import transaction
 #import urllib
 
+from datetime import timedelta
+from os.path import dirname, join as join_path
+
 #from pyramid.response import Response
-from pyramid.events import subscriber, NewResponse
+from pyramid.events import subscriber, NewRequest, NewResponse
+from pyramid.i18n import get_locale_name
+from pyramid.renderers import render
 from pyramid.httpexceptions import HTTPBadRequest, HTTPNotFound, HTTPForbidden
+from pyramid.httpexceptions import HTTPServiceUnavailable, HTTPUnauthorized
+from pyramid.httpexceptions import HTTPNotModified, HTTPTemporaryRedirect
 from pyramid.view import view_config, view_defaults
 from pyramid.security import unauthenticated_userid
+from pyramid.settings import asbool
 
 from pyramid_assetgen import IAssetGenManifest
+from pyramid_weblayer.csrf import CSRFError, CSRFValidator
+from pyramid_weblayer.csrf import METHODS_WITH_SIDE_EFFECTS
+from sqlalchemy import and_, func, select
+from webob.datetime_utils import UTC
 
+from .basemodel import get_serializer, open_snapshot, paginate, query_cache
+from .basemodel import stream_rows
+from .catalog import get_catalog, load_catalog
 from .mail import PostmarkMailer
+from .passwords import PasswordHasherBusy, password_hasher
+from .resolver import domain_resolver
 from awraamba import model, schema
 
+def generate_etag(*args):
+    """Return a strong entity tag for the representation identified by
+      ``args``, which must have a stable ``repr()``.
+    """
+    
+    return hashlib.md5(repr(args)).hexdigest()
+
+def is_not_modified(request, etag, last_modified=None):
+    """Does the conditional ``request`` match ``etag`` / ``last_modified``?
+      ``If-None-Match`` takes precedence over ``If-Modified-Since``.
+    """
+    
+    # Test for the header, as webob's ``If-None-Match: *`` matcher is falsy.
+    if request.headers.get('If-None-Match'):
+        return etag in request.if_none_match
+    if last_modified is not None and request.if_modified_since:
+        last_modified = last_modified.replace(microsecond=0, tzinfo=UTC)
+        return last_modified <= request.if_modified_since
+    return False
+
+def set_validators(response, etag, last_modified=None):
+    """Set the ``ETag`` and ``Last-Modified`` headers on ``response`` and ask
+      clients to revalidate before re-using it.
+    """
+    
+    response.etag = etag
+    if last_modified is not None:
+        response.last_modified = last_modified.replace(tzinfo=UTC)
+    response.cache_control.no_cache = True
+
+def not_modified(etag, last_modified=None):
+    """Return a ``304 Not Modified`` response with the given validators."""
+    
+    response = HTTPNotModified()
+    set_validators(response, etag, last_modified)
+    return response
+
+
+def json_response(request, body, etag, last_modified=None):
+    """Return ``request.response`` with an already serialised JSON ``body``,
+      or a ``304 Not Modified`` if the client has it already.
+    """
+    
+    if is_not_modified(request, etag, last_modified):
+        return not_modified(etag, last_modified)
+    response = request.response
+    response.content_type = 'application/json'
+    response.body = body
+    set_validators(response, etag, last_modified)
+    return response
+
+
 def get_is_authenticated(request):
     """Get the user for the request."""
     
@@ -35,23 +107,186 @@ def get_user(request):
         return model.User.get_by_id(user_id)
 
 
+@subscriber(NewRequest)
+def validate_against_csrf(event):
+    """Validate requests with side effects against cross site request
+      forgeries.  Unlike ``pyramid_weblayer``'s subscriber, this doesn't load
+      the session for other requests, so they don't get a session cookie.
+    """
+    
+    request = event.request
+    if not asbool(request.registry.settings.get('csrf_validate', True)):
+        return
+    if request.method.lower() not in METHODS_WITH_SIDE_EFFECTS:
+        return
+    validator = CSRFValidator(request.session.get_csrf_token())
+    try:
+        validator.validate(request)
+    except CSRFError:
+        raise HTTPUnauthorized
+
+def add_visited_cookie(response):
+    """Add a ``visited`` cookie (that lasts for six weeks) to ``response``."""
+    
+    response.set_cookie('visited', 'true', max_age=3628800)
+
+
+# ``Cache-Control`` policies for ``GET`` and ``HEAD`` responses, by route
+# name.  The API reads don't depend on the user, so shared caches may store
+# them, revalidating with their ``ETag``.  Routes that aren't listed (e.g.:
+# the static views) set their own caching headers.
+CACHE_POLICIES = {
+    'app': 'private, no-cache',
+    'reactions': 'public, no-cache',
+    'threads': 'public, no-cache',
+    'catalog': 'public, no-cache',
+    'stats': 'private, no-store',
+    'reaction_events': 'no-store',
+}
+
 @subscriber(NewResponse)
-def add_visited_cookie(event):
-    """Add a ``visited`` cookie (that lasts for six weeks) to all responses."""
+def set_cache_policy(event):
+    """Set the ``Cache-Control`` header of responses from the dynamic routes
+      to the route's policy, or, for unsafe methods, to ``no-store``.
+    """
     
-    event.response.set_cookie('visited', 'true', max_age=3628800)
+    request = event.request
+    route = getattr(request, 'matched_route', None)
+    if route is None or route.name not in CACHE_POLICIES:
+        return
+    if request.method in ('GET', 'HEAD'):
+        policy = CACHE_POLICIES[route.name]
+    else:
+        policy = 'no-store'
+    event.response.headers['Cache-Control'] = policy
 
 
-@view_config(route_name='app', renderer='app.mako', request_method='GET')
-def app_view(request):
-    """Render the main client application."""
+# Rendered into cached pages in place of the csrf token, which is then
+# substituted per request.  Random, so it can't be forged by user content.
+CSRF_PLACEHOLDER = 'csrf-%s' % os.urandom(16).encode('hex')
+
+# How far before a ``since`` watermark to look for changes, which must be
+# longer than a transaction can take to commit after flushing a change.
+DELTA_OVERLAP = timedelta(seconds=60)
+
+# The top level navigation paths, as selected by ``base.mako``.
+NAV_PATHS = ('/', '/themes', '/scarf')
+
+TEMPLATES_DIR = join_path(dirname(__file__), 'templates')
+
+def get_nav_section(path):
+    """Return the navigation path that ``base.mako`` selects for ``path``."""
+    
+    selected = None
+    for item in NAV_PATHS:
+        if path.startswith(item):
+            selected = item
+    return selected
+
+def get_manifest_info(registry):
+    """Return ``(manifest_data, version)``, the assetgen manifest serialised
+      as JSON and a hash of it, computed once per manifest.
+    """
     
     # XXX this way of getting the data is a temporary hack only.
-    manifest = request.registry.getUtility(IAssetGenManifest, 'awraamba:assets/')
-    manifest_data = json.dumps(manifest._data)
+    manifest = registry.getUtility(IAssetGenManifest, 'awraamba:assets/')
+    info = getattr(registry, 'manifest_info', None)
+    if info is None or info[0] is not manifest._data:
+        manifest_data = json.dumps(manifest._data, sort_keys=True)
+        version = hashlib.md5(manifest_data).hexdigest()
+        info = registry.manifest_info = (manifest._data, manifest_data, version)
+    return info[1:]
+
+def get_templates_version(settings):
+    """Return the latest template modification time if templates are being
+      reloaded, or ``None`` if they're not (and so can't change).
+    """
     
+    if not asbool(settings.get('reload_templates', False)):
+        return None
+    latest = 0
+    for root, dirs, files in os.walk(TEMPLATES_DIR):
+        for name in files:
+            if name.endswith('.mako'):
+                latest = max(latest, os.path.getmtime(join_path(root, name)))
+    return latest
+
+@view_config(route_name='app', request_method='GET')
+def app_view(request):
+    """Render the main client application.
+      
+      The rendered shell only varies by whether it's the user's first visit,
+      the locale, the assetgen manifest, the templates, the tour version, the
+      user, the selected navigation section, the host and whether it's an
+      ajax request, so it's rendered once per combination of those and
+      cached in ``registry.shell_cache``.  The csrf token is rendered as a
+      placeholder and substituted per request.
+      
+      The shell's forms are filled in from ``request.params``, so requests
+      with a query string are rendered afresh and not cached.
+    """
+    
+    registry = request.registry
+    manifest_data, manifest_version = get_manifest_info(registry)
     is_first_time = not request.cookies.get('visited', False)
-    return {'is_first_time': is_first_time, 'manifest_data': manifest_data}
+    username = None
+    if request.is_authenticated and request.user is not None:
+        username = request.user.username
+    key = (
+        request.host_url,
+        get_locale_name(request),
+        manifest_version,
+        get_templates_version(registry.settings),
+        registry.tour_index.version,
+        is_first_time,
+        request.is_authenticated,
+        username,
+        get_nav_section(request.path),
+        request.is_xhr
+    )
+    cache = registry.shell_cache
+    is_cacheable = not request.GET
+    entry = None
+    if is_cacheable:
+        entry = cache.get(key)
+    if entry is None:
+        values = {
+            'is_first_time': is_first_time,
+            'is_ajax': request.is_xhr,
+            'manifest_data': manifest_data,
+            'csrf_token': CSRF_PLACEHOLDER
+        }
+        body = render('app.mako', values, request=request).encode('utf-8')
+        entry = (body, hashlib.md5(body).hexdigest(), CSRF_PLACEHOLDER in body)
+        if is_cacheable:
+            cache.set(key, entry)
+    body, etag, has_placeholder = entry
+    if has_placeholder:
+        token = request.session.get_csrf_token()
+        body = body.replace(CSRF_PLACEHOLDER, token)
+        etag = generate_etag(etag, token)
+    if is_not_modified(request, etag):
+        response = not_modified(etag)
+    else:
+        response = request.response
+        response.content_type = 'text/html'
+        response.charset = 'utf-8'
+        response.body = body
+        set_validators(response, etag)
+    response.vary = ('Cookie',)
+    add_visited_cookie(response)
+    return response
+
+
+def reaction_added(status, registry, theme_slug, reaction_data):
+    """After commit hook that invalidates the theme's cached reactions and
+      publishes the new reaction to the theme's live subscribers.
+    """
+    
+    if status:
+        registry.reactions_cache.invalidate(theme_slug)
+        registry.live_hub.publish(theme_slug, 'reaction', reaction_data,
+                id=reaction_data['reaction_id'])
 
 
 # permission='authenticated'
@@ -73,25 +308,70 @@ def post_reaction_view(request):
         request.response.status = 400
         return err.unpack_errors()
     else:
-        theme = model.Theme.get_by_slug(data['theme_slug'])
+        catalog = get_catalog(request)
+        theme = catalog.themes.get_by_slug(data['theme_slug'])
         if theme is None:
             raise HTTPNotFound
         data['user_username'] = request.user.username
         reaction = model.Reaction(**data)
         model.Session.add(reaction)
-        return reaction.__json__()
+        model.Session.flush()
+        reaction_data = reaction.__json__()
+        # Once committed, invalidate the theme's cached reactions and push
+        # the new reaction to its live subscribers.
+        args = (request.registry, theme.slug, reaction_data)
+        transaction.get().addAfterCommitHook(reaction_added, args=args)
+        return reaction_data
 
 
 @view_config(route_name='reactions', renderer='json', request_method='GET')
 def get_reactions_view(request):
-    """Return a list of reactions.  ATM, this is a pretty naive implementation
-      that either gets all the reactions for a theme, or all the reactions
-      full stop.  That's not really viable in production...
+    """Return a page of reactions, newest first, either for a theme, by a user
+      or across all themes.
+      
+      Pages are keyset paginated on ``(c, id)``: the response is a dict with
+      the reactions in ``items`` and an opaque ``next`` cursor that can be
+      passed back as the ``cursor`` param to get the following page (or
+      ``None`` if there isn't one).
+      
+      If a ``theme_slug`` is given with ``timecode_from`` and / or
+      ``timecode_to`` then the reactions in that window of the theme video
+      are returned in timecode order (paginated on ``(timecode, id)``), so
+      the player can fetch reactions just ahead of the playhead.
+      
+      If ``stream`` is true, all of the matching reactions are returned, in
+      the same order, as a JSON array that's streamed from a server side
+      cursor rather than being loaded into memory.
+      
+      If a ``since`` timestamp is given, only the reactions created or
+      modified after it are returned, oldest change first (paginated on
+      ``(m, id)``), along with the ids of any reactions ``deleted`` since then
+      and a new ``watermark`` to pass as ``since`` next time.  Changes are
+      timestamped when they're flushed, not when they're committed, so the
+      changes in the ``DELTA_OVERLAP`` before ``since`` are returned again:
+      clients should merge them by ``reaction_id`` and ``v``.
+      
+      Responses carry an ``ETag`` and ``Last-Modified`` derived from the
+      matching reactions' latest ``m`` and their count (and, for deltas,
+      the latest deletion and the number deleted), so conditional
+      requests for unchanged reactions get a ``304`` without loading them.
+      
+      Serialised pages of a theme's reactions (apart from streams and
+      deltas) are cached in ``registry.reactions_cache`` until a reaction
+      is added to the theme.  Concurrent requests for the same uncached
+      page wait for and share a single computation of it.
     """
     
+    p = request.params
     data = {
-        'theme_slug': request.params.get('theme_slug', None),
-        'by_username': request.params.get('by_username', None)
+        'theme_slug': p.get('theme_slug', None),
+        'by_username': p.get('by_username', None),
+        'timecode_from': p.get('timecode_from', None),
+        'timecode_to': p.get('timecode_to', None),
+        'since': p.get('since', None),
+        'cursor': p.get('cursor', None),
+        'limit': p.get('limit', None),
+        'stream': p.get('stream', None)
     }
     try:
         data = schema.ContextData.to_python(data)
@@ -100,18 +380,348 @@ def get_reactions_view(request):
         raise HTTPBadRequest
     else:
         if data['theme_slug']:
-            theme = model.Theme.get_by_slug(data['theme_slug'])
-            if theme is None:
-                raise HTTPNotFound
-            reactions = theme.reactions
-        elif data['by_username']:
-            user = model.User.get_by('username', data['by_username'])
-            if user is None:
+            catalog = get_catalog(request)
+            if catalog.themes.get_by_slug(data['theme_slug']) is None:
                 raise HTTPNotFound
-            reactions = user.reactions
+        if data['theme_slug'] and data['since'] is None and not data['stream']:
+            # Serve from the cache, coalescing concurrent misses for the same
+            # page into a single computation.
+            cache = request.registry.reactions_cache
+            key = ('reactions', tuple(sorted(data.items())))
+            entry = cache.get(key)
+            if entry is None:
+                single_flight = request.registry.single_flight
+                entry = single_flight.do(key, load_cached_reactions, cache,
+                        key, data)
+            return json_response(request, *entry)
+        query = get_reactions_query(data)
+        if data['stream']:
+            return stream_reactions(request, data, query)
+        # If the client already has the current representation, tell it so
+        # without loading any rows.
+        etag, last_modified = get_reactions_validators(data, query[0])
+        if is_not_modified(request, etag, last_modified):
+            return not_modified(etag, last_modified)
+        set_validators(request.response, etag, last_modified)
+        return get_reactions_page(data, query)
+
+
+def get_reactions_validators(data, clauses, bind=None):
+    """Return the ``(etag, last_modified)`` of the reactions matching the
+      ``clauses`` for the validated ``data``, queried with ``bind``, if
+      given, or the ``Session``.
+    """
+    
+    if bind is None:
+        bind = model.Session
+    last_modified, count = model.Reaction.get_validator(*clauses, bind=bind)
+    validators = [last_modified, count]
+    if data['since'] is not None:
+        # Deleting a reaction changes the delta too.
+        deleted_at, deleted = get_deleted_validator(data,
+                get_changes_since(data), bind=bind)
+        validators.extend([deleted_at, deleted])
+        if deleted_at is not None:
+            if last_modified is None or deleted_at > last_modified:
+                last_modified = deleted_at
+    etag = generate_etag(sorted(data.items()), *validators)
+    return etag, last_modified
+
+def stream_reactions(request, data, query):
+    """Stream all of the reactions matching ``query``.  The rows are read as
+      the response is written out, after the request's transaction has ended,
+      so they're validated with the same snapshot they're read from.
+    """
+    
+    clauses, keys, descending = query
+    connection = open_snapshot()
+    try:
+        etag, last_modified = get_reactions_validators(data, clauses,
+                bind=connection)
+        if is_not_modified(request, etag, last_modified):
+            connection.close()
+            return not_modified(etag, last_modified)
+        set_validators(request.response, etag, last_modified)
+        if descending:
+            order_by = [item.desc() for item in keys]
         else:
-            reactions = model.Reaction.query.all()
-        return [item.__json__() for item in reactions]
+            order_by = keys
+        select = model.Reaction.select_public(*clauses).order_by(*order_by)
+        serializer = get_serializer(model.Reaction)
+    except Exception:
+        connection.close()
+        raise
+    request.override_renderer = 'json_stream'
+    return stream_rows(select, serializer, connection=connection)
+
+
+def get_reactions_query(data):
+    """Return ``(clauses, keys, descending)``, the filter clauses for, and
+      the keys and direction to sort by, the reactions requested by the
+      validated ``data``.  Raises ``HTTPNotFound`` if the user doesn't exist.
+      Themes are looked up in the catalog before this is called.
+    """
+    
+    table = model.Reaction.__table__
+    clauses = []
+    if data['theme_slug']:
+        clauses.append(table.c.theme_slug == data['theme_slug'])
+    elif data['by_username']:
+        user = model.User.get_by('username', data['by_username'])
+        if user is None:
+            raise HTTPNotFound
+        clauses.append(table.c.user_username == user.username)
+    is_window = (data['timecode_from'] is not None or
+                 data['timecode_to'] is not None)
+    if is_window:
+        if data['timecode_from'] is not None:
+            clauses.append(table.c.timecode >= data['timecode_from'])
+        if data['timecode_to'] is not None:
+            clauses.append(table.c.timecode < data['timecode_to'])
+        keys = (table.c.timecode, table.c.id)
+    else:
+        keys = (table.c.c, table.c.id)
+    if data['since'] is not None:
+        clauses.append(table.c.m > get_changes_since(data))
+        keys = (table.c.m, table.c.id)
+    descending = not (is_window or data['since'] is not None)
+    return clauses, keys, descending
+
+def get_since(data):
+    """Return the ``since`` watermark as a naive UTC datetime."""
+    
+    since = data['since']
+    if since.tzinfo is not None:
+        since = since.astimezone(UTC).replace(tzinfo=None)
+    return since
+
+def get_changes_since(data):
+    """Return the time to look for changes after: the ``since`` watermark
+      less the ``DELTA_OVERLAP``, so changes that were committed after the
+      watermark was given out, but timestamped before it, aren't missed.
+    """
+    
+    return get_since(data) - DELTA_OVERLAP
+
+def get_reactions_page(data, query):
+    """Return a page of the reactions matching ``query``, as returned by
+      ``get_reactions_query(data)``.
+    """
+    
+    clauses, keys, descending = query
+    select = model.Reaction.select_public(*clauses)
+    try:
+        rows, next_cursor = paginate(select, keys, data['limit'],
+                cursor=data['cursor'] or None, descending=descending)
+    except ValueError as err:
+        logging.warning(err)
+        raise HTTPBadRequest
+    serializer = get_serializer(model.Reaction)
+    page = {
+        'items': [serializer(row) for row in rows],
+        'next': next_cursor
+    }
+    if data['since'] is not None:
+        page.update(get_delta_info(data, rows, next_cursor))
+    return page
+
+def load_cached_reactions(cache, key, data):
+    """Load, serialise and cache a page of a theme's reactions, returning
+      the ``(body, etag, last_modified)`` cache entry.
+    """
+    
+    generation = cache.generation([data['theme_slug']])
+    query = get_reactions_query(data)
+    last_modified, count = model.Reaction.get_validator(*query[0])
+    etag = generate_etag(sorted(data.items()), last_modified, count)
+    page = get_reactions_page(data, query)
+    entry = (json.dumps(page), etag, last_modified)
+    cache.set(key, entry, tags=[data['theme_slug']], generation=generation)
+    return entry
+
+
+def select_tombstones(data, since, columns):
+    """Select ``columns`` from the tombstones of the reactions matching
+      ``data`` that were deleted ``since`` a watermark.
+    """
+    
+    table = model.Tombstone.__table__
+    query = select(columns).where(and_(
+        table.c.target == unicode(model.Reaction.__tablename__),
+        table.c.c > since
+    ))
+    if data['theme_slug']:
+        query = query.where(table.c.theme_slug == data['theme_slug'])
+    elif data['by_username']:
+        query = query.where(table.c.user_username == data['by_username'])
+    return query
+
+def get_deleted_validator(data, since, bind=None):
+    """Return ``(last_deleted, count)`` for the reactions matching ``data``
+      that were deleted ``since`` a watermark, queried with ``bind``, if
+      given, or the ``Session``.
+    """
+    
+    if bind is None:
+        bind = model.Session
+    table = model.Tombstone.__table__
+    query = select_tombstones(data, since, [func.max(table.c.c),
+            func.count(table.c.id)])
+    return tuple(bind.execute(query).first())
+
+def get_delta_info(data, rows, next_cursor):
+    """Return the ``deleted`` reaction ids and new ``watermark`` for a page of
+      reactions changed since the ``since`` watermark.
+      
+      Tombstones are only returned with the first page of changes.  The
+      watermark is the last change in the page or, once there are no more
+      pages, the last change or deletion seen.  It never goes back before
+      ``since``, although the changes overlapping it are returned again.
+    """
+    
+    deleted = []
+    watermark = get_since(data)
+    if rows and rows[-1].m > watermark:
+        watermark = rows[-1].m
+    if not data['cursor']:
+        table = model.Tombstone.__table__
+        query = select_tombstones(data, get_changes_since(data),
+                [table.c.target_id, table.c.c])
+        for target_id, deleted_at in model.Session.execute(query):
+            deleted.append(target_id)
+            if next_cursor is None and deleted_at > watermark:
+                watermark = deleted_at
+    return {'deleted': deleted, 'watermark': watermark.isoformat()}
+
+
+@view_config(route_name='reaction_events', request_method='GET')
+def reaction_events_view(request):
+    """Redirect ``EventSource`` subscribers to the live event server, which
+      serves this path on its own port.  In production this path should be
+      proxied straight to it, or ``live.url`` set to its public url.
+    """
+    
+    settings = request.registry.settings
+    url = settings.get('live.url')
+    if not url:
+        if not settings.get('live.port'):
+            raise HTTPNotFound
+        url = '%s://%s:%s%s' % (request.scheme, request.domain,
+                settings['live.port'], request.path)
+    if request.query_string:
+        url = '%s?%s' % (url, request.query_string)
+    return HTTPTemporaryRedirect(location=url)
+
+
+@view_config(route_name='threads', renderer='json', request_method='GET')
+def get_threads_view(request):
+    """Return a page of a theme's top level reactions, with their replies
+      nested in ``children``.  The ``depth`` and ``replies`` params limit how
+      deep and how many replies per reaction are loaded, upto the
+      ``threads.max_depth`` and ``threads.max_replies`` settings.
+    """
+    
+    p = request.params
+    data = {
+        'theme_slug': p.get('theme_slug', None),
+        'cursor': p.get('cursor', None),
+        'limit': p.get('limit', None),
+        'depth': p.get('depth', None),
+        'replies': p.get('replies', None)
+    }
+    try:
+        data = schema.ThreadData.to_python(data)
+    except formencode.Invalid as err:
+        logging.warning(err)
+        raise HTTPBadRequest
+    else:
+        catalog = get_catalog(request)
+        theme = catalog.themes.get_by_slug(data['theme_slug'])
+        if theme is None:
+            raise HTTPNotFound
+        settings = request.registry.settings
+        max_depth = int(settings.get('threads.max_depth', 3))
+        max_replies = int(settings.get('threads.max_replies', 10))
+        if data['depth'] is not None:
+            max_depth = min(data['depth'], max_depth)
+        if data['replies'] is not None:
+            max_replies = min(data['replies'], max_replies)
+        # Coalesce concurrent requests for the same page of threads.
+        key = ('threads', theme.slug, data['limit'], data['cursor'],
+               max_depth, max_replies)
+        single_flight = request.registry.single_flight
+        try:
+            threads, next_cursor = single_flight.do(key,
+                    model.Reaction.get_threads, theme.slug, data['limit'],
+                    cursor=data['cursor'] or None, max_depth=max_depth,
+                    max_replies=max_replies)
+        except ValueError as err:
+            logging.warning(err)
+            raise HTTPBadRequest
+        return {'items': threads, 'next': next_cursor}
+
+
+@view_config(route_name='catalog', request_method='GET')
+def catalog_view(request):
+    """Return the whole catalog of themes, characters and locations, which
+      only changes when it's reloaded, so clients can fetch it once.
+    """
+    
+    catalog = get_catalog(request)
+    return json_response(request, catalog.body, catalog.etag)
+
+
+@view_config(route_name='catalog', renderer='json', request_method='POST')
+def reload_catalog_view(request):
+    """Reload the catalog from the db, e.g.: after editing the fixtures."""
+    
+    user = request.user
+    if user is None or not user.is_admin:
+        raise HTTPForbidden
+    catalog = load_catalog(model.Session)
+    request.registry.catalog = catalog
+    return {
+        'etag': catalog.etag,
+        'themes': len(catalog.themes),
+        'characters': len(catalog.characters),
+        'locations': len(catalog.locations)
+    }
+
+
+@view_config(route_name='stats', renderer='json', request_method='GET')
+def stats_view(request):
+    """Return the counters of the in-process caches and services to admins."""
+    
+    user = request.user
+    if user is None or not user.is_admin:
+        raise HTTPForbidden
+    registry = request.registry
+    hub = registry.live_hub
+    return {
+        'reactions_cache': registry.reactions_cache.stats(),
+        'single_flight': registry.single_flight.stats(),
+        'thumbnailer': registry.thumbnailer.stats(),
+        'query_cache': query_cache.stats(),
+        'password_hasher': password_hasher.stats(),
+        'domain_resolver': domain_resolver.stats(),
+        'micro_cache': registry.micro_cache and registry.micro_cache.stats(),
+        'mail_dispatcher': registry.mail_dispatcher.stats(),
+        'live_hub': {
+            'subscribers': hub.subscriber_count,
+            'published': hub.published,
+            'delivered': hub.delivered
+        }
+    }
+
+
+@view_config(context=PasswordHasherBusy)
+def password_hasher_busy_view(context, request):
+    """Ask clients to retry password checks that couldn't get a process."""
+    
+    logging.warning(context)
+    response = HTTPServiceUnavailable()
+    response.retry_after = 5
+    return response
 
 
 def not_found_view(context, request):